@@ -0,0 +1,135 @@
+import copy
+
+import numpy as np
+
+# lists searched per query unless asked otherwise, more lists find more of the true nearest
+# tracks (higher recall) but score more candidates
+ANN_PROBES = 8
+
+# k-means iterations and training points per list when building the index
+KMEANS_ITERATIONS = 10
+TRAINING_POINTS_PER_LIST = 40
+
+# entries in the (points x centroids) distance matrix worked on at once while clustering
+CLUSTER_CELLS = 1 << 22
+
+
+class AnnIndex:
+    """
+    Inverted file (IVF) index for similar tracks across every genre. The tracks' audio features,
+    weighted and scaled the way find_similar_songs compares them, are clustered with k-means into
+    about sqrt(tracks) lists. A query scores only the tracks in the `probes` lists whose centres
+    are closest to it, with the exact similarity formula, so the scores are the same as a full scan
+    would give and only some of the true nearest tracks can be missed.
+
+    Works on the columns of a SimilarityIndex (tracks without a genre aren't in it).
+    """
+
+    def __init__(self, similarity, lists=None, seed=0):
+        self.similarity = similarity
+
+        # distances between these vectors (summed absolute differences) are the similarity distances
+        vectors = (similarity.features.T * similarity.feature_weights).astype(np.float32)
+
+        # tracks with a missing feature can't be placed, they are left out (a full scan sorts them last)
+        valid = np.flatnonzero(~np.isnan(vectors).any(axis=1))
+        self.list_count = min(len(valid), lists or max(1, int(round(np.sqrt(len(valid))))))
+
+        # a separate generator, so building the index doesn't change the recommenders' random draws
+        rng = np.random.default_rng(seed)
+        if len(valid):
+            sample = valid[rng.choice(len(valid), min(len(valid), TRAINING_POINTS_PER_LIST * self.list_count),
+                                      replace=False)]
+            self.centroids = _kmeans(vectors[sample], self.list_count, rng)
+            assignments = _nearest_centroids(vectors[valid], self.centroids)
+        else:
+            self.centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            assignments = np.empty(0, dtype=np.int64)
+
+        # the columns of each list are one contiguous slice of list_columns
+        by_list = np.argsort(assignments, kind='stable')
+        self.list_columns = valid[by_list]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=self.list_count))])
+        self.vectors = vectors
+
+    def upsert(self, similarity, rows):
+        """
+        The index over similarity, the SimilarityIndex.upsert of this index's one for the tracks at rows.
+        Those tracks are put in the list with the closest centre, the centres themselves stay as they
+        were (a full reload clusters again).
+        """
+        updated = copy.copy(self)
+        updated.similarity = similarity
+
+        # the columns of the matrix have moved, carry every vector and list entry over to its new column
+        moved = similarity.columns[self.similarity.positions]
+        updated.vectors = np.empty((len(similarity.positions), self.vectors.shape[1]), dtype=np.float32)
+        updated.vectors[moved[moved >= 0]] = self.vectors[moved >= 0]
+
+        lists = np.repeat(np.arange(self.list_count), np.diff(self.list_offsets))
+        entry_rows = self.similarity.positions[self.list_columns]
+        kept = ~np.isin(entry_rows, rows)
+
+        # then the updated tracks are placed like any other
+        columns = similarity.columns[rows]
+        columns = columns[columns >= 0]
+        vectors = (similarity.features[:, columns].T * similarity.feature_weights).astype(np.float32)
+        updated.vectors[columns] = vectors
+        valid = ~np.isnan(vectors).any(axis=1)
+        if len(self.centroids):
+            columns, new_lists = columns[valid], _nearest_centroids(vectors[valid], self.centroids)
+        else:
+            columns, new_lists = columns[:0], np.empty(0, dtype=np.int64)
+
+        lists = np.concatenate([lists[kept], new_lists])
+        by_list = np.argsort(lists, kind='stable')
+        updated.list_columns = np.concatenate([similarity.columns[entry_rows[kept]], columns])[by_list]
+        updated.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=self.list_count))])
+        return updated
+
+    def nearest(self, position, count, probes=ANN_PROBES, exclude_track_id=None):
+        """
+        Approximate nearest_global: row positions and similarity scores of about the `count` tracks
+        closest to the track at `position` in the whole catalogue, highest similarity first.
+        """
+        query = np.nan_to_num(self.vectors[self.similarity.columns[position]])
+        probes = max(1, min(probes, self.list_count))
+        distances = ((self.centroids - query) ** 2).sum(axis=1)
+        if probes < self.list_count:
+            probed = np.argpartition(distances, probes - 1)[:probes]
+        else:
+            probed = np.arange(self.list_count)
+
+        candidates = np.concatenate([self.list_columns[self.list_offsets[i]:self.list_offsets[i + 1]]
+                                     for i in probed] + [np.empty(0, dtype=np.int64)])
+        return self.similarity.nearest_among(position, candidates, count, exclude_track_id)
+
+
+def _kmeans(points, count, rng):
+    # Lloyd's algorithm from `count` random points, lists that end up empty restart from a random point
+    centroids = points[rng.choice(len(points), count, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = _nearest_centroids(points, centroids)
+        sizes = np.bincount(assignments, minlength=count)
+        sums = np.stack([np.bincount(assignments, weights=points[:, i], minlength=count)
+                         for i in range(points.shape[1])], axis=1)
+        empty = sizes == 0
+        centroids = (sums / np.maximum(sizes, 1)[:, np.newaxis]).astype(np.float32)
+        centroids[empty] = points[rng.choice(len(points), empty.sum())]
+    return centroids
+
+
+def _nearest_centroids(points, centroids):
+    # index of the closest centroid (squared euclidean) for each point, in chunks of CLUSTER_CELLS
+    # |p - c|^2 = |p|^2 - 2 p.c + |c|^2, and |p|^2 is the same for every centroid.
+    # all float32, close enough for picking a list and several times faster than float64
+    centroids = centroids.astype(np.float32)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    scaled = -2 * centroids.T
+    step = max(1, CLUSTER_CELLS // len(centroids))
+    nearest = np.empty(len(points), dtype=np.int64)
+    for start in range(0, len(points), step):
+        distances = points[start:start + step] @ scaled
+        distances += centroid_norms
+        nearest[start:start + step] = distances.argmin(axis=1)
+    return nearest
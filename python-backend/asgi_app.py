@@ -0,0 +1,291 @@
+# Async serving mode: uvicorn asgi_app:app --host 0.0.0.0 --port 5000 (any ASGI server works)
+#
+# The Flask routes stay as they are, this wraps them in an ASGI app. Request bodies are read and
+# responses written on the event loop, so a slow upload or a slow client doesn't hold a thread.
+# The routes themselves run in bounded thread pools, one per kind of work (photo inference, the
+# recommenders, quick lookups), so photos saturating the inference pool never hold up /api/search.
+# Each route also has its own concurrency limit, requests over it wait (up to MAX_QUEUE of them,
+# after that they get a 503) and the queue depths are reported at /api/pool-status.
+import asyncio
+import io
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask_app import app as flask_app
+
+# threads per pool, sized for the work each does: inference waits on the batched model,
+# the recommenders are CPU bound (numpy/pandas release the GIL for much of it)
+POOL_THREADS = {
+    'inference': int(os.environ.get('MELODEX_INFERENCE_THREADS', 4)),
+    'recommend': int(os.environ.get('MELODEX_RECOMMEND_THREADS', os.cpu_count() or 4)),
+    'light': int(os.environ.get('MELODEX_LIGHT_THREADS', 8))
+}
+
+# (pool, most requests running at once) per route. photo uploads to /api/mood-recommend go to the
+# inference pool, text moods to the recommend pool. routes that aren't listed share DEFAULT_ROUTE
+ROUTES = {
+    '/api/mood-recommend (photo)': ('inference', POOL_THREADS['inference']),
+    '/api/mood-recommend': ('recommend', POOL_THREADS['recommend']),
+    '/api/activity-recommend': ('recommend', POOL_THREADS['recommend']),
+    '/api/random': ('recommend', POOL_THREADS['recommend']),
+    '/api/similar': ('recommend', POOL_THREADS['recommend']),
+    '/api/obscure': ('recommend', POOL_THREADS['recommend']),
+    # a batch is up to BATCH_LIMIT queries, so only a couple run at once
+    '/api/similar/batch': ('recommend', 2),
+    '/api/analyse/batch': ('recommend', 2),
+    '/api/mood-recommend/batch': ('recommend', 2),
+    '/api/activity-recommend/batch': ('recommend', 2),
+    '/api/search': ('light', POOL_THREADS['light']),
+    '/api/analyse': ('light', POOL_THREADS['light'])
+}
+DEFAULT_ROUTE = ('light', POOL_THREADS['light'])
+
+# requests that can wait for each route before new ones are turned away with a 503
+MAX_QUEUE = int(os.environ.get('MELODEX_MAX_QUEUE', 64))
+
+# the route is picked before the body is read, from the headers. multipart mood requests larger than
+# this (or of unknown length) carry a photo, a text mood form is only a few hundred bytes
+PHOTO_MIN_BYTES = 4096
+
+
+class RouteLimit:
+    """
+    Concurrency limit of one route: at most `limit` of its requests run at once, the rest wait
+    in order, up to max_queue of them.
+    """
+
+    def __init__(self, pool, limit, max_queue):
+        self.pool = pool
+        self.limit = limit
+        self.max_queue = max_queue
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.slots = None
+
+    async def acquire(self):
+        # False if the queue is full. the semaphore is made here so it belongs to the running loop
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.limit)
+        if self.slots.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        return True
+
+    def release(self):
+        self.running -= 1
+        self.slots.release()
+
+    def status(self):
+        return {'pool': self.pool, 'limit': self.limit, 'running': self.running,
+                'waiting': self.waiting, 'rejected': self.rejected}
+
+
+class AsgiBridge:
+    """
+    ASGI app running a WSGI app (the Flask app) in bounded thread pools, see the top of this file.
+    pool_threads maps each pool name to its size, routes maps a path to (pool, limit).
+    """
+
+    def __init__(self, wsgi_app, pool_threads=None, routes=None, default_route=None, max_queue=MAX_QUEUE):
+        self.wsgi_app = wsgi_app
+        pool_threads = pool_threads or POOL_THREADS
+        self.pools = {name: ThreadPoolExecutor(threads, thread_name_prefix=f'{name}-pool')
+                      for name, threads in pool_threads.items()}
+        self.pool_threads = dict(pool_threads)
+        self.limits = {path: RouteLimit(pool, limit, max_queue)
+                       for path, (pool, limit) in (ROUTES if routes is None else routes).items()}
+        self.limits['*'] = RouteLimit(*(default_route or DEFAULT_ROUTE), max_queue)
+        self.max_queue = max_queue
+        # calls handed to each pool that haven't got a thread yet
+        self.queued = {name: 0 for name in self.pools}
+        self.queued_lock = threading.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    def route_limit(self, path, headers):
+        if path == '/api/mood-recommend' and _is_photo_upload(headers):
+            path = '/api/mood-recommend (photo)'
+        if path not in self.limits:
+            path = '*'
+        return path, self.limits[path]
+
+    def status(self):
+        # queued counts requests waiting for a route slot plus work waiting for a pool thread
+        routes = {path: limit.status() for path, limit in self.limits.items()}
+        pools = {}
+        for name in self.pools:
+            pool_routes = [route for route in routes.values() if route['pool'] == name]
+            pools[name] = {
+                'threads': self.pool_threads[name],
+                'running': sum(route['running'] for route in pool_routes),
+                'queued': sum(route['waiting'] for route in pool_routes) + self.queued[name]
+            }
+        return {'success': True, 'pools': pools, 'routes': routes, 'max_queue': self.max_queue}
+
+    async def _http(self, scope, receive, send):
+        if scope['path'] == '/api/pool-status':
+            # answered here rather than by a pool, so it works even when every pool is busy
+            await self._send_json(send, 200, self.status())
+            return
+
+        # the route's limit is taken before the body is read, so requests turned away aren't read at all
+        path, limit = self.route_limit(scope['path'], scope.get('headers', []))
+        queued_at = time.perf_counter()
+        if not await limit.acquire():
+            await self._send_json(send, 503, {'success': False, 'error': f'Too many requests queued for {path}'},
+                                  [(b'retry-after', b'1')])
+            return
+
+        try:
+            body = await self._read_body(receive)
+            await self._run_wsgi(limit.pool, self._environ(scope, body), send, queued_at)
+        finally:
+            limit.release()
+
+    async def _in_pool(self, name, function, *args):
+        # function(*args) in one of the pool's threads, counted in self.queued until it gets one
+        def run():
+            with self.queued_lock:
+                self.queued[name] -= 1
+            return function(*args)
+
+        with self.queued_lock:
+            self.queued[name] += 1
+        return await asyncio.get_running_loop().run_in_executor(self.pools[name], run)
+
+    async def _run_wsgi(self, pool, environ, send, queued_at):
+        # the app is called and its body produced in the pool, one chunk at a time for streamed
+        # responses, while the chunks are written out here. data the app gives to write() goes
+        # out before the chunk produced after it
+        started = {}
+        written = []
+
+        def call():
+            # time waiting for a route slot and then a pool thread, recorded as the queue stage
+            environ['melodex.queue_ms'] = (time.perf_counter() - queued_at) * 1000
+            result = self.wsgi_app(environ, start_response)
+            try:
+                body = iter(result)
+                return result, body, next(body, None)
+            except Exception:
+                if hasattr(result, 'close'):
+                    result.close()
+                raise
+
+        def start_response(status, headers, exc_info=None):
+            # an error after the headers went out can't change them any more (PEP 3333)
+            if exc_info is not None and started.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            return written.append
+
+        result, body, chunk = await self._in_pool(pool, call)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            started['sent'] = True
+            while True:
+                for data in _take_all(written):
+                    await send({'type': 'http.response.body', 'body': bytes(data), 'more_body': True})
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await self._in_pool(pool, next, body, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await self._in_pool(pool, result.close)
+
+    async def _read_body(self, receive):
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+        return b''.join(chunks)
+
+    def _environ(self, scope, body):
+        # WSGI environ for the request (PEP 3333)
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False
+        }
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = f'HTTP_{name}'
+                environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+    async def _send_json(self, send, status, obj, headers=()):
+        body = flask_app.json.dumpb(obj)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'), *headers]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for pool in self.pools.values():
+                    pool.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def _is_photo_upload(headers):
+    # whether a /api/mood-recommend request (by its ASGI headers) uploads a photo, see PHOTO_MIN_BYTES
+    headers = dict(headers)
+    if not headers.get(b'content-type', b'').startswith(b'multipart/form-data'):
+        return False
+    length = headers.get(b'content-length')
+    return length is None or not length.isdigit() or int(length) > PHOTO_MIN_BYTES
+
+
+def _take_all(items):
+    # empties the list, returning what was in it
+    taken = items[:]
+    del items[:len(taken)]
+    return taken
+
+
+app = AsgiBridge(flask_app)
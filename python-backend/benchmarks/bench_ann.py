@@ -0,0 +1,53 @@
+"""
+Approximate cross-genre similar songs (ann_index.AnnIndex) compared with an exact scan of the whole
+catalogue: index build time, then for each number of probed lists the recall@10 (share of the exact
+10 nearest songs that were found) and the latency per query.
+
+Run from python-backend/: python -m benchmarks.bench_ann [rows] [queries]
+"""
+import sys
+import time
+
+import numpy as np
+
+from ann_index import AnnIndex
+from benchmarks.synthetic import make_catalogue
+from catalogue_index import SimilarityIndex
+
+PROBES = (1, 2, 4, 8, 16, 32)
+COUNT = 10
+
+
+def per_query_ms(call, positions):
+    start = time.perf_counter()
+    results = [call(position) for position in positions]
+    return results, (time.perf_counter() - start) * 1000 / len(positions)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    data = make_catalogue(rows)
+    similarity = SimilarityIndex(data)
+    start = time.perf_counter()
+    ann = AnnIndex(similarity)
+    build_seconds = time.perf_counter() - start
+
+    positions = np.random.default_rng(0).integers(0, rows, queries)
+    exact, exact_ms = per_query_ms(lambda position: similarity.nearest_global(position, COUNT)[0], positions)
+    exact = [set(found.tolist()) for found in exact]
+
+    print(f'{rows} rows, {ann.list_count} lists built in {build_seconds:.2f}s, {queries} queries')
+    print(f'{"probes":>8}{"recall@10":>11}{"ms/query":>10}{"speed-up":>10}')
+    print(f'{"exact":>8}{1:>11.3f}{exact_ms:>10.2f}{1:>9.1f}x')
+    for probes in PROBES:
+        if probes > ann.list_count:
+            break
+        found, ms = per_query_ms(lambda position: ann.nearest(position, COUNT, probes)[0], positions)
+        recall = np.mean([len(truth & set(result.tolist())) / COUNT for truth, result in zip(exact, found)])
+        print(f'{probes:>8}{recall:>11.3f}{ms:>10.2f}{exact_ms / ms:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
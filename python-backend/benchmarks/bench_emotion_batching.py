@@ -0,0 +1,73 @@
+"""
+Throughput and latency of per-request emotion predictions compared with BatchedPredictor,
+using a small stand-in model instead of the Keras one.
+
+Run from python-backend/: python -m benchmarks.bench_emotion_batching [clients] [requests per client]
+"""
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from emotion_inference import BatchedPredictor
+
+
+class StandInModel:
+    """
+    4-class classifier over 48x48 crops with a fixed cost per predict call, like Keras'
+    per-call overhead, and one device that runs a single call at a time.
+    """
+
+    def __init__(self, call_overhead_ms=4.0, seed=0):
+        self.call_overhead = call_overhead_ms / 1000
+        self.weights = np.random.default_rng(seed).normal(size=(48 * 48, 4))
+        self.device = threading.Lock()
+
+    def predict(self, batch):
+        with self.device:
+            time.sleep(self.call_overhead)
+            logits = batch.reshape(len(batch), -1) @ self.weights
+            logits -= logits.max(axis=1, keepdims=True)
+            probabilities = np.exp(logits)
+            return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+
+def run(predict_one, clients, requests_per_client):
+    faces = np.random.default_rng(1).random((clients, 48, 48, 1))
+    latencies = []
+
+    def client(i):
+        for _ in range(requests_per_client):
+            start = time.perf_counter()
+            predict_one(faces[i])
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(client, range(clients)))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    return len(latencies) / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+
+def main():
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 32
+    requests_per_client = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    model = StandInModel()
+
+    results = {'per request': run(lambda face: model.predict(face[np.newaxis])[0], clients, requests_per_client)}
+    for batch_size, wait_ms in ((8, 2), (16, 5), (32, 5)):
+        predictor = BatchedPredictor(model.predict, batch_size, wait_ms)
+        results[f'batched {batch_size}/{wait_ms}ms'] = run(predictor.predict, clients, requests_per_client)
+        predictor.close()
+
+    print(f'{clients} concurrent clients, {requests_per_client} requests each')
+    for name, (throughput, p50, p95) in results.items():
+        print(f'{name:>18}: {throughput:8.1f} predictions/s   p50 {p50:7.2f} ms   p95 {p95:7.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Adding or updating tracks: Catalogue.upsert (incremental, what /api/catalogue-upsert does) compared
+with writing the change into the CSV and loading it again (parse, deduplicate, build every index),
+for deltas of several sizes, half of them updates to existing tracks and half new tracks.
+
+Run from python-backend/: python -m benchmarks.bench_ingest [rows]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import make_catalogue
+from catalogue_index import CatalogueIndex
+from catalogue_manager import Catalogue
+from catalogue_store import drop_duplicate_tracks
+
+DELTA_SIZES = (10, 100, 1000, 10000)
+
+
+def make_delta(data, size, rng):
+    updates = data.iloc[rng.choice(len(data), size // 2, replace=False)].copy()
+    updates['popularity'] = rng.integers(0, 100, len(updates))
+    additions = make_catalogue(size - len(updates), seed=int(rng.integers(1 << 30)))
+    additions['track_name'] = [f'Added track {i}' for i in range(len(additions))]
+    additions['track_id'] = [f'added{i}' for i in range(len(additions))]
+    return pd.concat([updates, additions], ignore_index=True)
+
+
+def full_reload(csv_path):
+    data = drop_duplicate_tracks(pd.read_csv(csv_path))
+    CatalogueIndex(data)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rng = np.random.default_rng(0)
+    data = make_catalogue(rows)
+    catalogue = Catalogue(data, 'bench')
+
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'songs_dataset.csv')
+        data.to_csv(csv_path, index=False)
+        start = time.perf_counter()
+        full_reload(csv_path)
+        reload_seconds = time.perf_counter() - start
+
+    # the first upsert also builds the (track_name, artists) keys, it is timed separately
+    start = time.perf_counter()
+    catalogue.upsert(make_delta(data, 2, rng), 'first')
+    first_seconds = time.perf_counter() - start
+
+    print(f'{rows} rows, full reload {reload_seconds:.2f}s, first upsert (builds the track keys) {first_seconds:.2f}s')
+    print(f'{"delta tracks":>12}{"upsert":>10}{"speed-up":>10}')
+    catalogue = catalogue.upsert(make_delta(data, 2, rng), 'warm')[0]
+    for size in DELTA_SIZES:
+        delta = make_delta(data, size, rng)
+        start = time.perf_counter()
+        catalogue.upsert(delta, f'delta-{size}')
+        seconds = time.perf_counter() - start
+        print(f'{size:>12}{seconds:>9.3f}s{reload_seconds / seconds:>9.1f}x')
+
+
+if __name__ == '__main__':
+    main()
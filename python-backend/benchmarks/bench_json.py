@@ -0,0 +1,57 @@
+"""
+Encode time of a 100-playlist response with the standard json module (what Flask's default
+provider does, with a numpy default() hook) compared with FastJSONProvider, and of the same
+songs handed over as numpy columns instead of one dict per song.
+
+Run from python-backend/: python -m benchmarks.bench_json [rows]
+"""
+import json
+import sys
+import timeit
+
+import numpy as np
+from flask import Flask
+
+import json_provider
+from benchmarks.synthetic import make_catalogue
+from catalogue_index import CatalogueIndex
+from json_provider import FastJSONProvider, encode_default
+from music_recommender import recommend_by_activity
+
+PLAYLISTS = 100
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = make_catalogue(rows)
+    index = CatalogueIndex(data)
+    np.random.seed(0)
+    response = {'success': True, 'items': recommend_by_activity(data, 'party', 'playlist', PLAYLISTS, index=index)}
+
+    # the same songs as one array per field
+    songs = data.iloc[np.random.choice(len(data), PLAYLISTS * 10, replace=False)]
+    columnar = {'success': True, 'songs': {
+        'track_name': songs['track_name'].to_numpy(dtype=object).tolist(),
+        'popularity': songs['popularity'].to_numpy(),
+        'duration_ms': songs['duration_ms'].to_numpy(),
+        'energy': songs['energy'].to_numpy()
+    }}
+
+    provider = FastJSONProvider(Flask(__name__))
+    cases = {
+        'json, numpy default()': lambda: json.dumps(response, default=encode_default, sort_keys=True,
+                                                    separators=(',', ':')),
+        'FastJSONProvider': lambda: provider.dumpb(response),
+        'json, columns': lambda: json.dumps(columnar, default=encode_default, sort_keys=True, separators=(',', ':')),
+        'FastJSONProvider, columns': lambda: provider.dumpb(columnar)
+    }
+
+    print(f'{PLAYLISTS} playlists, {len(provider.dumpb(response)) // 1024} KB'
+          f'{"" if json_provider.orjson else " (orjson is not installed, both use json)"}')
+    for name, run in cases.items():
+        seconds = min(timeit.repeat(run, number=50, repeat=5)) / 50
+        print(f'{name:>28}: {seconds * 1000:8.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
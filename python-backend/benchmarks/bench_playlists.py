@@ -0,0 +1,53 @@
+"""
+Time to generate 50 playlists with PlaylistEngine, on its own and through recommend_by_activity,
+compared with drawing each playlist with its own sample as recommend_by_activity used to.
+
+Run from python-backend/: python -m benchmarks.bench_playlists [rows]
+"""
+import sys
+import timeit
+
+import numpy as np
+
+from benchmarks.synthetic import make_catalogue
+from catalogue_index import CatalogueIndex
+from music_recommender import PLAYLIST_SONG_FIELDS, recommend_by_activity, to_records
+
+PLAYLISTS = 50
+
+
+def sampled_playlists(data, songs, count):
+    # one DataFrame.sample per playlist, songs can repeat across playlists
+    playlists = []
+    for _ in range(count):
+        playlist_songs = data.iloc[songs].sample(min(10, len(songs)))
+        playlists.append({
+            'total_duration_ms': int(playlist_songs['duration_ms'].sum()),
+            'songs': to_records(playlist_songs, PLAYLIST_SONG_FIELDS)
+        })
+    return playlists
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = make_catalogue(rows)
+    index = CatalogueIndex(data)
+    songs = np.flatnonzero(index.masks.activities['party'])
+    print(f'{rows} rows, {len(songs)} party songs, {PLAYLISTS} playlists')
+
+    cases = {
+        'sample per playlist': lambda: sampled_playlists(data, songs, PLAYLISTS),
+        'engine': lambda: index.playlists.generate(songs, PLAYLISTS),
+        'engine, 1 song per artist': lambda: index.playlists.generate(songs, PLAYLISTS, max_per_artist=1),
+        'engine, 1 hour': lambda: index.playlists.generate(songs, PLAYLISTS, target_duration_ms=3600000),
+        'endpoint': lambda: recommend_by_activity(data, 'party', 'playlist', PLAYLISTS, index=index),
+        'endpoint, 1 hour, 2 per artist': lambda: recommend_by_activity(
+            data, 'party', 'playlist', PLAYLISTS, 3600000, 2, index=index)
+    }
+    for name, run in cases.items():
+        seconds = min(timeit.repeat(run, number=20, repeat=3)) / 20
+        print(f'{name:>32}: {seconds * 1000:8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
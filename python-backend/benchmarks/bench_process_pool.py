@@ -0,0 +1,66 @@
+"""
+Throughput of similar songs and playlist calls from concurrent clients, run in threads of this
+process compared with ProcessExecutor worker processes, for 1 up to the number of cores.
+Threads are held back by the GIL, processes should scale with the cores.
+
+Run from python-backend/: python -m benchmarks.bench_process_pool [rows] [calls per run]
+"""
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from benchmarks.synthetic import make_catalogue
+from catalogue_index import CatalogueIndex
+from catalogue_manager import Catalogue
+from music_recommender import find_similar_songs, recommend_by_activity, recommend_by_mood
+from process_executor import ProcessExecutor
+
+
+def cases(data, track_ids):
+    return {
+        'find_similar_songs': lambda i, index, executor: find_similar_songs(
+            data, track_ids[i % len(track_ids)], 10, index=index, executor=executor),
+        'recommend_by_mood playlist': lambda i, index, executor: recommend_by_mood(
+            data, 'happy', 'playlist', 10, index=index, executor=executor),
+        'recommend_by_activity playlist': lambda i, index, executor: recommend_by_activity(
+            data, 'party', 'playlist', 10, max_per_artist=2, index=index, executor=executor)
+    }
+
+
+def throughput(call, clients, calls):
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(call, range(clients)))
+        start = time.perf_counter()
+        list(pool.map(call, range(calls)))
+    return calls / (time.perf_counter() - start)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    calls = int(sys.argv[2]) if len(sys.argv) > 2 else 400
+    cores = os.cpu_count() or 1
+    counts = sorted({count for count in (1, 2, 4, 8) if count < cores} | {cores})
+
+    data = make_catalogue(rows)
+    catalogue = Catalogue(data, 'bench', index=CatalogueIndex(data))
+    track_ids = data['track_id'].to_numpy(dtype=object)[np.random.default_rng(0).integers(0, rows, 1000)].tolist()
+
+    print(f'{rows} rows, {calls} calls per run, {cores} cores, calls/s')
+    print(f'{"":<32}{"clients":>8}{"threads":>10}{"processes":>11}')
+    for name, case in cases(data, track_ids).items():
+        for clients in counts:
+            threads = throughput(lambda i: case(i, catalogue.index, None), clients, calls)
+
+            executor = ProcessExecutor(clients)
+            executor.start(catalogue)
+            processes = throughput(lambda i: case(i, catalogue.index, executor), clients, calls)
+            executor.stop()
+
+            print(f'{name:<32}{clients:>8}{threads:>10.0f}{processes:>11.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Compare the old iterrows() result building with to_records().
+
+Run from python-backend/: python -m benchmarks.bench_serialisation
+"""
+import timeit
+
+from benchmarks.synthetic import make_catalogue
+from music_recommender import to_records, SONG_FIELDS, PLAYLIST_SONG_FIELDS
+
+
+def iterrows_songs(df):
+    return [{
+        'track_name': row['track_name'],
+        'artist': row['artists'],
+        'album': row['album_name'],
+        'genre': row['track_genre'],
+        'popularity': int(row['popularity']),
+        'duration_ms': int(row.get('duration_ms', 180000))
+    } for _, row in df.iterrows()]
+
+
+def iterrows_playlist(df):
+    return [{
+        'track_name': row['track_name'],
+        'artist': row['artists'],
+        'duration_ms': int(row.get('duration_ms', 180000))
+    } for _, row in df.iterrows()]
+
+
+def main():
+    data = make_catalogue(20000)
+
+    for size in (10, 100, 1000):
+        sample = data.sample(size, random_state=0)
+        assert iterrows_songs(sample) == to_records(sample, SONG_FIELDS)
+
+        runs = max(3, 2000 // size)
+        before = timeit.timeit(lambda: iterrows_songs(sample), number=runs) / runs
+        after = timeit.timeit(lambda: to_records(sample, SONG_FIELDS), number=runs) / runs
+        print(f'{size:>5} songs      iterrows {before * 1e3:8.3f} ms   to_records {after * 1e3:8.3f} ms   {before / after:5.1f}x')
+
+    # a 100 playlist response, 10 songs each
+    playlists = [data.sample(10, random_state=i) for i in range(100)]
+    before = timeit.timeit(lambda: [iterrows_playlist(p) for p in playlists], number=5) / 5
+    after = timeit.timeit(lambda: [to_records(p, PLAYLIST_SONG_FIELDS) for p in playlists], number=5) / 5
+    print(f'  100 playlists  iterrows {before * 1e3:8.3f} ms   to_records {after * 1e3:8.3f} ms   {before / after:5.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Similar songs (scope 'genre') served from the precomputed table (similar_table) compared with
+computing them live: the time to build the table with 1 and all worker processes, then the
+latency per /api/similar call of find_similar_songs both ways.
+
+Run from python-backend/: python -m benchmarks.bench_similar_table [rows] [queries]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import make_catalogue
+from catalogue_manager import Catalogue
+from music_recommender import find_similar_songs
+from similar_table import build_similar_table, load_similar_table
+
+COUNTS = (5, 50)
+
+
+def per_query_ms(catalogue, track_ids, count):
+    start = time.perf_counter()
+    for track_id in track_ids:
+        find_similar_songs(catalogue.data, track_id, count, index=catalogue.index)
+    return (time.perf_counter() - start) * 1000 / len(track_ids)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    # the same catalogue twice, the table is only attached to the second
+    live = Catalogue(make_catalogue(rows), 'bench')
+    served = Catalogue(live.data, 'bench')
+    track_ids = live.data['track_id'].to_numpy()[np.random.default_rng(0).integers(0, rows, queries)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        table_path = os.path.join(directory, 'songs_dataset.similar')
+        for processes in sorted({1, os.cpu_count() or 1}):
+            start = time.perf_counter()
+            build_similar_table(live, table_path, processes)
+            print(f'{rows} rows, table built with {processes} processes in {time.perf_counter() - start:.2f}s, '
+                  f'{os.path.getsize(os.path.join(table_path, "positions.npy")) / 1e6:.0f} MB')
+        served.index.similar_table = load_similar_table(table_path, served)
+
+        print(f'{"count":>6}{"live ms":>10}{"table ms":>10}{"speed-up":>10}')
+        for count in COUNTS:
+            live_ms = per_query_ms(live, track_ids, count)
+            table_ms = per_query_ms(served, track_ids, count)
+            print(f'{count:>6}{live_ms:>10.3f}{table_ms:>10.3f}{live_ms / table_ms:>9.1f}x')
+        # the table's files are memory-mapped, let go of them before the directory is removed
+        served.index.similar_table = None
+
+
+if __name__ == '__main__':
+    main()
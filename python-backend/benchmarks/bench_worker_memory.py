@@ -0,0 +1,101 @@
+"""
+Per-worker memory with each worker loading its own catalogue from CSV, compared with the
+shared mode (snapshot memory-mapped and indexes built once in the parent, then forked).
+
+Run from python-backend/: python -m benchmarks.bench_worker_memory [rows] [workers]
+Linux only, memory figures come from /proc/self/smaps_rollup.
+"""
+import gc
+import multiprocessing
+import os
+import sys
+import tempfile
+
+from benchmarks.synthetic import make_catalogue
+from catalogue_index import CatalogueIndex
+from catalogue_store import build_snapshot, drop_duplicate_tracks
+from music_recommender import find_similar_songs, load_data, recommend_by_mood, search_songs
+
+
+def memory_usage():
+    # RSS counts shared pages in full, PSS splits them between the processes sharing them,
+    # USS is what the process holds on its own
+    fields = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1]) / 1024
+    return {
+        'rss': fields['Rss'],
+        'pss': fields['Pss'],
+        'uss': fields['Private_Clean'] + fields['Private_Dirty']
+    }
+
+
+def serve_a_little(data, index):
+    # touch the catalogue the way requests would
+    track_ids = data['track_id'].iloc[:20].tolist()
+    for track_id in track_ids:
+        find_similar_songs(data, track_id, 5, index=index)
+    recommend_by_mood(data, 'happy', 'playlist', 5, index=index)
+    search_songs(data, 'love', index=index)
+
+
+def worker(dataset_path, catalogue, barrier, results):
+    if catalogue is None:
+        data = drop_duplicate_tracks(load_data(dataset_path))
+        index = CatalogueIndex(data)
+    else:
+        data, index = catalogue
+    serve_a_little(data, index)
+
+    # measure once every worker is up, so shared pages are split between all of them
+    barrier.wait()
+    results.put(memory_usage())
+    barrier.wait()
+
+
+def run(mode, dataset_path, workers):
+    context = multiprocessing.get_context('fork')
+    catalogue = None
+    if mode == 'shared':
+        build_snapshot(dataset_path)
+        data = drop_duplicate_tracks(load_data(dataset_path))
+        catalogue = (data, CatalogueIndex(data))
+        gc.freeze()
+
+    barrier = context.Barrier(workers)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(dataset_path, catalogue, barrier, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    usage = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    gc.unfreeze()
+    return usage
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    with tempfile.TemporaryDirectory() as directory:
+        dataset_path = os.path.join(directory, 'songs_dataset.csv')
+        make_catalogue(rows).to_csv(dataset_path, index=False)
+
+        print(f'{rows} rows, {workers} workers (MB)')
+        for mode in ('independent', 'shared'):
+            usage = run(mode, dataset_path, workers)
+            rss = sum(u['rss'] for u in usage) / workers
+            pss = sum(u['pss'] for u in usage) / workers
+            uss = sum(u['uss'] for u in usage) / workers
+            total = sum(u['pss'] for u in usage)
+            print(f'{mode:>12}: per worker RSS {rss:7.1f}  PSS {pss:7.1f}  USS {uss:7.1f}   total PSS {total:7.1f}')
+
+
+if __name__ == '__main__':
+    main()
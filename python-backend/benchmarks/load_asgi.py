@@ -0,0 +1,173 @@
+"""
+Load test of the async serving mode (asgi_app): /api/search latency on its own, then while photo
+uploads saturate the inference pool. Run once with the default pools and once with every route
+sharing a single pool (what a plain threaded server does), to show search stays flat only when
+photos are kept to their own pool.
+
+Requests go straight into the ASGI app from asyncio clients in this process, no server needed.
+The emotion model is replaced by the stand-in from bench_emotion_batching and face detection is
+skipped (the synthetic photos have no faces), the photos are still decoded.
+
+Run from python-backend/:
+    python -m benchmarks.load_asgi [--rows 20000] [--seconds 5] [--search-clients 4] [--photo-clients 32]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import urllib.parse
+
+import cv2
+import numpy as np
+
+from benchmarks.bench_emotion_batching import StandInModel
+from benchmarks.synthetic import make_catalogue
+from catalogue_index import CatalogueIndex
+from emotion_inference import BatchedPredictor
+
+# cost of each stand-in model call, about what the Keras model takes on a CPU
+INFER_CALL_MS = 40.0
+
+
+def load_app(rows):
+    os.environ['MELODEX_CACHE_SIZE'] = '0'
+    os.environ.setdefault('MELODEX_RELOAD_INTERVAL', '0')
+    os.environ.setdefault('MELODEX_DATASET_PATH', os.devnull)
+    import asgi_app
+    import flask_app
+
+    data = make_catalogue(rows)
+    flask_app.catalogue_manager.install(flask_app.Catalogue(data, f'synthetic-{rows}', index=CatalogueIndex(data)))
+
+    flask_app.emotion_predictor = BatchedPredictor(StandInModel(INFER_CALL_MS).predict, flask_app.EMOTION_BATCH_SIZE,
+                                                   flask_app.EMOTION_BATCH_WAIT_MS)
+
+    def decode_only(image_bytes, timings=None):
+        gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        return np.expand_dims(cv2.resize(gray, (48, 48)) / 255.0, axis=-1)
+
+    flask_app.extract_face = decode_only
+    return asgi_app, flask_app, data
+
+
+def photo_form():
+    # multipart body like the frontend sends, with a 640x480 photo
+    image = np.random.default_rng(0).integers(0, 256, (480, 640), dtype=np.uint8)
+    photo = cv2.imencode('.jpg', image)[1].tobytes()
+    boundary = 'melodexloadtest'
+    fields = {'input_method': 'photo', 'item_type': 'song', 'count': '5'}
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+             for name, value in fields.items()]
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="mood_photo"; filename="mood_photo.jpg"\r\n'
+                 f'Content-Type: image/jpeg\r\n\r\n'.encode() + photo + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+async def request(app, method, path, query='', body=b'', content_type=None):
+    # one request through the ASGI app, returns the status
+    scope = {
+        'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http', 'path': path,
+        'raw_path': path.encode(), 'query_string': query.encode(), 'root_path': '',
+        'headers': [(b'content-type', content_type.encode())] if content_type else [],
+        'client': ('127.0.0.1', 0), 'server': ('localhost', 5000)
+    }
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    status = {}
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status['code'] = message['status']
+
+    await app(scope, receive, send)
+    return status['code']
+
+
+async def client(deadline, make_request, latencies, statuses):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        statuses.append(await make_request())
+        latencies.append(time.perf_counter() - start)
+
+
+async def scenario(app, queries, search_clients, photo_clients, seconds):
+    deadline = time.perf_counter() + seconds
+    search_latencies, search_statuses = [], []
+    photo_latencies, photo_statuses = [], []
+    max_queued = 0
+    form, content_type = photo_form()
+
+    def search(i):
+        query = urllib.parse.urlencode({'query': queries[i % len(queries)]})
+        return lambda: request(app, 'GET', '/api/search', query)
+
+    async def watch_queues():
+        nonlocal max_queued
+        while time.perf_counter() < deadline:
+            pools = app.status()['pools']
+            max_queued = max(max_queued, max(pool['queued'] for pool in pools.values()))
+            await asyncio.sleep(0.02)
+
+    await asyncio.gather(
+        watch_queues(),
+        *(client(deadline, search(i), search_latencies, search_statuses) for i in range(search_clients)),
+        *(client(deadline, lambda: request(app, 'POST', '/api/mood-recommend', body=form, content_type=content_type),
+                 photo_latencies, photo_statuses) for _ in range(photo_clients))
+    )
+
+    search_ms = np.array(search_latencies) * 1000
+    return {
+        'search_p50_ms': float(np.percentile(search_ms, 50)),
+        'search_p99_ms': float(np.percentile(search_ms, 99)),
+        'search_per_s': len(search_ms) / seconds,
+        'photos_per_s': sum(status == 200 for status in photo_statuses) / seconds,
+        'photo_errors': sum(status != 200 for status in photo_statuses),
+        'max_queued': max_queued
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--search-clients', type=int, default=4)
+    parser.add_argument('--photo-clients', type=int, default=32)
+    args = parser.parse_args()
+
+    asgi_app, flask_app, data = load_app(args.rows)
+    names = data['track_name'].str.lower().to_numpy(dtype=object)
+    queries = [name[:5] for name in names[np.random.default_rng(0).integers(0, len(names), 500)]]
+
+    shared_threads = sum(asgi_app.POOL_THREADS.values())
+    configurations = {
+        'separate pools': asgi_app.AsgiBridge(flask_app.app),
+        f'one shared pool ({shared_threads} threads)': asgi_app.AsgiBridge(
+            flask_app.app, {'shared': shared_threads}, routes={}, default_route=('shared', shared_threads))
+    }
+
+    print(f'{args.rows} rows, {args.search_clients} search clients, {args.photo_clients} photo clients, '
+          f'{args.seconds:.0f} s per run, stand-in model {INFER_CALL_MS:.0f} ms per call\n')
+    print(f'{"":<32}{"photos":>7}{"search p50":>12}{"search p99":>12}{"search/s":>10}'
+          f'{"photos/s":>10}{"max queued":>12}')
+    # every run shares one event loop, the route limits belong to the loop they were first used in
+    asyncio.run(run_all(configurations, queries, args))
+
+
+async def run_all(configurations, queries, args):
+    for name, app in configurations.items():
+        for photo_clients in (0, args.photo_clients):
+            result = await scenario(app, queries, args.search_clients, photo_clients, args.seconds)
+            print(f'{name:<32}{photo_clients:>7}{result["search_p50_ms"]:>10.2f}ms{result["search_p99_ms"]:>10.2f}ms'
+                  f'{result["search_per_s"]:>10.0f}{result["photos_per_s"]:>10.1f}{result["max_queued"]:>12}')
+            if result['photo_errors']:
+                print(f'  {result["photo_errors"]} photo requests failed', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""
+Benchmark and load-test suite: microbenchmarks every recommender function, then load tests the
+/api endpoints, on synthetic catalogues of one or more sizes. Reports p50/p95/p99 latency,
+throughput and peak memory allocated per function or endpoint, as a table or as JSON for
+comparing runs over time.
+
+Run from python-backend/:
+    python -m benchmarks.suite [--rows 10000,100000] [--iterations 200] [--concurrency 4]
+                               [--server] [--cache] [--only recommenders|endpoints] [--json results.json]
+
+The load test goes through Flask's test client, or with --server through a local threaded WSGI
+server over HTTP. The response cache is turned off unless --cache is given, so every request is
+computed. Photo mood detection isn't covered (it needs the emotion model).
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import make_catalogue
+from catalogue_index import ACTIVITY_FILTERS, MOOD_FEATURES, CatalogueIndex
+from music_recommender import (
+    find_obscure_songs, find_similar_songs, find_similar_songs_batch, get_song_analysis, random_recommendations,
+    recommend_by_activity, recommend_by_mood, search_songs
+)
+
+# number of calls whose allocations are traced for the peak memory figure, separately from
+# the timed calls since tracing slows everything down
+TRACED_CALLS = 5
+
+
+def measure(call, iterations, concurrency=1, trace=True):
+    """
+    Time `iterations` calls of call(i) spread over `concurrency` threads, then (with trace) the
+    peak memory allocated by a few more. call returns False for a failed request.
+    """
+    call(0)
+    latencies = []
+    errors = []
+
+    def timed(i):
+        start = time.perf_counter()
+        ok = call(i)
+        latencies.append(time.perf_counter() - start)
+        if ok is False:
+            errors.append(i)
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            list(pool.map(timed, range(iterations)))
+    else:
+        for i in range(iterations):
+            timed(i)
+    elapsed = time.perf_counter() - start
+
+    milliseconds = np.array(latencies) * 1000
+    return {
+        'calls': iterations,
+        'errors': len(errors),
+        'mean_ms': float(milliseconds.mean()),
+        'p50_ms': float(np.percentile(milliseconds, 50)),
+        'p95_ms': float(np.percentile(milliseconds, 95)),
+        'p99_ms': float(np.percentile(milliseconds, 99)),
+        'throughput_per_s': iterations / elapsed,
+        'peak_alloc_mb': peak_allocation(call) if trace else None
+    }
+
+
+def peak_allocation(call):
+    # MB allocated at the peak of a few calls, traced separately from the timed calls since tracing
+    # slows everything down
+    tracemalloc.start()
+    for i in range(TRACED_CALLS):
+        call(i)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def workload(data, index, seed=0):
+    # request parameters drawn once up front, call i uses entry i % len of each list
+    rng = np.random.default_rng(seed)
+    names = data['track_name'].to_numpy(dtype=object)[rng.integers(0, len(data), 1000)]
+    return {
+        'track_ids': data['track_id'].to_numpy(dtype=object)[rng.integers(0, len(data), 1000)].tolist(),
+        'queries': [name.lower()[:length] for name, length in zip(names, rng.integers(3, 9, len(names)))],
+        'genres': sorted(index.masks.genres),
+        'moods': sorted(MOOD_FEATURES),
+        'activities': sorted(ACTIVITY_FILTERS)
+    }
+
+
+def pick(values, i):
+    return values[i % len(values)]
+
+
+def recommender_cases(data, index, w):
+    return {
+        'recommend_by_mood song': lambda i: recommend_by_mood(data, pick(w['moods'], i), 'song', 10, index=index),
+        'recommend_by_mood song genre': lambda i: recommend_by_mood(
+            data, pick(w['moods'], i), 'song', 10, pick(w['genres'], i), index=index),
+        'recommend_by_mood song score': lambda i: recommend_by_mood(
+            data, pick(w['moods'], i), 'song', 10, ranking='score', index=index),
+        'recommend_by_mood playlist': lambda i: recommend_by_mood(
+            data, pick(w['moods'], i), 'playlist', 5, index=index),
+        'recommend_by_activity song': lambda i: recommend_by_activity(
+            data, pick(w['activities'], i), 'song', 10, index=index),
+        'recommend_by_activity song score': lambda i: recommend_by_activity(
+            data, pick(w['activities'], i), 'song', 10, ranking='score', index=index),
+        'recommend_by_activity playlist': lambda i: recommend_by_activity(
+            data, pick(w['activities'], i), 'playlist', 5, index=index),
+        'random_recommendations song': lambda i: random_recommendations(data, 'song', None, 10, index=index),
+        'random_recommendations album': lambda i: random_recommendations(
+            data, 'album', pick(w['genres'], i), 10, index=index),
+        'random_recommendations artist': lambda i: random_recommendations(data, 'artist', None, 10, index=index),
+        'random_recommendations playlist': lambda i: random_recommendations(
+            data, 'playlist', pick(w['genres'], i), 3, index=index),
+        'search_songs': lambda i: search_songs(data, pick(w['queries'], i), index=index),
+        'get_song_analysis': lambda i: get_song_analysis(data, pick(w['track_ids'], i), index=index),
+        'find_obscure_songs': lambda i: find_obscure_songs(data, pick(w['genres'], i), 30, 5),
+        'find_similar_songs': lambda i: find_similar_songs(data, pick(w['track_ids'], i), 10, index=index),
+        'find_similar_songs_batch 20': lambda i: find_similar_songs_batch(
+            data, [(pick(w['track_ids'], i + j), 10) for j in range(20)], index=index)
+    }
+
+
+def endpoint_cases(w):
+    # name -> function of i giving (method, path, form, json body)
+    return {
+        'GET /api/random song': lambda i: ('GET', '/api/random?item_type=song&count=10', None, None),
+        'GET /api/random playlist': lambda i: (
+            'GET', f'/api/random?item_type=playlist&count=3&genre={pick(w["genres"], i)}', None, None),
+        'GET /api/search': lambda i: (
+            'GET', '/api/search?' + urllib.parse.urlencode({'query': pick(w['queries'], i)}), None, None),
+        'GET /api/analyse': lambda i: ('GET', f'/api/analyse?track_id={pick(w["track_ids"], i)}', None, None),
+        'GET /api/obscure': lambda i: ('GET', f'/api/obscure?genre={pick(w["genres"], i)}', None, None),
+        'GET /api/similar': lambda i: ('GET', f'/api/similar?track_id={pick(w["track_ids"], i)}&count=10', None, None),
+        'GET /api/genres': lambda i: ('GET', '/api/genres', None, None),
+        'GET /api/activity-recommend song': lambda i: (
+            'GET', f'/api/activity-recommend?activity={pick(w["activities"], i)}&count=10', None, None),
+        'GET /api/activity-recommend playlist': lambda i: (
+            'GET', f'/api/activity-recommend?activity={pick(w["activities"], i)}&item_type=playlist&count=5',
+            None, None),
+        'POST /api/mood-recommend song': lambda i: (
+            'POST', '/api/mood-recommend', {'mood_text': pick(w['moods'], i), 'count': '10'}, None),
+        'POST /api/mood-recommend playlist': lambda i: (
+            'POST', '/api/mood-recommend', {'mood_text': pick(w['moods'], i), 'item_type': 'playlist', 'count': '5'},
+            None),
+        'POST /api/similar/batch 20': lambda i: (
+            'POST', '/api/similar/batch', None, [{'track_id': pick(w['track_ids'], i + j)} for j in range(20)]),
+        'GET /api/catalogue-status': lambda i: ('GET', '/api/catalogue-status', None, None)
+    }
+
+
+class TestClientRequests:
+    # requests through Flask's test client, one client per thread
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def __call__(self, method, path, form=None, body=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.open(path, method=method, data=form, json=body)
+        response.get_data()
+        return response.status_code < 500
+
+    def close(self):
+        pass
+
+
+class ServerRequests:
+    # requests over HTTP to a local threaded WSGI server running the app
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        # the per-request access log would be part of every timing
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.base = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def __call__(self, method, path, form=None, body=None):
+        data, headers = None, {}
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+        elif body is not None:
+            data, headers = json.dumps(body).encode(), {'Content-Type': 'application/json'}
+        try:
+            with urllib.request.urlopen(urllib.request.Request(self.base + path, data, headers, method=method)) as r:
+                r.read()
+                return True
+        except urllib.error.HTTPError as e:
+            return e.code < 500
+
+    def close(self):
+        self.server.shutdown()
+
+
+def load_app(cache):
+    # flask_app loads its own catalogue at import, the synthetic one is swapped in afterwards
+    if not cache:
+        os.environ['MELODEX_CACHE_SIZE'] = '0'
+    os.environ.setdefault('MELODEX_RELOAD_INTERVAL', '0')
+    os.environ.setdefault('MELODEX_DATASET_PATH', os.devnull)
+    import flask_app
+    return flask_app
+
+
+def run_size(rows, args):
+    print(f'\n{rows} rows', file=sys.stderr)
+    data = make_catalogue(rows)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = CatalogueIndex(data)
+    result = {
+        'rows': len(data),
+        'index_build_seconds': time.perf_counter() - start,
+        'index_alloc_mb': tracemalloc.get_traced_memory()[1] / 2 ** 20
+    }
+    tracemalloc.stop()
+    w = workload(data, index)
+
+    if args.only in (None, 'recommenders'):
+        result['recommenders'] = {}
+        for name, call in recommender_cases(data, index, w).items():
+            result['recommenders'][name] = stats = measure(call, args.iterations)
+            print(f'  {name:<38} p50 {stats["p50_ms"]:8.2f} ms  p99 {stats["p99_ms"]:8.2f} ms', file=sys.stderr)
+
+    if args.only in (None, 'endpoints'):
+        flask_app = load_app(args.cache)
+        flask_app.catalogue_manager.install(flask_app.Catalogue(data, f'synthetic-{rows}', index=index))
+        in_process = TestClientRequests(flask_app.app)
+        send = ServerRequests(flask_app.app) if args.server else in_process
+
+        result['endpoints'] = {}
+        for name, request in endpoint_cases(w).items():
+            stats = measure(lambda i: send(*request(i)), args.iterations, args.concurrency, trace=not args.server)
+            result['endpoints'][name] = stats
+            print(f'  {name:<38} p50 {stats["p50_ms"]:8.2f} ms  p99 {stats["p99_ms"]:8.2f} ms  '
+                  f'{stats["throughput_per_s"]:8.1f} req/s', file=sys.stderr)
+        send.close()
+
+        # over HTTP the allocations would mostly be the client's and the server thread's,
+        # so they are traced through the test client once the server is stopped
+        if args.server:
+            for name, request in endpoint_cases(w).items():
+                result['endpoints'][name]['peak_alloc_mb'] = peak_allocation(lambda i: in_process(*request(i)))
+
+    # ru_maxrss is in KB on Linux
+    result['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+
+def print_table(results):
+    for result in results:
+        print(f'\n{result["rows"]} rows (index built in {result["index_build_seconds"]:.2f} s, '
+              f'{result["index_alloc_mb"]:.0f} MB allocated, max RSS {result["max_rss_mb"]:.0f} MB)')
+        for section in ('recommenders', 'endpoints'):
+            if section not in result:
+                continue
+            print(f'{section:<40} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"calls/s":>9} {"peak MB":>9} {"errors":>7}')
+            for name, stats in result[section].items():
+                print(f'{name:<40} {stats["p50_ms"]:9.2f} {stats["p95_ms"]:9.2f} {stats["p99_ms"]:9.2f} '
+                      f'{stats["throughput_per_s"]:9.1f} {stats["peak_alloc_mb"]:9.2f} {stats["errors"]:7d}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the recommenders and load test the /api endpoints.')
+    parser.add_argument('--rows', default='10000,100000', help='comma separated catalogue sizes (up to 1M)')
+    parser.add_argument('--iterations', type=int, default=200, help='calls per function or endpoint')
+    parser.add_argument('--concurrency', type=int, default=1, help='threads sending requests in the load test')
+    parser.add_argument('--server', action='store_true', help='load test over HTTP instead of the test client')
+    parser.add_argument('--cache', action='store_true', help='leave the response cache on')
+    parser.add_argument('--only', choices=['recommenders', 'endpoints'])
+    parser.add_argument('--json', help='write the results as JSON to this file (- for stdout)')
+    args = parser.parse_args()
+
+    results = [run_size(int(rows), args) for rows in args.rows.split(',')]
+
+    if args.json:
+        report = {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'settings': vars(args),
+            'results': results
+        }
+        if args.json == '-':
+            json.dump(report, sys.stdout, indent=2)
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+    else:
+        print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+GENRES = ['acoustic', 'alt-rock', 'ambient', 'blues', 'chill', 'classical', 'country', 'dance',
+          'edm', 'folk', 'hip-hop', 'indie', 'jazz', 'metal', 'pop', 'r-n-b', 'rock', 'soul']
+
+
+def make_catalogue(rows=100000, seed=0):
+    """
+    Build a synthetic catalogue with the same columns and value ranges as songs_dataset.csv,
+    deduplicated the same way flask_app does after loading.
+    """
+    rng = np.random.default_rng(seed)
+    artist_count = max(1, rows // 8)
+    album_count = max(1, rows // 5)
+    words = np.array(['love', 'night', 'heart', 'fire', 'dream', 'rain', 'summer', 'blue', 'home', 'light'])
+
+    data = pd.DataFrame({
+        'track_id': [f'{i:022x}' for i in range(rows)],
+        'artists': [f'Artist {i}' for i in rng.integers(0, artist_count, rows)],
+        'album_name': [f'Album {i}' for i in rng.integers(0, album_count, rows)],
+        'track_name': [f'{a.capitalize()} {b} {i}' for a, b, i in zip(rng.choice(words, rows), rng.choice(words, rows), range(rows))],
+        'popularity': rng.integers(0, 100, rows),
+        'duration_ms': rng.integers(90000, 360000, rows),
+        'explicit': rng.random(rows) < 0.1,
+        'danceability': rng.random(rows).round(3),
+        'energy': rng.random(rows).round(3),
+        'key': rng.integers(0, 12, rows),
+        'loudness': (-rng.random(rows) * 30).round(3),
+        'mode': rng.integers(0, 2, rows),
+        'speechiness': (rng.random(rows) ** 3).round(4),
+        'acousticness': rng.random(rows).round(4),
+        'instrumentalness': (rng.random(rows) ** 2).round(4),
+        'liveness': rng.random(rows).round(4),
+        'valence': rng.random(rows).round(3),
+        'tempo': (60 + rng.random(rows) * 140).round(3),
+        'time_signature': rng.choice([3, 4, 5], rows, p=[0.1, 0.85, 0.05]),
+        'track_genre': rng.choice(GENRES, rows)
+    })
+
+    return data.drop_duplicates(subset=['track_name', 'artists'])
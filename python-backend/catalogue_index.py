@@ -0,0 +1,898 @@
+import copy
+import itertools
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from ann_index import AnnIndex
+from playlist_engine import PlaylistEngine
+
+# audio features compared by find_similar_songs, in the order their distance terms are summed
+SIMILARITY_FEATURES = ['danceability', 'energy', 'key', 'loudness', 'speechiness',
+                       'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo']
+
+# Weights are defined for finding similar songs,
+# a value is assigned between 0 and 1,
+# the higher the value the more the importance of that attribute and vice versa
+SIMILARITY_WEIGHTS = {
+    'danceability': 1.0,
+    'energy': 1.0,
+    'key': 0.5,  # Less weight for key since it has less impact than other features
+    'loudness': 0.8,
+    'speechiness': 0.8,
+    'acousticness': 1.0,
+    'instrumentalness': 0.9,
+    'liveness': 0.6,  # same as key, less impact
+    'valence': 1.0,
+    'tempo': 0.7
+}
+
+# features that are not already on a 0-1 scale are divided by their maximum difference
+# key is 0-11, loudness is usually between -60 and 0, 150 is a reasonable maximum for tempo
+SIMILARITY_SCALES = {
+    'key': 11,
+    'loudness': 60,
+    'tempo': 150
+}
+
+
+# mood-specific feature ranges used by recommend_by_mood
+MOOD_FEATURES = {
+    'angry': {
+        'valence': (0.0, 0.3),
+        'energy': (0.7, 1.0),
+        'loudness': (-10, 0),
+        'tempo': (120, 200),
+        'speechiness': (0.3, 1.0),
+        'acousticness': (0.0, 0.4)
+    },
+    'frightened': {
+        'valence': (0.2, 0.5),
+        'energy': (0.4, 0.6),
+        'instrumentalness': (0.3, 0.7),
+        'acousticness': (0.5, 0.8),
+        'tempo': (70, 110),
+    },
+    'happy': {
+        'valence': (0.7, 1.0),
+        'energy': (0.6, 0.9),
+        'danceability': (0.7, 1.0),
+        'tempo': (110, 160),
+        'loudness': (-8, 0),
+        'mode': (1, 1),
+        'speechiness': (0.0, 0.3)
+    },
+    'sad': {
+        'valence': (0.3, 0.5),
+        'energy': (0.3, 0.5),
+        'acousticness': (0.5, 0.9),
+        'tempo': (60, 100),
+        'instrumentalness': (0.2, 0.5)
+    },
+    'chill': {
+        'valence': (0.4, 0.7),
+        'energy': (0.2, 0.5),
+        'acousticness': (0.6, 1.0),
+        'tempo': (60, 100),
+        'instrumentalness': (0.3, 0.8),
+        'danceability': (0.3, 0.6),
+        'loudness': (-20, -7)
+    },
+}
+
+# activity-specific feature ranges used by recommend_by_activity
+ACTIVITY_FILTERS = {
+    'workout': {
+        'energy': (0.7, 1.0),
+        'tempo': (120, 200),
+        'danceability': (0.6, 1.0)
+    },
+    'studying': {
+        'instrumentalness': (0.5, 1.0),
+        'energy': (0.0, 0.5),
+        'acousticness': (0.4, 1.0)
+    },
+    'relaxing': {
+        'energy': (0.0, 0.4),
+        'valence': (0.3, 0.7),
+        'acousticness': (0.5, 1.0),
+        'instrumentalness': (0.3, 1.0)
+    },
+    'party': {
+        'danceability': (0.7, 1.0),
+        'energy': (0.7, 1.0),
+        'valence': (0.6, 1.0)
+    },
+    'commuting': {
+        'energy': (0.4, 0.8),
+        'danceability': (0.4, 0.7),
+        'instrumentalness': (0.2, 0.6)
+    },
+    'meditation': {
+        'energy': (0.0, 0.3),
+        'instrumentalness': (0.6, 1.0),
+        'acousticness': (0.6, 1.0),
+        'valence': (0.3, 0.7)
+    },
+    'cooking': {
+        'danceability': (0.5, 0.9),
+        'energy': (0.4, 0.7),
+        'valence': (0.5, 0.9)
+    }
+}
+
+# most entries in one distance matrix of a batched similarity query (8MB of float64)
+BATCH_CELLS = 1 << 20
+
+# popularity cut-offs used by the mood recommendations (normal selection and broader fallback)
+POPULARITY_TIERS = (30, 40)
+
+# in the scoring mode of the moods tracks at or below the first popularity tier are pushed down the
+# ranking by this much per popularity point they are short, instead of being filtered out
+POPULARITY_PENALTY = 0.01
+
+# default temperature for the scoring mode. tracks are sampled with a probability proportional to
+# exp(-distance / temperature), so tracks inside every range are equally likely and tracks further
+# outside them quickly become rare. 0 always gives the closest tracks
+SCORE_TEMPERATURE = 0.01
+SCORE_CUTOFF = 20
+
+# tracks updated since the search index was last built, as a share of the catalogue, above
+# which the next update builds it again instead of adding to its DeltaSearchIndex
+SEARCH_DELTA_LIMIT = 0.1
+
+
+class SimilarityIndex:
+    """
+    Audio feature matrix for find_similar_songs, with the rows grouped by track_genre
+    so that each genre is one contiguous slice.
+    """
+
+    def __init__(self, data):
+        self.missing_columns = [col for col in SIMILARITY_FEATURES + ['track_genre'] if col not in data.columns]
+        if self.missing_columns:
+            return
+
+        # group the row positions by genre, keeping file order within each genre
+        # (rows without a genre get the code -1 and are left out of every slice)
+        codes, genres, order, self.genre_slices = _group_positions(data['track_genre'])
+
+        # positions[i] is the row in data for column i of the matrix
+        self.positions = order
+        self.columns = np.full(len(data), -1, dtype=np.int64)
+        self.columns[order] = np.arange(len(order))
+        self.track_ids = data['track_id'].to_numpy(dtype=object)[order]
+        self.genres = genres
+        self.column_genres = codes[order]
+
+        # one row per feature so each genre slice of a feature is contiguous,
+        # kept as float64 so the scores match the pandas computation exactly
+        self.features = np.ascontiguousarray(data[SIMILARITY_FEATURES].to_numpy(dtype=np.float64)[order].T)
+
+        # multiplier for each feature that turns the distance into a plain sum of absolute differences
+        self.feature_weights = np.array([SIMILARITY_WEIGHTS[feature] / SIMILARITY_SCALES.get(feature, 1)
+                                         for feature in SIMILARITY_FEATURES])
+
+    def upsert(self, data, rows):
+        """
+        The index of data, where the tracks at `rows` were updated or added since this one was built
+        (see CatalogueIndex.upsert). Their columns are taken out and put back in their genre's slice,
+        the rest of the matrix is only moved along. Genres seen for the first time are put at the end.
+        """
+        if self.missing_columns:
+            return self
+        updated = copy.copy(self)
+        length = len(data)
+
+        # genre code of each updated track, -1 for no genre
+        genres = list(self.genres)
+        genre_codes = {genre: code for code, genre in enumerate(genres)}
+        codes = np.empty(len(rows), dtype=np.int64)
+        for i, genre in enumerate(data['track_genre'].to_numpy(dtype=object)[rows]):
+            if pd.isna(genre):
+                codes[i] = -1
+                continue
+            if genre not in genre_codes:
+                genre_codes[genre] = len(genres)
+                genres.append(genre)
+            codes[i] = genre_codes[genre]
+
+        # columns are ordered by (genre code, row position), so the kept columns are still in order
+        # and the updated ones are merged in by that same key
+        kept = np.ones(len(self.positions), dtype=bool)
+        old_columns = self.columns[rows[rows < len(self.columns)]]
+        kept[old_columns[old_columns >= 0]] = False
+        kept = np.flatnonzero(kept)
+        kept_keys = self.column_genres[kept].astype(np.int64) * length + self.positions[kept]
+
+        inserted = rows[codes >= 0]
+        inserted_keys = codes[codes >= 0] * length + inserted
+        by_key = np.argsort(inserted_keys, kind='stable')
+        inserted, inserted_keys = inserted[by_key], inserted_keys[by_key]
+
+        kept_to = np.arange(len(kept)) + np.searchsorted(inserted_keys, kept_keys)
+        inserted_to = np.arange(len(inserted)) + np.searchsorted(kept_keys, inserted_keys)
+        size = len(kept) + len(inserted)
+
+        updated.positions = np.empty(size, dtype=np.int64)
+        updated.positions[kept_to] = self.positions[kept]
+        updated.positions[inserted_to] = inserted
+        updated.column_genres = np.empty(size, dtype=np.int64)
+        updated.column_genres[kept_to] = self.column_genres[kept]
+        updated.column_genres[inserted_to] = inserted_keys // length
+        updated.track_ids = np.empty(size, dtype=object)
+        updated.track_ids[kept_to] = self.track_ids[kept]
+        updated.track_ids[inserted_to] = data['track_id'].to_numpy(dtype=object)[inserted]
+        updated.features = np.empty((len(SIMILARITY_FEATURES), size), dtype=np.float64)
+        updated.features[:, kept_to] = self.features[:, kept]
+        updated.features[:, inserted_to] = data[SIMILARITY_FEATURES].iloc[inserted].to_numpy(dtype=np.float64).T
+
+        updated.columns = np.full(length, -1, dtype=np.int64)
+        updated.columns[updated.positions] = np.arange(size)
+        updated.genres = np.array(genres, dtype=object)
+        counts = np.bincount(updated.column_genres, minlength=len(genres))
+        ends = np.cumsum(counts)
+        updated.genre_slices = {genre: (int(end - count), int(end))
+                                for genre, count, end in zip(genres, counts, ends) if count}
+        return updated
+
+    def genre_size(self, genre):
+        start, stop = self.genre_slices.get(genre, (0, 0))
+        return stop - start
+
+    def nearest_in_genre(self, position, count, exclude_track_id=None):
+        """
+        Return the row positions and similarity scores of the `count` tracks closest to the
+        track at `position` within its genre, highest similarity first.
+        """
+        column = self.columns[position]
+        genre_start, genre_stop = self.genre_slices[self.genres[self.column_genres[column]]]
+        scores = self._scores(genre_start, genre_stop, [column])[0]
+        return self._nearest(scores, slice(genre_start, genre_stop), count, exclude_track_id)
+
+    def nearest_global(self, position, count, exclude_track_id=None):
+        # nearest_in_genre over every genre, an exact scan of the whole catalogue
+        scores = self._scores(0, len(self.positions), [self.columns[position]])[0]
+        return self._nearest(scores, slice(0, len(self.positions)), count, exclude_track_id)
+
+    def nearest_among(self, position, candidates, count, exclude_track_id=None):
+        # nearest_in_genre over just the candidate columns (e.g. picked by an AnnIndex)
+        scores = self._score_block(self.features[:, candidates], self.features[:, [self.columns[position]]])[0]
+        return self._nearest(scores, candidates, count, exclude_track_id)
+
+    def scores_of(self, position, positions):
+        # similarity scores of the tracks at positions to the track at position
+        reference = self.features[:, [self.columns[position]]]
+        return self._score_block(self.features[:, self.columns[positions]], reference)[0]
+
+    def nearest_in_genre_batch(self, positions, counts, exclude_track_ids=None):
+        """
+        nearest_in_genre for many tracks at once, as a list of (positions, scores) in the same order.
+        Tracks from the same genre are compared against it together, as one (tracks x genre size)
+        distance matrix computed in chunks of at most BATCH_CELLS entries.
+        """
+        exclude_track_ids = exclude_track_ids or [None] * len(positions)
+        columns = self.columns[np.asarray(positions, dtype=np.int64)]
+        column_genres = self.column_genres[columns]
+        results = [None] * len(positions)
+
+        for genre_code in np.unique(column_genres):
+            queries = np.flatnonzero(column_genres == genre_code)
+            genre_start, genre_stop = self.genre_slices[self.genres[genre_code]]
+            step = max(1, BATCH_CELLS // (genre_stop - genre_start))
+
+            for chunk in range(0, len(queries), step):
+                batch = queries[chunk:chunk + step]
+                scores = self._scores(genre_start, genre_stop, columns[batch])
+                for row, query in enumerate(batch):
+                    results[query] = self._nearest(scores[row], slice(genre_start, genre_stop), counts[query],
+                                                   exclude_track_ids[query])
+        return results
+
+    def _scores(self, genre_start, genre_stop, columns):
+        # similarity of each of the reference columns to every track in the genre, one row per reference
+        return self._score_block(self.features[:, genre_start:genre_stop], self.features[:, columns])
+
+    def _score_block(self, block, reference):
+        # weighted distance, summed feature by feature in the same order as before
+        distance = None
+        for i, feature in enumerate(SIMILARITY_FEATURES):
+            diff = np.abs(block[i] - reference[i][:, np.newaxis])
+            if feature in SIMILARITY_SCALES:
+                diff = diff / SIMILARITY_SCALES[feature]
+            term = SIMILARITY_WEIGHTS[feature] * diff
+            distance = term if distance is None else distance + term
+
+        # convert to similarity (lower distance = higher similarity)
+        return 1 / (1 + distance)
+
+    def _nearest(self, scores, columns, count, exclude_track_id):
+        # top `count` of the scores of `columns` (a slice or array of matrix columns).
+        # the excluded track_id is dropped from a slightly longer top list rather than compared
+        # against the whole genre, the list only has to grow if the id appears more than once
+        extra = 1
+        while True:
+            top = _top_k(scores, count + extra)
+            if exclude_track_id is not None:
+                top = top[self.track_ids[_pick(columns, top)] != exclude_track_id]
+            if len(top) >= count or count + extra >= len(scores):
+                break
+            extra *= 2
+
+        top = top[:count]
+        return self.positions[_pick(columns, top)], scores[top]
+
+
+class TrackLookup:
+    """
+    Hash index from track_id to row position, plus every catalogue column as a plain array
+    so a single track can be read without going through the DataFrame.
+    """
+
+    def __init__(self, data):
+        # first occurrence wins, the same row a boolean filter followed by iloc[0] would give
+        self.positions = {}
+        for position, track_id in enumerate(data['track_id'].to_numpy(dtype=object)):
+            self.positions.setdefault(track_id, position)
+
+        self.columns = {col: data[col].to_numpy() for col in data.columns}
+
+    def upsert(self, data, changed, added):
+        # the lookup for data, where the tracks at `changed` were replaced and the ones at `added` appended
+        updated = copy.copy(self)
+        updated.positions = dict(self.positions)
+        track_ids = data['track_id'].to_numpy(dtype=object)
+
+        # a replaced track that had its track_id changed no longer holds the old one
+        for position, old_id in zip(changed, self.columns['track_id'][changed]):
+            if old_id != track_ids[position] and updated.positions.get(old_id) == position:
+                others = np.flatnonzero(track_ids == old_id)
+                if len(others):
+                    updated.positions[old_id] = int(others[0])
+                else:
+                    del updated.positions[old_id]
+
+        for position in np.union1d(changed, added).tolist():
+            if updated.positions.get(track_ids[position], position) >= position:
+                updated.positions[track_ids[position]] = position
+
+        updated.columns = {col: data[col].to_numpy() for col in data.columns}
+        return updated
+
+    def position(self, track_id):
+        return self.positions.get(track_id)
+
+    def record(self, position):
+        # compact stand-in for data.iloc[position], supports the same .get() and [] access
+        return {col: values[position] for col, values in self.columns.items()}
+
+
+class SearchIndex:
+    """
+    Bigram/trigram index over the lowercased track and artist names for search_songs.
+
+    Every row gets a rank by popularity (most popular first) and all the lookup tables are
+    stored in rank order, so walking any of them front to back already gives the results
+    best first and the search can stop as soon as it has enough.
+    """
+
+    def __init__(self, data, rows=None):
+        # with rows, only those row positions of data are indexed (see DeltaSearchIndex)
+        if rows is not None:
+            data = data.iloc[rows]
+        popularity = data['popularity'].fillna(0).to_numpy() if 'popularity' in data.columns else np.zeros(len(data))
+        self.order = np.argsort(-popularity, kind='stable')
+
+        self.names = [_normalise(name) for name in data['track_name'].to_numpy(dtype=object)[self.order]]
+        self.artists = [_normalise(artist) for artist in data['artists'].to_numpy(dtype=object)[self.order]]
+        if rows is not None:
+            self.order = np.asarray(rows, dtype=np.int64)[self.order]
+
+        # exact matches: normalised name -> ranks
+        self.exact = defaultdict(list)
+        # substring matches: bigram or trigram -> ranks, ascending because rows are added in rank order
+        postings = defaultdict(list)
+        for rank, (name, artist) in enumerate(zip(self.names, self.artists)):
+            self.exact[name].append(rank)
+            if artist != name:
+                self.exact[artist].append(rank)
+            for gram in _ngrams(name) | _ngrams(artist):
+                postings[gram].append(rank)
+        self.postings = {gram: np.array(ranks, dtype=np.int32) for gram, ranks in postings.items()}
+
+        # prefix matches: each field sorted alphabetically, so a prefix is one contiguous range
+        self.sorted_fields = []
+        for field in (self.names, self.artists):
+            field = np.array(field, dtype=object)
+            alphabetical = np.argsort(field, kind='stable')
+            self.sorted_fields.append((field[alphabetical], alphabetical))
+
+    def upsert(self, data, changed, added):
+        # the index of data after the tracks at `changed` were replaced and the ones at `added` appended
+        return _search_delta(self, data, np.union1d(changed, added))
+
+    def search(self, query, limit=10):
+        """
+        Return the row positions of up to `limit` tracks whose name or artist contains `query`
+        as plain text, exact matches first, then prefix matches, then other substring matches,
+        each group ordered by popularity.
+        """
+        return _search([(self, None)], query, limit)
+
+    def exact_matches(self, query, hidden=None):
+        # row positions whose name or artist is the query, best first, leaving out the hidden ones
+        positions = self.order[sorted(self.exact.get(query, []))].tolist()
+        return positions if hidden is None else [position for position in positions if not hidden[position]]
+
+    def prefix_matches(self, query, needed, hidden=None):
+        # row positions whose name or artist starts with the query, best first. only the
+        # best `needed` of each field can make it into the results
+        prefix_ranks = []
+        for field, alphabetical in self.sorted_fields:
+            start = np.searchsorted(field, query, side='left')
+            stop = np.searchsorted(field, query + chr(0x10FFFF), side='left')
+            ranks = alphabetical[start:stop]
+            if hidden is not None:
+                ranks = ranks[~hidden[self.order[ranks]]]
+            if len(ranks) > needed:
+                ranks = np.partition(ranks, needed - 1)[:needed]
+            prefix_ranks.append(ranks)
+        return self.order[np.unique(np.concatenate(prefix_ranks))].tolist()
+
+    def substring_matches(self, query, hidden=None):
+        # row positions whose name or artist contains the query, best first, found as they are taken
+        for rank in self._substring_candidates(query):
+            if query in self.names[rank] or query in self.artists[rank]:
+                position = self.order[rank]
+                if hidden is None or not hidden[position]:
+                    yield position
+
+    def _substring_candidates(self, query):
+        # ranks that contain the query's rarest n-gram (a superset of the real matches), in rank
+        # order so the caller can stop checking once it has enough. Queries too short to have
+        # an n-gram fall back to checking every rank
+        grams = _trigrams(query) or _bigrams(query)
+        if not grams:
+            return range(len(self.names))
+
+        postings = [self.postings.get(gram) for gram in grams]
+        if any(ranks is None for ranks in postings):
+            return []
+        return min(postings, key=len)
+
+
+class DeltaSearchIndex:
+    """
+    SearchIndex of a catalogue that had tracks added or updated, without indexing it all again:
+    the index from before the updates with the updated tracks hidden, plus a small SearchIndex of
+    just those tracks. Gives the same results as a SearchIndex of the whole catalogue.
+    """
+
+    def __init__(self, base, data, rows):
+        self.base = base
+        self.rows = rows
+        self.delta = SearchIndex(data, rows)
+        self.hidden = np.zeros(len(base.order), dtype=bool)
+        self.hidden[rows[rows < len(base.order)]] = True
+        self.popularity = data['popularity'].fillna(0).to_numpy() if 'popularity' in data.columns else None
+
+    def upsert(self, data, changed, added):
+        return _search_delta(self.base, data, np.union1d(self.rows, np.union1d(changed, added)))
+
+    def search(self, query, limit=10):
+        return _search([(self.base, self.hidden), (self.delta, None)], query, limit, self.popularity)
+
+
+class FeatureMasks:
+    """
+    Boolean row masks for every mood, activity and popularity tier, and the sorted row
+    positions of every genre, so the recommenders only have to combine them per request.
+    """
+
+    def __init__(self, data):
+        self.popular, self.moods, self.activities = self._masks(data)
+
+        self.genres = {}
+        if 'track_genre' in data.columns:
+            _, _, order, slices = _group_positions(data['track_genre'])
+            self.genres = {genre: order[start:stop] for genre, (start, stop) in slices.items()}
+
+    def upsert(self, data, changed, added, previous_genres):
+        """
+        The masks of data, where the tracks at `changed` were replaced (they used to be in previous_genres)
+        and the ones at `added` appended. Only the updated tracks are checked against the ranges.
+        """
+        updated = copy.copy(self)
+        rows = np.union1d(changed, added)
+        popular, moods, activities = self._masks(data.iloc[rows])
+        updated.popular = {tier: _updated(mask, rows, popular[tier]) for tier, mask in self.popular.items()}
+        updated.moods = {mood: _updated(mask, rows, moods[mood]) for mood, mask in self.moods.items()}
+        updated.activities = {activity: _updated(mask, rows, activities[activity])
+                              for activity, mask in self.activities.items()}
+
+        if 'track_genre' in data.columns:
+            updated.genres = dict(self.genres)
+            genres = data['track_genre'].to_numpy(dtype=object)[rows]
+            for genre in {genre for genre in list(previous_genres) + list(genres) if not pd.isna(genre)}:
+                genre_rows = self.genre_rows(genre)
+                genre_rows = np.union1d(genre_rows[~np.isin(genre_rows, changed)], rows[genres == genre])
+                if len(genre_rows):
+                    updated.genres[genre] = genre_rows
+                else:
+                    del updated.genres[genre]
+        return updated
+
+    @staticmethod
+    def _masks(data):
+        popular = {}
+        if 'popularity' in data.columns:
+            popularity = data['popularity'].to_numpy()
+            popular = {tier: popularity > tier for tier in POPULARITY_TIERS}
+
+        # features missing from the dataset are skipped, like the per-request filters did
+        moods = {mood: _range_mask(data, features) for mood, features in MOOD_FEATURES.items()}
+
+        # only the first three filters of an activity have ever been applied to the song selection
+        activities = {}
+        if all(col in data.columns for filters in ACTIVITY_FILTERS.values() for col in filters):
+            activities = {activity: _range_mask(data, dict(list(filters.items())[:3]))
+                          for activity, filters in ACTIVITY_FILTERS.items()}
+        return popular, moods, activities
+
+    def genre_rows(self, genre):
+        return self.genres.get(genre, np.empty(0, dtype=np.int64))
+
+
+class RangeScorer:
+    """
+    The audio features used by the mood and activity ranges, scaled like the similarity features,
+    for ranking tracks by how far outside a set of ranges they fall rather than filtering on them.
+    """
+
+    def __init__(self, data):
+        self.rows = len(data)
+        scored = {feature for ranges in list(MOOD_FEATURES.values()) + list(ACTIVITY_FILTERS.values())
+                  for feature in ranges}
+        self.features = {
+            feature: data[feature].to_numpy(dtype=np.float32) / SIMILARITY_SCALES.get(feature, 1)
+            for feature in sorted(scored) if feature in data.columns
+        }
+
+        self.popularity_penalty = np.zeros(len(data), dtype=np.float32)
+        if 'popularity' in data.columns:
+            shortfall = POPULARITY_TIERS[0] + 1 - data['popularity'].to_numpy(dtype=np.float32)
+            self.popularity_penalty = np.maximum(shortfall, 0) * POPULARITY_PENALTY
+
+    def upsert(self, data, rows):
+        # the scorer of data, where the tracks at rows were updated or added since this one was built
+        updated = copy.copy(self)
+        part = RangeScorer(data.iloc[rows])
+        updated.rows = len(data)
+        updated.features = {feature: _updated(values, rows, part.features[feature])
+                            for feature, values in self.features.items()}
+        updated.popularity_penalty = _updated(self.popularity_penalty, rows, part.popularity_penalty)
+        return updated
+
+    def distances(self, ranges, rows=None, popular=False):
+        # weighted distance of each track (or each of rows) to the ranges, 0 if it is inside all of them.
+        # features missing from the dataset are skipped, tracks with a missing value are ranked last.
+        # popular adds the popularity penalty, for the moods which otherwise only take popular tracks
+        distance = np.zeros(self.rows if rows is None else len(rows), dtype=np.float32)
+        if popular:
+            distance = self.popularity_penalty if rows is None else self.popularity_penalty[rows]
+        for feature, (low, high) in ranges.items():
+            if feature not in self.features:
+                continue
+            values = self.features[feature] if rows is None else self.features[feature][rows]
+            scale = SIMILARITY_SCALES.get(feature, 1)
+            outside = np.maximum(low / scale - values, 0) + np.maximum(values - high / scale, 0)
+            distance = distance + SIMILARITY_WEIGHTS.get(feature, 1.0) * outside
+        return np.where(np.isnan(distance), np.inf, distance)
+
+    def rank(self, ranges, count, rows=None, temperature=SCORE_TEMPERATURE, popular=False):
+        """
+        Row positions of `count` tracks (out of all of them or of rows) closest to the ranges, best first.
+        With a temperature they are sampled without replacement with probability proportional to
+        exp(-distance / temperature) (Gumbel top-k), without it ties are broken at random.
+        popular pushes unpopular tracks down, see distances.
+        """
+        distance = self.distances(ranges, rows, popular)
+        candidates = np.arange(self.rows) if rows is None else np.asarray(rows)
+        count = min(count, len(candidates))
+        if count <= 0:
+            return candidates[:0]
+
+        # a temperature that isn't above 0 (or is nan) ranks by distance alone, sampling with it would
+        # put the cutoff below every track
+        if not temperature > 0:
+            return candidates[_top_k(-distance + np.random.random(len(distance)) * 1e-9, count)]
+
+        # tracks more than SCORE_CUTOFF temperatures further away than the count-th closest one
+        # would practically never be drawn, so only the ones nearer than that are sampled from
+        cutoff = np.partition(distance, count - 1)[count - 1] + SCORE_CUTOFF * temperature
+        near = np.flatnonzero(distance <= cutoff)
+        keys = -distance[near] / temperature + np.random.gumbel(size=len(near))
+        return candidates[near[_top_k(keys, count)]]
+
+
+class GroupSummaries:
+    """
+    Album and artist summaries for random_recommendations, for the whole catalogue (under the
+    key None) and for each genre on its own.
+    """
+
+    def __init__(self, data, genre_rows=None):
+        self.albums = {None: summarise_albums(data)}
+        self.artists = {None: summarise_artists(data)}
+
+        for genre, rows in (genre_rows or {}).items():
+            genre_data = data.iloc[rows]
+            self.albums[genre] = summarise_albums(genre_data)
+            self.artists[genre] = summarise_artists(genre_data)
+
+    def upsert(self, data, genre_rows, genres, albums, artists):
+        """
+        The summaries of data, after tracks in `genres`, `albums` and `artists` (the values the
+        updated tracks had before and after) were updated or added. Only those genres are looked
+        at and only those albums and artists are summarised again.
+        """
+        updated = copy.copy(self)
+        updated.albums = dict(self.albums)
+        updated.artists = dict(self.artists)
+        updated.albums[None] = _upsert_summary(self.albums[None], data, 'album_name', summarise_albums, albums)
+        updated.artists[None] = _upsert_summary(self.artists[None], data, 'artists', summarise_artists, artists)
+
+        for genre in genres:
+            if genre in genre_rows:
+                genre_data = data.iloc[genre_rows[genre]]
+                updated.albums[genre] = _upsert_summary(self.albums.get(genre), genre_data, 'album_name',
+                                                        summarise_albums, albums)
+                updated.artists[genre] = _upsert_summary(self.artists.get(genre), genre_data, 'artists',
+                                                         summarise_artists, artists)
+            else:
+                updated.albums.pop(genre, None)
+                updated.artists.pop(genre, None)
+        return updated
+
+
+def summarise_albums(data):
+    # album names in order of first appearance, with the record random_recommendations returns for each
+    names, codes, first_rows = _first_appearances(data['album_name'])
+    artists = data['artists'].to_numpy(dtype=object)[first_rows]
+    tracks = np.bincount(codes, minlength=len(names))
+    genres = _unique_per_group(data['track_genre'], codes, len(names))
+
+    return names, [{
+        'album_name': name,
+        'artist': artist,
+        'tracks': int(count),
+        'genres': album_genres
+    } for name, artist, count, album_genres in zip(names, artists, tracks, genres)]
+
+
+def summarise_artists(data):
+    # artist names in order of first appearance, with the record random_recommendations returns for each
+    names, codes, _ = _first_appearances(data['artists'])
+    tracks = np.bincount(codes, minlength=len(names))
+    albums = _unique_per_group(data['album_name'], codes, len(names))
+    genres = _unique_per_group(data['track_genre'], codes, len(names))
+
+    return names, [{
+        'artist': name,
+        'tracks': int(count),
+        'albums': artist_albums,
+        'genres': artist_genres
+    } for name, count, artist_albums, artist_genres in zip(names, tracks, albums, genres)]
+
+
+class CatalogueIndex:
+    """
+    Lookup structures derived from the catalogue once at load time, so the recommenders
+    don't have to rebuild them on every request.
+    """
+
+    def __init__(self, data):
+        self.tracks = TrackLookup(data)
+        self.similarity = SimilarityIndex(data)
+        # cross-genre similar tracks (scope=global), not available without the audio features
+        self.ann = AnnIndex(self.similarity) if not self.similarity.missing_columns else None
+        self.search = SearchIndex(data)
+        self.masks = FeatureMasks(data)
+        self.groups = GroupSummaries(data, self.masks.genres)
+        self.playlists = PlaylistEngine(data)
+        self.scorer = RangeScorer(data)
+        # (track_name, artists) -> row position, built by the first upsert (see catalogue_store.upsert_tracks)
+        self.track_keys = None
+        # precomputed similar songs, attached by the CatalogueManager when one was built for this catalogue
+        self.similar_table = None
+
+    def upsert(self, data, changed, added, track_keys=None):
+        """
+        The index of data, a copy of the catalogue this index was built from with the tracks at `changed`
+        replaced and the tracks at `added` appended (see catalogue_store.upsert_tracks). Only the updated
+        tracks are indexed, everything else is carried over from this index.
+        """
+        rows = np.union1d(changed, added)
+        # genres, albums and artists of the updated tracks, before (for replaced ones) and after
+        previous_genres = self.tracks.columns['track_genre'][changed]
+        genres = {genre for genre in list(previous_genres) + list(data['track_genre'].to_numpy(dtype=object)[rows])
+                  if not pd.isna(genre)}
+        albums, artists = (set(self.tracks.columns[column][changed]) | set(data[column].to_numpy(dtype=object)[rows])
+                           for column in ('album_name', 'artists'))
+
+        updated = copy.copy(self)
+        updated.tracks = self.tracks.upsert(data, changed, added)
+        updated.similarity = self.similarity.upsert(data, rows)
+        updated.ann = self.ann.upsert(updated.similarity, rows) if self.ann is not None else None
+        updated.search = self.search.upsert(data, changed, added)
+        updated.masks = self.masks.upsert(data, changed, added, previous_genres)
+        updated.groups = self.groups.upsert(data, updated.masks.genres, genres, albums, artists)
+        updated.playlists = self.playlists.upsert(data, rows)
+        updated.scorer = self.scorer.upsert(data, rows)
+        updated.track_keys = track_keys
+        if self.similar_table is not None:
+            updated.similar_table = self.similar_table.upsert(genres)
+        return updated
+
+
+def _pick(columns, indices):
+    # matrix columns at `indices` within `columns`, a slice or an array of columns
+    if isinstance(columns, slice):
+        return indices + columns.start
+    return columns[indices]
+
+
+def _top_k(scores, count):
+    # indices of the `count` highest scores, highest first, ties kept in their original order.
+    # argpartition finds the cut-off score, then only the tracks at or above it are sorted
+    if count <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    # NaN scores are sorted last, like sort_values does
+    keys = np.where(np.isnan(scores), -np.inf, scores)
+    if count < len(keys):
+        threshold = keys[np.argpartition(-keys, count - 1)[count - 1]]
+        candidates = np.flatnonzero(keys >= threshold)
+    else:
+        candidates = np.arange(len(keys))
+
+    ranked = candidates[np.argsort(-keys[candidates], kind='stable')]
+    return ranked[:count]
+
+
+def _search(layers, query, limit, popularity=None):
+    # search_songs over (SearchIndex, hidden row mask) layers. each layer gives its matches best
+    # first, matches from several layers are merged by popularity and then row position, the
+    # order a single SearchIndex of all of them would rank them in
+    query = _normalise(query)
+    if not query:
+        return np.empty(0, dtype=np.int64)
+
+    found = []
+    seen = set()
+
+    def take(positions):
+        for position in positions:
+            if len(found) == limit:
+                break
+            if position not in seen:
+                seen.add(position)
+                found.append(position)
+
+    def merged(matches):
+        if len(matches) == 1:
+            return matches[0]
+        return sorted(itertools.chain(*matches), key=lambda position: (-popularity[position], position))
+
+    take(merged([index.exact_matches(query, hidden) for index, hidden in layers]))
+
+    if len(found) < limit:
+        # only the best `needed` prefix matches can make it into the results
+        needed = limit + len(found)
+        take(merged([index.prefix_matches(query, needed, hidden) for index, hidden in layers]))
+
+    if len(found) < limit:
+        # substring matches are checked as they are taken, each layer needs at most the number still missing
+        wanted = limit - len(found)
+        take(merged([itertools.islice((position for position in index.substring_matches(query, hidden)
+                                       if position not in seen), wanted) for index, hidden in layers]))
+
+    return np.array(found, dtype=np.int64)
+
+
+def _search_delta(base, data, rows):
+    # base with the tracks at rows (updated since base was built) indexed on the side, or a new
+    # SearchIndex once there are too many of them
+    if len(rows) > SEARCH_DELTA_LIMIT * len(data):
+        return SearchIndex(data)
+    return DeltaSearchIndex(base, data, rows)
+
+
+def _group_positions(values):
+    # row positions grouped by value, keeping file order within each group and leaving out
+    # missing values (factorize gives them the code -1). returns the codes, the distinct values,
+    # the grouped positions and the (start, stop) slice of each value within them
+    codes, uniques = pd.factorize(values)
+    order = np.argsort(codes, kind='stable')
+    order = order[codes[order] >= 0]
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    ends = np.cumsum(counts)
+    slices = {value: (int(end - size), int(end)) for value, size, end in zip(uniques, counts, ends)}
+    return codes, uniques, order, slices
+
+
+def _upsert_summary(summary, data, column, summarise, changed_names):
+    # summarise(data) from an older summary of it, where only the groups in changed_names changed.
+    # the names are put in order of first appearance again and only the changed groups summarised
+    if summary is None:
+        return summarise(data)
+    names = _first_appearances(data[column])[0]
+    values = data[column].to_numpy(dtype=object)
+    changed_rows = np.flatnonzero(pd.Index(values).isin(list(changed_names)))
+    records = {_summary_key(name): record for name, record in zip(*summary)}
+    records.update((_summary_key(name), record) for name, record in zip(*summarise(data.iloc[changed_rows])))
+    return names, [records[_summary_key(name)] for name in names]
+
+
+def _summary_key(name):
+    # missing album or artist names are one group, whichever missing value they have
+    return None if pd.isna(name) else name
+
+
+def _first_appearances(values):
+    # distinct values in order of first appearance (like .unique(), so a missing value counts as one),
+    # each row's code into them and the row where each value first appears
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    _, first = np.unique(codes, return_index=True)
+    return np.array(uniques.tolist(), dtype=object), codes, first
+
+
+def _unique_per_group(values, codes, group_count):
+    # for each group code, the list of distinct values in order of first appearance
+    value_codes, distinct_values = pd.factorize(values, use_na_sentinel=False)
+
+    # first row of every (group, value) pair, then those pairs ordered by group and first row
+    pairs = codes.astype(np.int64) * len(distinct_values) + value_codes
+    _, first = np.unique(pairs, return_index=True)
+    first = first[np.lexsort((first, codes[first]))]
+
+    ordered = np.array(distinct_values.tolist(), dtype=object)[value_codes[first]].tolist()
+    ends = np.cumsum(np.bincount(codes[first], minlength=group_count)).tolist()
+    return [ordered[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+
+def _updated(values, rows, row_values):
+    # copy of values with the entries at rows set to row_values, rows past the end are appended
+    # (every new row has to be in rows)
+    length = max(len(values), int(rows.max()) + 1 if len(rows) else 0)
+    updated = np.empty(length, dtype=np.result_type(values, row_values))
+    updated[:len(values)] = values
+    updated[rows] = row_values
+    return updated
+
+
+def _range_mask(data, ranges):
+    # rows where every feature that exists in data is within its (inclusive) range
+    mask = np.ones(len(data), dtype=bool)
+    for feature, (low, high) in ranges.items():
+        if feature in data.columns:
+            mask &= data[feature].between(low, high).to_numpy()
+    return mask
+
+
+def _normalise(text):
+    # search text is compared lowercased, missing names become empty strings
+    return text.lower() if isinstance(text, str) else ''
+
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)}
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _ngrams(text):
+    return _bigrams(text) | _trigrams(text)
@@ -0,0 +1,232 @@
+import copy
+import os
+import threading
+import time
+
+from catalogue_index import CatalogueIndex
+from catalogue_store import (
+    catalogue_version, delta_name, list_deltas, read_delta, save_delta, track_keys, upsert_tracks
+)
+from similar_table import load_similar_table, similar_table_path_for
+
+
+class Catalogue:
+    """
+    One loaded version of the catalogue and the indexes built from it. It is never modified,
+    a request keeps using the Catalogue it started with even if a reload swaps in a newer one.
+    """
+
+    def __init__(self, data, version, load_seconds=0.0, index=None, deltas=(), incremental=False):
+        self.data = data
+        self.index = index if index is not None else CatalogueIndex(data)
+        # version of the dataset file, and the saved deltas applied on top of it (see CatalogueManager.ingest)
+        self.base_version = version
+        self.deltas = tuple(deltas)
+        self.version = f'{version}+{self.deltas[-1]}' if self.deltas else version
+        # made by upsert() from a previous catalogue rather than loaded and indexed from scratch
+        self.incremental = incremental
+        self.loaded_at = time.time()
+        self.load_seconds = load_seconds
+
+    def upsert(self, delta, name):
+        """
+        A new Catalogue with the tracks of delta (saved as `name`) added or updated, see
+        catalogue_store.upsert_tracks. Only the updated tracks are indexed, the rest of the
+        index is carried over. Returns it with the number of tracks updated and added.
+        """
+        start = time.perf_counter()
+        keys = self.index.track_keys if self.index.track_keys is not None else track_keys(self.data)
+        data, changed, added, keys = upsert_tracks(self.data, delta, keys)
+        index = self.index.upsert(data, changed, added, keys)
+        catalogue = Catalogue(data, self.base_version, time.perf_counter() - start, index, self.deltas + (name,),
+                              incremental=True)
+        return catalogue, len(changed), len(added)
+
+    def with_similar_table(self, table):
+        # a copy of this catalogue taking similar songs from table (see similar_table), this one is left as it is
+        catalogue = copy.copy(self)
+        catalogue.index = copy.copy(self.index)
+        catalogue.index.similar_table = table
+        return catalogue
+
+
+class CatalogueManager:
+    """
+    Holds the current Catalogue and reloads it in a background thread when the dataset (or its
+    snapshot) changes. The new version is loaded and fully indexed before it replaces the old
+    one, with a single assignment, so requests never see a half built catalogue.
+
+    Tracks can also be added or updated without a reload with ingest(). Each delta is saved next to
+    the dataset (see catalogue_store.save_delta) and applied on top of it by every load, other
+    processes serving the same dataset pick it up on their next check and apply it the same way.
+
+    Similar songs tables built for a catalogue (see similar_table) are picked up when it is installed,
+    or by the next check if the table is built after that.
+
+    loader(dataset_path) returns the deduplicated DataFrame and should raise if it can't be loaded.
+    on_reload(catalogue) is called after each swap (e.g. to invalidate cached responses).
+    """
+
+    def __init__(self, dataset_path, loader, poll_interval=30.0, on_reload=None):
+        self.dataset_path = dataset_path
+        self.loader = loader
+        self.poll_interval = poll_interval
+        self.on_reload = on_reload
+        self.current = None
+        self.reloading = False
+        self.reloads = 0
+        self.last_error = None
+        self.failed_version = None
+        self.reload_lock = threading.RLock()
+        self.watcher_pid = None
+
+    def reload(self):
+        # returns False and keeps serving the current catalogue if the new one can't be loaded
+        with self.reload_lock:
+            self.reloading = True
+            start = time.perf_counter()
+            version = None
+            try:
+                version = catalogue_version(self.dataset_path)
+                data = self.loader(self.dataset_path)
+                # the file changed while it was being read (e.g. it is still being copied in),
+                # leave it for the next check
+                if catalogue_version(self.dataset_path) != version:
+                    raise RuntimeError('dataset changed while it was being loaded')
+                data, deltas = self._apply_saved_deltas(data)
+                catalogue = Catalogue(data, version, time.perf_counter() - start, deltas=deltas)
+            except Exception as e:
+                print(f"Error reloading catalogue: {e}")
+                self.last_error = str(e)
+                self.failed_version = version
+                return False
+            finally:
+                self.reloading = False
+
+            self.install(catalogue)
+            return True
+
+    def ingest(self, content):
+        """
+        Add the tracks of a delta CSV (given as bytes) to the catalogue, or update the ones with the same
+        track_name and artists, without reloading it. The delta is saved so it is applied again by later
+        loads and in the other processes. Returns the number of tracks updated and added.
+        Raises ValueError if the delta doesn't fit the catalogue, nothing is saved then.
+        """
+        delta = read_delta(content)
+        with self.reload_lock:
+            # deltas other processes saved in the meantime come first
+            self.apply_deltas()
+            if self.current is None:
+                raise ValueError('No catalogue is loaded to add tracks to')
+            # applied before it is saved, so a delta that doesn't fit is never replayed
+            name = delta_name()
+            catalogue, updated, added = self.current.upsert(delta, name)
+            save_delta(self.dataset_path, name, content)
+            self.install(catalogue)
+            return {'updated': updated, 'added': added, 'version': catalogue.version,
+                    'seconds': catalogue.load_seconds}
+
+    def apply_deltas(self):
+        """
+        Apply the deltas saved since the current catalogue was loaded (e.g. by another process) to it,
+        incrementally. If they can't just be applied on top (a delta was saved out of order, or one it
+        had applied was removed) the catalogue is reloaded instead. Returns False if that failed.
+        """
+        with self.reload_lock:
+            catalogue = self.current
+            saved = list_deltas(self.dataset_path)
+            if catalogue is None or saved[:len(catalogue.deltas)] != list(catalogue.deltas):
+                return self.reload()
+            pending = saved[len(catalogue.deltas):]
+            if not pending:
+                return True
+
+            try:
+                for name in pending:
+                    catalogue = catalogue.upsert(read_delta(self.dataset_path, name), name)[0]
+            except Exception as e:
+                print(f"Error applying catalogue delta: {e}")
+                self.last_error = str(e)
+                return False
+            self.install(catalogue)
+            return True
+
+    def install(self, catalogue):
+        catalogue = self._with_similar_table(catalogue)
+        self.current = catalogue
+        self.reloads += 1
+        self.last_error = None
+        if self.on_reload is not None:
+            self.on_reload(catalogue)
+
+    def is_stale(self):
+        # versions that already failed to load are only retried once the file changes again
+        version = catalogue_version(self.dataset_path)
+        return self.current is None or version not in (self.current.base_version, self.failed_version)
+
+    def start_watching(self):
+        # threads don't survive a fork, so this is called again in each (gunicorn) worker process
+        if not self.poll_interval or self.watcher_pid == os.getpid():
+            return
+        self.watcher_pid = os.getpid()
+        threading.Thread(target=self._watch, name='catalogue-watcher', daemon=True).start()
+
+    def status(self):
+        catalogue = self.current
+        similar_table = catalogue.index.similar_table if catalogue else None
+        return {
+            'dataset_path': self.dataset_path,
+            'version': catalogue.version if catalogue else None,
+            'rows': len(catalogue.data) if catalogue else 0,
+            'loaded_at': catalogue.loaded_at if catalogue else None,
+            'load_seconds': catalogue.load_seconds if catalogue else None,
+            'deltas': len(catalogue.deltas) if catalogue else 0,
+            'similar_table': similar_table.version if similar_table is not None else None,
+            'reloading': self.reloading,
+            'reloads': self.reloads,
+            'last_error': self.last_error,
+            'poll_interval': self.poll_interval
+        }
+
+    def _apply_saved_deltas(self, data):
+        # the dataset as loaded with every saved delta applied, and the names of those deltas.
+        # a delta that can't be applied is skipped (it was checked when it was ingested)
+        deltas = list_deltas(self.dataset_path)
+        keys = None
+        for name in deltas:
+            try:
+                data, _, _, keys = upsert_tracks(data, read_delta(self.dataset_path, name), keys)
+            except Exception as e:
+                print(f"Error applying catalogue delta {name}: {e}")
+        return data, deltas
+
+    def _with_similar_table(self, catalogue):
+        # catalogue with the similar songs table built for exactly it, if there is one and it doesn't have it
+        # yet (it may have one carried over from an older version)
+        table = catalogue.index.similar_table
+        if table is not None and table.version == catalogue.version:
+            return catalogue
+        table = load_similar_table(similar_table_path_for(self.dataset_path), catalogue)
+        return catalogue.with_similar_table(table) if table is not None else catalogue
+
+    def _check_similar_table(self):
+        # a table built after the current catalogue was installed comes in as a new Catalogue, requests
+        # already running keep the one they started with
+        with self.reload_lock:
+            if self.current is not None:
+                catalogue = self._with_similar_table(self.current)
+                if catalogue is not self.current:
+                    self.install(catalogue)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                if self.is_stale():
+                    self.reload()
+                else:
+                    self.apply_deltas()
+                self._check_similar_table()
+            except Exception as e:
+                print(f"Error checking the catalogue for changes: {e}")
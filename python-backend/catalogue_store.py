@@ -0,0 +1,326 @@
+import io
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+SNAPSHOT_VERSION = 3
+
+# compact dtypes for the known numeric columns, anything else keeps the dtype pandas gave it.
+# the audio features stay float64, in float32 the similarity scores would differ from the CSV's
+SNAPSHOT_DTYPES = {
+    'popularity': np.int8,
+    'duration_ms': np.int32,
+    'explicit': np.bool_,
+    'key': np.int8,
+    'mode': np.int8,
+    'time_signature': np.int8
+}
+
+# string columns with a lot of repeated values are stored as categorical codes
+CATEGORY_COLUMNS = ['track_genre', 'artists', 'album_name']
+
+
+def snapshot_path_for(dataset_path):
+    # songs_dataset.csv -> songs_dataset.snapshot (a directory)
+    return os.path.splitext(dataset_path)[0] + '.snapshot'
+
+
+def deltas_path_for(dataset_path):
+    # songs_dataset.csv -> songs_dataset.deltas (a directory of the delta CSVs ingested on top of it)
+    return os.path.splitext(dataset_path)[0] + '.deltas'
+
+
+def drop_duplicate_tracks(df):
+    # the same song can appear once per genre in the dataset, keep the first one.
+    # snapshots are written already deduplicated, dropping duplicates again would copy every column
+    if df.attrs.get('deduplicated'):
+        return df
+    df = df.drop_duplicates(subset=['track_name', 'artists'])
+    df.attrs['deduplicated'] = True
+    return df
+
+
+def track_keys(df):
+    # (track_name, artists) -> row position, for a catalogue that is already deduplicated
+    return {_track_key(name, artists): position for position, (name, artists) in enumerate(
+        zip(df['track_name'].to_numpy(dtype=object), df['artists'].to_numpy(dtype=object)))}
+
+
+def upsert_tracks(df, delta, keys=None):
+    """
+    Add the tracks in delta to the catalogue df. A track with the same track_name and artists as one
+    already in df replaces it at the same row position, the others are appended in the order they
+    come in delta (the first of several with the same track_name and artists, like the dataset).
+
+    keys is track_keys(df), built here if not passed in. Returns the new DataFrame, the row positions
+    that were replaced, the row positions that were appended and the keys of the new DataFrame.
+    """
+    missing_columns = [col for col in df.columns if col not in delta.columns]
+    if missing_columns:
+        raise ValueError(f'Missing columns in delta: {", ".join(missing_columns)}')
+    delta = delta.drop_duplicates(subset=['track_name', 'artists'])
+
+    keys = dict(keys if keys is not None else track_keys(df))
+    changed, changed_rows, added_rows = [], [], []
+    names, artists = delta['track_name'].to_numpy(dtype=object), delta['artists'].to_numpy(dtype=object)
+    for row, key in enumerate(zip(names, artists)):
+        key = _track_key(*key)
+        position = keys.get(key)
+        if position is None:
+            keys[key] = len(df) + len(added_rows)
+            added_rows.append(row)
+        else:
+            changed.append(position)
+            changed_rows.append(row)
+
+    by_position = np.argsort(changed)
+    changed = np.array(changed, dtype=np.int64)[by_position]
+    changed_rows = np.array(changed_rows, dtype=np.int64)[by_position]
+    added_rows = np.array(added_rows, dtype=np.int64)
+
+    columns = {col: _upsert_column(df[col], delta[col], changed, changed_rows, added_rows) for col in df.columns}
+    updated = pd.DataFrame(columns, copy=False)
+    updated.attrs['deduplicated'] = True
+    return updated, changed, np.arange(len(df), len(updated)), keys
+
+
+def delta_name():
+    # names of saved deltas sort in the order they were made
+    return f'{time.time_ns():020d}-{os.getpid()}.csv'
+
+
+def save_delta(dataset_path, name, content):
+    # keep a delta CSV (as bytes) next to the dataset, so it is applied again whenever the dataset is loaded
+    path = deltas_path_for(dataset_path)
+    os.makedirs(path, exist_ok=True)
+    # written under another name first so a half written delta is never read
+    with open(os.path.join(path, f'.{name}.tmp'), 'wb') as f:
+        f.write(content)
+    os.replace(os.path.join(path, f'.{name}.tmp'), os.path.join(path, name))
+
+
+def list_deltas(dataset_path):
+    # names of the saved deltas, in the order they have to be applied
+    try:
+        names = os.listdir(deltas_path_for(dataset_path))
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if name.endswith('.csv') and not name.startswith('.'))
+
+
+def read_delta(source, name=None):
+    # a delta from its CSV bytes, or the saved delta `name` of the dataset at source
+    if name is None:
+        return pd.read_csv(io.BytesIO(source))
+    return pd.read_csv(os.path.join(deltas_path_for(source), name))
+
+
+def build_snapshot(dataset_path, snapshot_path=None):
+    """
+    Parse the CSV once, deduplicate it and write it as a directory of .npy column files
+    that load_snapshot can memory-map.
+    """
+    snapshot_path = snapshot_path or snapshot_path_for(dataset_path)
+    df = drop_duplicate_tracks(pd.read_csv(dataset_path))
+
+    # write everything to a temporary directory first so a half written snapshot is never loaded,
+    # one per process as several workers can notice a changed CSV at the same time
+    building_path = f'{snapshot_path}.building-{os.getpid()}'
+    shutil.rmtree(building_path, ignore_errors=True)
+    os.makedirs(building_path)
+
+    columns = []
+    for i, name in enumerate(df.columns):
+        values = df[name]
+        if name in CATEGORY_COLUMNS:
+            codes, categories = pd.factorize(values)
+            code_dtype = np.int16 if len(categories) < np.iinfo(np.int16).max else np.int32
+            np.save(os.path.join(building_path, f'{i}.codes.npy'), codes.astype(code_dtype))
+            _save_strings(building_path, f'{i}.categories', list(categories))
+            columns.append({'name': name, 'kind': 'category'})
+        elif values.dtype.kind in 'biuf':
+            array = _compact(values)
+            np.save(os.path.join(building_path, f'{i}.npy'), array)
+            columns.append({'name': name, 'kind': 'numeric', 'dtype': str(array.dtype)})
+        else:
+            _save_strings(building_path, str(i), values.tolist())
+            columns.append({'name': name, 'kind': 'string'})
+
+    stat = os.stat(dataset_path)
+    meta = {
+        'version': SNAPSHOT_VERSION,
+        'rows': len(df),
+        'source': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns},
+        'columns': columns
+    }
+    with open(os.path.join(building_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(snapshot_path, ignore_errors=True)
+    try:
+        os.rename(building_path, snapshot_path)
+    except OSError:
+        # another process put its (identical) snapshot in place first
+        shutil.rmtree(building_path, ignore_errors=True)
+    return snapshot_path
+
+
+def snapshot_is_fresh(dataset_path, snapshot_path=None):
+    # a snapshot is usable if it was built from the current version of the CSV,
+    # or if there is no CSV at all to compare against
+    snapshot_path = snapshot_path or snapshot_path_for(dataset_path)
+    meta = _read_meta(snapshot_path)
+    if meta is None or meta.get('version') != SNAPSHOT_VERSION:
+        return False
+    if not os.path.exists(dataset_path):
+        return True
+    stat = os.stat(dataset_path)
+    return meta['source'] == {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def catalogue_version(dataset_path):
+    # identifies the catalogue contents, the same in every worker loading the same file
+    snapshot_path = snapshot_path_for(dataset_path)
+    if os.path.exists(dataset_path):
+        stat = os.stat(dataset_path)
+        return f'{stat.st_size}-{stat.st_mtime_ns}'
+    meta = _read_meta(snapshot_path)
+    if meta is not None:
+        return f'{meta["source"]["size"]}-{meta["source"]["mtime_ns"]}'
+    return 'none'
+
+
+def ensure_snapshot(dataset_path, snapshot_path=None):
+    # (re)build the snapshot if it is missing or stale, returns False if there is no CSV to build it from
+    snapshot_path = snapshot_path or snapshot_path_for(dataset_path)
+    if snapshot_is_fresh(dataset_path, snapshot_path):
+        return True
+    if not os.path.exists(dataset_path):
+        return False
+    build_snapshot(dataset_path, snapshot_path)
+    return True
+
+
+def load_snapshot(snapshot_path, mmap=True):
+    """
+    Load a snapshot written by build_snapshot. Numeric columns and category codes are
+    memory-mapped (read only) unless mmap is False.
+    """
+    meta = _read_meta(snapshot_path)
+    if meta is None:
+        raise FileNotFoundError(f'No catalogue snapshot at {snapshot_path}')
+
+    mmap_mode = 'r' if mmap else None
+    columns = {}
+    for i, column in enumerate(meta['columns']):
+        if column['kind'] == 'numeric':
+            columns[column['name']] = np.load(os.path.join(snapshot_path, f'{i}.npy'), mmap_mode=mmap_mode)
+        elif column['kind'] == 'category':
+            codes = np.load(os.path.join(snapshot_path, f'{i}.codes.npy'), mmap_mode=mmap_mode)
+            categories = _load_strings(snapshot_path, f'{i}.categories')
+            columns[column['name']] = pd.Categorical.from_codes(codes, categories=pd.Index(categories, dtype=object))
+        else:
+            columns[column['name']] = _load_strings(snapshot_path, str(i))
+
+    df = pd.DataFrame(columns, copy=False)
+    df.attrs['deduplicated'] = True
+    return df
+
+
+def _compact(values):
+    # cast to the compact dtype only when that doesn't change any value (see _fits). an int column with
+    # NaNs or fractions and one with values out of the compact range are kept as they are
+    array = values.to_numpy()
+    dtype = SNAPSHOT_DTYPES.get(values.name)
+    if dtype is None:
+        return array
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'iu' and array.dtype.kind == 'f':
+        if np.isnan(array).any() or (array != np.trunc(array)).any():
+            return array
+        array = array.astype(np.int64)
+    return array.astype(dtype) if _fits(array, dtype) else array
+
+
+def _track_key(name, artists):
+    # missing values all compare equal, like they do for drop_duplicates
+    return (name if isinstance(name, str) else None, artists if isinstance(artists, str) else None)
+
+
+def _upsert_column(values, incoming, changed, changed_rows, added_rows):
+    # values with the rows at `changed` replaced by incoming[changed_rows] and incoming[added_rows] appended
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        # new values become new categories after the existing ones, the existing codes stay as they are
+        categories = values.cat.categories
+        incoming = pd.Index(incoming.to_numpy(dtype=object))
+        categories = categories.append(incoming[categories.get_indexer(incoming) < 0].dropna().unique())
+        incoming_codes = categories.get_indexer(incoming)
+        codes = np.concatenate([values.cat.codes.to_numpy(), incoming_codes[added_rows]])
+        codes[changed] = incoming_codes[changed_rows]
+        return pd.Categorical.from_codes(codes, categories=categories)
+
+    existing = values.to_numpy()
+    incoming = incoming.to_numpy()
+    if existing.dtype.kind in 'biuf' and incoming.dtype.kind in 'biuf':
+        # the column keeps its dtype (e.g. the compact snapshot ones) when the new values fit in it
+        dtype = existing.dtype if _fits(incoming, existing.dtype) else np.result_type(existing, incoming)
+    else:
+        dtype = object
+    updated = np.concatenate([existing.astype(dtype, copy=False), incoming[added_rows].astype(dtype)])
+    updated[changed] = incoming[changed_rows]
+    # string columns keep their pandas dtype
+    return pd.array(updated, dtype=values.dtype) if isinstance(values.dtype, pd.StringDtype) else updated
+
+
+def _fits(values, dtype):
+    # whether the numeric values can be stored as dtype without changing them (floats only lose precision)
+    if dtype.kind == 'f':
+        return True
+    if dtype.kind == 'b' or values.dtype.kind not in 'iub':
+        return values.dtype.kind == dtype.kind
+    limits = np.iinfo(dtype)
+    return not len(values) or (values.min() >= limits.min and values.max() <= limits.max)
+
+
+def _save_strings(path, name, values):
+    # strings are stored as one utf-8 blob plus character offsets, missing values in a separate mask
+    missing = np.array([not isinstance(value, str) for value in values], dtype=bool)
+    strings = ['' if is_missing else value for value, is_missing in zip(values, missing)]
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in strings], out=offsets[1:])
+
+    blob = ''.join(strings).encode('utf-8', 'surrogatepass')
+    np.save(os.path.join(path, f'{name}.offsets.npy'), offsets)
+    np.save(os.path.join(path, f'{name}.data.npy'), np.frombuffer(blob, dtype=np.uint8))
+    if missing.any():
+        np.save(os.path.join(path, f'{name}.missing.npy'), missing)
+
+
+def _load_strings(path, name):
+    offsets = np.load(os.path.join(path, f'{name}.offsets.npy')).tolist()
+    text = np.load(os.path.join(path, f'{name}.data.npy')).tobytes().decode('utf-8', 'surrogatepass')
+    values = np.array([text[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])], dtype=object)
+
+    missing_path = os.path.join(path, f'{name}.missing.npy')
+    if os.path.exists(missing_path):
+        values[np.load(missing_path)] = np.nan
+    return values
+
+
+def _read_meta(snapshot_path):
+    try:
+        with open(os.path.join(snapshot_path, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+if __name__ == '__main__':
+    # python catalogue_store.py path/to/songs_dataset.csv
+    for path in sys.argv[1:]:
+        print(f'Wrote {build_snapshot(path)}')
@@ -0,0 +1,2 @@
+# lets pytest import the backend modules (they are plain top-level modules, not a package)
+# however it is started: python -m pytest tests, or pytest from this directory
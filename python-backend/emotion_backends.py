@@ -0,0 +1,155 @@
+import os
+import sys
+import threading
+
+import numpy as np
+
+# order backends are tried in when none is asked for, the converted artefacts are much
+# lighter to load and run than the full Keras model
+BACKEND_PREFERENCE = ['tflite', 'onnx', 'keras']
+
+
+class KerasBackend:
+    name = 'keras'
+
+    def __init__(self, keras_path):
+        # tensorflow is imported here rather than at module level so only this backend pays for it
+        from tensorflow.keras.models import load_model
+        self.model = load_model(keras_path)
+
+    def predict(self, batch):
+        return self.model.predict(batch, verbose=0)
+
+
+class TFLiteBackend:
+    name = 'tflite'
+
+    def __init__(self, tflite_path):
+        self.interpreter = _tflite_interpreter_class()(model_path=tflite_path)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.batch_size = None
+        self.lock = threading.Lock()
+
+    def predict(self, batch):
+        batch = np.asarray(batch, dtype=np.float32)
+        with self.lock:
+            # the interpreter's tensors are sized for one batch size at a time
+            if len(batch) != self.batch_size:
+                self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(batch)
+            self.interpreter.set_tensor(self.input_index, batch)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index).copy()
+
+
+class ONNXBackend:
+    name = 'onnx'
+
+    def __init__(self, onnx_path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(onnx_path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, batch):
+        return self.session.run(None, {self.input_name: np.asarray(batch, dtype=np.float32)})[0]
+
+
+def _tflite_interpreter_class():
+    # the standalone runtimes are a few MB, full tensorflow is only used if neither is installed
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        import tensorflow as tf
+        return tf.lite.Interpreter
+
+
+BACKENDS = {
+    'keras': (KerasBackend, '.keras'),
+    'tflite': (TFLiteBackend, '.tflite'),
+    'onnx': (ONNXBackend, '.onnx')
+}
+
+
+def artefact_path(keras_path, backend):
+    # model.keras -> model.tflite / model.onnx, next to the original
+    return os.path.splitext(keras_path)[0] + BACKENDS[backend][1]
+
+
+def load_emotion_backend(keras_path, backend='auto'):
+    """
+    Load the emotion classifier with the given backend, or with 'auto' the first of
+    BACKEND_PREFERENCE whose artefact exists and whose runtime can be imported.
+    """
+    candidates = BACKEND_PREFERENCE if backend == 'auto' else [backend]
+    errors = []
+    for name in candidates:
+        backend_class, _ = BACKENDS[name]
+        path = artefact_path(keras_path, name) if name != 'keras' else keras_path
+        if not os.path.exists(path):
+            errors.append(f'{name}: {path} not found')
+            continue
+        try:
+            return backend_class(path)
+        except Exception as e:
+            errors.append(f'{name}: {e}')
+
+    raise RuntimeError(f'Could not load the emotion model ({"; ".join(errors)})')
+
+
+def convert(keras_path, backend='tflite'):
+    """
+    Convert the Keras model to a .tflite (needs tensorflow) or .onnx (needs tf2onnx) artefact
+    next to it. Only needs to be run again when the model changes.
+    """
+    from tensorflow.keras.models import load_model
+    model = load_model(keras_path)
+    output_path = artefact_path(keras_path, backend)
+
+    if backend == 'tflite':
+        import tensorflow as tf
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        with open(output_path, 'wb') as f:
+            f.write(converter.convert())
+    elif backend == 'onnx':
+        import tensorflow as tf
+        import tf2onnx
+        signature = [tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32, name='input')]
+        tf2onnx.convert.from_keras(model, input_signature=signature, output_path=output_path)
+    else:
+        raise ValueError(f'Cannot convert to {backend}, choose "tflite" or "onnx"')
+
+    return output_path
+
+
+def check_parity(keras_path, backend, samples=64, atol=1e-4, seed=0):
+    # compare a converted backend against the Keras model on random 48x48 crops,
+    # returns the largest absolute difference between their predicted probabilities
+    crops = np.random.default_rng(seed).random((samples, 48, 48, 1)).astype(np.float32)
+    expected = KerasBackend(keras_path).predict(crops)
+    actual = load_emotion_backend(keras_path, backend).predict(crops)
+
+    difference = float(np.abs(expected - actual).max())
+    if difference > atol or not np.array_equal(expected.argmax(axis=1), actual.argmax(axis=1)):
+        raise AssertionError(f'{backend} predictions differ from keras by up to {difference}')
+    return difference
+
+
+if __name__ == '__main__':
+    # python emotion_backends.py convert path/to/model.keras [tflite|onnx]
+    # python emotion_backends.py check path/to/model.keras [tflite|onnx]
+    command, path = sys.argv[1], sys.argv[2]
+    target = sys.argv[3] if len(sys.argv) > 3 else 'tflite'
+    if command == 'convert':
+        print(f'Wrote {convert(path, target)}')
+    elif command == 'check':
+        print(f'{target} matches keras, max difference {check_parity(path, target)}')
+    else:
+        print(f'Unknown command {command}, use "convert" or "check"')
@@ -0,0 +1,73 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class BatchedPredictor:
+    """
+    Collects face crops from concurrent requests and runs them through the model together.
+
+    A single worker thread waits for the first crop, keeps collecting until it has
+    max_batch_size crops or max_wait_ms has passed, runs one batched predict call and hands
+    each request its own row of the output.
+    """
+
+    def __init__(self, predict, max_batch_size=16, max_wait_ms=5.0):
+        self.predict_batch = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.pending = queue.Queue()
+        self.worker = threading.Thread(target=self._run, name='emotion-inference', daemon=True)
+        self.worker.start()
+
+    def submit(self, face):
+        # face is a single (48, 48, 1) crop, the future resolves to that crop's prediction row
+        future = Future()
+        self.pending.put((face, future))
+        return future
+
+    def predict(self, face, timeout=None):
+        return self.submit(face).result(timeout)
+
+    def close(self):
+        self.pending.put(None)
+        self.worker.join()
+
+    def _run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    # finish this batch first, then stop
+                    self.pending.put(None)
+                    break
+                batch.append(item)
+
+            self._predict(batch)
+
+    def _predict(self, batch):
+        faces, futures = zip(*batch)
+        try:
+            predictions = self.predict_batch(np.stack(faces))
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, prediction in zip(futures, predictions):
+            future.set_result(prediction)
@@ -0,0 +1,63 @@
+import threading
+
+import cv2
+import numpy as np
+
+from request_metrics import timed
+
+# uploads are downsized so their longest side is at most this before looking for faces,
+# the face itself is still cropped from the full resolution image
+DETECTION_MAX_SIDE = 640
+
+# input size of the emotion model (it was trained on 48x48 grayscale images)
+FACE_SIZE = 48
+
+_detectors = threading.local()
+
+
+def get_face_detector():
+    # the haarcascade face detector is loaded once per thread instead of once per request
+    # (a CascadeClassifier shouldn't be shared between threads running detectMultiScale)
+    detector = getattr(_detectors, 'face', None)
+    if detector is None:
+        detector = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+        _detectors.face = detector
+    return detector
+
+
+def extract_face(image_bytes, timings=None):
+    """
+    Decode an uploaded photo and return the first detected face as a normalised
+    (48, 48, 1) array ready for the emotion model, or None if no face was found.
+    Time spent decoding, detecting and cropping is added to timings if given.
+    """
+    timings = {} if timings is None else timings
+
+    # decode straight to grayscale, the model only uses grayscale
+    with timed(timings, 'decode'):
+        gray = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            raise ValueError('Could not decode the image')
+
+    with timed(timings, 'detect'):
+        scale = min(1.0, DETECTION_MAX_SIDE / max(gray.shape))
+        small = gray if scale == 1.0 else cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        faces = get_face_detector().detectMultiScale(small, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+
+    if len(faces) == 0:
+        return None
+
+    with timed(timings, 'crop'):
+        # take the first detected face, if multiple rest are ignored,
+        # and map its box back to the full resolution image
+        x, y, w, h = (np.asarray(faces[0]) / scale).round().astype(int)
+        x, y = max(x, 0), max(y, 0)
+        face_roi = gray[y:y + h, x:x + w]
+
+        # resize it for the model and normalise
+        face_roi = cv2.resize(face_roi, (FACE_SIZE, FACE_SIZE))
+        face_roi = face_roi / 255.0
+        face_roi = np.expand_dims(face_roi, axis=-1)
+
+    return face_roi
+
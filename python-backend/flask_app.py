@@ -1,77 +1,243 @@
-from flask import Flask, request, jsonify
-import cv2
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
+import hmac
+import math
 import os
-from tensorflow.keras.models import load_model
-from tensorflow.keras.preprocessing.image import img_to_array
+import threading
 import numpy as np
 from PIL import Image
 import pandas as pd
 from music_recommender import (
-    NumpyEncoder, load_data, recommend_by_mood, recommend_by_activity, random_recommendations, search_songs,
-    get_song_analysis, find_obscure_songs, find_similar_songs
+    load_data, recommend_by_mood, recommend_by_activity, random_recommendations, search_songs,
+    get_song_analysis, find_obscure_songs, find_similar_songs, find_similar_songs_batch, SIMILAR_SCOPES
 )
+from ann_index import ANN_PROBES
+from catalogue_index import SCORE_TEMPERATURE
+from catalogue_manager import Catalogue, CatalogueManager
+from catalogue_store import drop_duplicate_tracks, ensure_snapshot, snapshot_path_for
+from emotion_backends import load_emotion_backend
+from emotion_inference import BatchedPredictor
+from face_detection import extract_face
+from json_provider import FastJSONProvider
+from process_executor import ProcessExecutor
+from request_metrics import RequestMetrics, SlowRequestProfiler, instrument, request_stages, stage, timed
+from response_cache import LocalSharedBackend, RedisBackend, ResponseCache, cached_response, int_argument
+
+# the emotion detection model, converted artefacts (.tflite/.onnx) next to it are preferred
+# when present, see emotion_backends
+EMOTION_MODEL_PATH = os.environ.get(
+    'MELODEX_EMOTION_MODEL_PATH',
+    'C:\\Users\\syedn\\Melodex\\Melodex-Recommendation-System\\venv\\Models\\facial_expression_model_4emotions_continued.keras'
+)
+EMOTION_BACKEND = os.environ.get('MELODEX_EMOTION_BACKEND', 'auto')
+
+# define emotion labels 
+EMOTION_LABELS = ['Angry', 'Fear', 'Happy', 'Sad']
+
+# photos from concurrent requests are classified together, in batches of up to
+# EMOTION_BATCH_SIZE faces collected for at most EMOTION_BATCH_WAIT_MS
+EMOTION_BATCH_SIZE = int(os.environ.get('MELODEX_EMOTION_BATCH_SIZE', 16))
+EMOTION_BATCH_WAIT_MS = float(os.environ.get('MELODEX_EMOTION_BATCH_WAIT_MS', 5))
+
+emotion_predictor = None
+emotion_model_failed = False
+emotion_model_lock = threading.Lock()
 
-# load the emotion detection model
-try:
-    emotion_model = load_model('C:\\Users\\syedn\\Melodex\\Melodex-Recommendation-System\\venv\\Models\\facial_expression_model_4emotions_continued.keras')
 
-    # define emotion labels 
-    EMOTION_LABELS = ['Angry', 'Fear', 'Happy', 'Sad']
-except Exception as e:
-    print(f"Error loading emotion model: {e}")
-    emotion_model = None
+def get_emotion_predictor():
+    # the model is loaded when the first photo comes in rather than at startup, so workers that
+    # only serve the other endpoints never import an inference runtime. None if it failed to load
+    global emotion_predictor, emotion_model_failed
+    with emotion_model_lock:
+        if emotion_predictor is None and not emotion_model_failed:
+            try:
+                backend = load_emotion_backend(EMOTION_MODEL_PATH, EMOTION_BACKEND)
+                emotion_predictor = BatchedPredictor(backend.predict, EMOTION_BATCH_SIZE, EMOTION_BATCH_WAIT_MS)
+            except Exception as e:
+                print(f"Error loading emotion model: {e}")
+                emotion_model_failed = True
+    return emotion_predictor
+
 
 app = Flask(__name__)
 CORS(app)
 
-# configure Flask to use custom JSON encoder
-app.json_encoder = NumpyEncoder
+# JSON responses are encoded with orjson (when installed), which handles numpy values itself
+app.json = FastJSONProvider(app)
+
+# every request is timed into latency histograms per route and per stage (filter, sample, score,
+# serialize, and decode, detect, crop, infer for photos), served in Prometheus format at /metrics.
+# with MELODEX_PROFILE_SLOW_MS set, requests are also sampled by a profiler and the stacks of those
+# slower than that are kept for /api/slow-requests
+PROFILE_SLOW_MS = float(os.environ.get('MELODEX_PROFILE_SLOW_MS', 0))
+PROFILE_INTERVAL_MS = float(os.environ.get('MELODEX_PROFILE_INTERVAL_MS', 5))
+request_metrics = RequestMetrics()
+slow_request_profiler = SlowRequestProfiler(PROFILE_SLOW_MS, PROFILE_INTERVAL_MS) if PROFILE_SLOW_MS else None
+instrument(app, request_metrics, slow_request_profiler)
 
 # configure allowed file extensions and upload folder
 UPLOAD_FOLDER = 'temp_uploads'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-try:
-    DATASET_PATH = 'C:\\Users\\syedn\\Melodex\\Melodex-Recommendation-System\\venv\\songs_dataset.csv'
-    music_data = load_data(DATASET_PATH)
-    music_data =  music_data.drop_duplicates(subset=['track_name', 'artists'])
-except:
-    DATASET_PATH = 'songs_dataset.csv'
-    try:
-        music_data = load_data(DATASET_PATH)
-        music_data =  music_data.drop_duplicates(subset=['track_name', 'artists'])
-    except:
-        # Create a placeholder dataset if both paths fail
-        print("Warning: Could not load dataset. Creating a sample dataset.")
-        import numpy as np
-        music_data = pd.DataFrame({
-            'track_id': [f'sample{i}' for i in range(10)],
-            'track_name': [f'Sample Track {i}' for i in range(10)],
-            'album_name': [f'Sample Album {i // 2}' for i in range(10)],
-            'artists': [f'Sample Artist {i // 3}' for i in range(10)],
-            'track_genre': np.random.choice(['pop', 'rock', 'jazz', 'hip-hop', 'classical'], 10),
-            'popularity': np.random.randint(1, 100, 10),
-            'duration_ms': np.random.randint(120000, 300000, 10)
-        })
+# in shared catalogue mode (see gunicorn.conf.py) the binary snapshot is written up front, so every
+# worker memory-maps the same files and the OS keeps a single copy of the numeric columns
+SHARED_CATALOGUE = os.environ.get('MELODEX_SHARED_CATALOGUE') == '1'
+
+
+# the dataset can be set with MELODEX_DATASET_PATH, otherwise the first of these that exists is used
+# (a snapshot on its own is enough, see catalogue_store)
+DATASET_PATHS = [
+    os.environ.get('MELODEX_DATASET_PATH'),
+    'C:\\Users\\syedn\\Melodex\\Melodex-Recommendation-System\\venv\\songs_dataset.csv',
+    'songs_dataset.csv'
+]
+DATASET_PATH = next(
+    (path for path in DATASET_PATHS if path and (os.path.exists(path) or os.path.exists(snapshot_path_for(path)))),
+    'songs_dataset.csv'
+)
+
+# how often (in seconds) to check the dataset for changes, a changed dataset is loaded and indexed
+# in the background and then swapped in without restarting. 0 turns reloading off
+RELOAD_INTERVAL = float(os.environ.get('MELODEX_RELOAD_INTERVAL', 30))
+
+
+def load_catalogue(dataset_path):
+    if SHARED_CATALOGUE:
+        ensure_snapshot(dataset_path)
+    music_data = load_data(dataset_path)
+    if music_data.empty:
+        raise ValueError(f'No songs could be loaded from {dataset_path}')
+    return drop_duplicate_tracks(music_data)
+
+
+def sample_catalogue():
+    return pd.DataFrame({
+        'track_id': [f'sample{i}' for i in range(10)],
+        'track_name': [f'Sample Track {i}' for i in range(10)],
+        'album_name': [f'Sample Album {i // 2}' for i in range(10)],
+        'artists': [f'Sample Artist {i // 3}' for i in range(10)],
+        'track_genre': np.random.choice(['pop', 'rock', 'jazz', 'hip-hop', 'classical'], 10),
+        'popularity': np.random.randint(1, 100, 10),
+        'duration_ms': np.random.randint(120000, 300000, 10)
+    })
+
+
+# responses of the endpoints that only depend on their query parameters are cached. the
+# shared backend ('local' or a redis:// URL) lets workers reuse each other's responses
+CACHE_SIZE = int(os.environ.get('MELODEX_CACHE_SIZE', 2048))
+CACHE_TTL = float(os.environ['MELODEX_CACHE_TTL']) if os.environ.get('MELODEX_CACHE_TTL') else None
+CACHE_BACKEND = os.environ.get('MELODEX_CACHE_BACKEND', '')
+if CACHE_BACKEND == 'local':
+    shared_cache = LocalSharedBackend()
+elif CACHE_BACKEND:
+    shared_cache = RedisBackend(CACHE_BACKEND)
+else:
+    shared_cache = None
+response_cache = ResponseCache(CACHE_SIZE, CACHE_TTL, shared_cache)
+
+# with MELODEX_PROCESS_WORKERS set, similar songs and playlists are computed by that many worker
+# processes forked with the catalogue, so they use more than one core (see process_executor).
+# a new set of workers is forked for each full reload of the catalogue
+PROCESS_WORKERS = int(os.environ.get('MELODEX_PROCESS_WORKERS', 0))
+process_executor = ProcessExecutor(PROCESS_WORKERS) if PROCESS_WORKERS else None
+
+
+def catalogue_installed(catalogue):
+    response_cache.invalidate(catalogue.version)
+    if process_executor is not None:
+        process_executor.start(catalogue)
+
+
+# routes take catalogue_manager.current once and use it for the whole request, so a reload
+# swapping in a new catalogue never affects requests that are already running
+catalogue_manager = CatalogueManager(DATASET_PATH, load_catalogue, RELOAD_INTERVAL, on_reload=catalogue_installed)
+if not catalogue_manager.reload():
+    # Create a placeholder dataset if the dataset can't be loaded
+    print("Warning: Could not load dataset. Creating a sample dataset.")
+    catalogue_manager.install(Catalogue(sample_catalogue(), 'sample'))
+catalogue_manager.start_watching()
+
+
+# largest count the random, mood and activity endpoints produce, larger counts are cut down to it
+MAX_COUNT = int(os.environ.get('MELODEX_MAX_COUNT', 10000))
+
+# sampling temperature of ranking=score, a negative or nan one would leave nothing to sample from
+INVALID_TEMPERATURE = 'Temperature must be a number >= 0'
+
+
+def valid_temperature(temperature):
+    return math.isfinite(temperature) and temperature >= 0
+
+
+# playlist options, a playlist can't be filled up to 0 ms or take no songs per artist
+INVALID_PLAYLIST_OPTIONS = 'target_duration_ms and max_per_artist must be > 0'
+
+
+def valid_playlist_options(target_duration_ms, max_per_artist):
+    return all(option is None or option > 0 for option in (target_duration_ms, max_per_artist))
+
+
+# with stream=1 those endpoints send their items as newline delimited JSON while they are being
+# produced, in chunks of about STREAM_CHUNK_BYTES. the next items are only produced once the
+# server has written the previous chunk, so a slow client slows the generator down
+STREAM_CHUNK_BYTES = int(os.environ.get('MELODEX_STREAM_CHUNK_BYTES', 32 * 1024))
+
+
+def ndjson_response(items, headers=None):
+    # the items are produced after the request has finished, so the time spent producing and
+    # encoding them is recorded as the route's serialize stage once the stream ends
+    route = request.url_rule.rule
+    items = iter(items)
+
+    def generate():
+        chunk = []
+        size = 0
+        timings = {}
+        try:
+            while True:
+                with timed(timings, 'serialize'):
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    line = app.json.dumpb(item) + b'\n'
+                chunk.append(line)
+                size += len(line)
+                if size >= STREAM_CHUNK_BYTES:
+                    yield b''.join(chunk)
+                    chunk = []
+                    size = 0
+        except Exception as e:
+            # the status has already been sent, so a failure ends the stream with an error line
+            chunk.append(app.json.dumpb({'error': str(e)}) + b'\n')
+        finally:
+            request_metrics.observe_stages(route, timings)
+        if chunk:
+            yield b''.join(chunk)
+
+    return Response(generate(), mimetype='application/x-ndjson', headers=headers)
 
 
 @app.route('/api/random', methods=['GET'])
 def random_music_items():
     item_type = request.args.get('item_type', 'song')
     genre = request.args.get('genre', None)
-    count = int(request.args.get('count', 1))
+    count = min(int(request.args.get('count', 1)), MAX_COUNT)
+    stream = request.args.get('stream') == '1'
 
     if item_type not in ['song', 'album', 'artist', 'playlist']:
         return jsonify(
             {'success': False, 'error': 'Invalid item type. Must be one of: song, album, artist, playlist'}), 400
 
     try:
-        results = random_recommendations(music_data, item_type, genre, count)
+        catalogue = catalogue_manager.current
+        results = random_recommendations(catalogue.data, item_type, genre, count, stream, index=catalogue.index)
 
         if isinstance(results, dict) and 'error' in results:
             return jsonify({'success': False, 'error': results['error']}), 404
 
+        if stream:
+            return ndjson_response(results)
+
         return jsonify({
             'success': True,
             'items': results
@@ -82,6 +248,7 @@ def random_music_items():
 
 
 @app.route('/api/search', methods=['GET'])
+@cached_response(response_cache, 'search', {'query': str.lower})
 def search_for_songs():
     query = request.args.get('query', '')
 
@@ -92,7 +259,8 @@ def search_for_songs():
         })
 
     try:
-        results = search_songs(music_data, query)
+        catalogue = catalogue_manager.current
+        results = search_songs(catalogue.data, query, index=catalogue.index)
         return jsonify({
             'success': True,
             'results': results
@@ -103,6 +271,7 @@ def search_for_songs():
 
 
 @app.route('/api/analyse', methods=['GET'])
+@cached_response(response_cache, 'analyse', {'track_id': None})
 def analyse_song():
     track_id = request.args.get('track_id', '')
 
@@ -110,7 +279,8 @@ def analyse_song():
         return jsonify({'success': False, 'error': 'Track ID is required'}), 400
 
     try:
-        analysis = get_song_analysis(music_data, track_id)
+        catalogue = catalogue_manager.current
+        analysis = get_song_analysis(catalogue.data, track_id, index=catalogue.index)
 
         if isinstance(analysis, dict) and 'error' in analysis:
             return jsonify({'success': False, 'error': analysis['error']}), 404
@@ -131,7 +301,8 @@ def obscure_songs():
     count = int(request.args.get('count', 5))
 
     try:
-        results = find_obscure_songs(music_data, genre, popularity_threshold, count)
+        catalogue = catalogue_manager.current
+        results = find_obscure_songs(catalogue.data, genre, popularity_threshold, count)
 
         if isinstance(results, dict) and 'error' in results:
             return jsonify({'success': False, 'error': results['error']}), 404
@@ -146,15 +317,24 @@ def obscure_songs():
 
 
 @app.route('/api/similar', methods=['GET'])
+@cached_response(response_cache, 'similar', {'track_id': None, 'count': int_argument(5), 'scope': None,
+                                             'probes': int_argument(ANN_PROBES)})
 def similar_songst():
     track_id = request.args.get('track_id', '')
     count = request.args.get('count', 5, type=int)
+    # 'global' looks for similar songs in every genre, probes trades speed for finding more of the closest
+    scope = request.args.get('scope', 'genre')
+    probes = request.args.get('probes', ANN_PROBES, type=int)
 
     if not track_id:
         return jsonify({'success': False, 'error': 'Track ID is required'}), 400
+    if scope not in SIMILAR_SCOPES:
+        return jsonify({'success': False, 'error': f'Invalid scope. Must be one of: {", ".join(SIMILAR_SCOPES)}'}), 400
 
     try:
-        similar_songs = find_similar_songs(music_data, track_id, count)
+        catalogue = catalogue_manager.current
+        similar_songs = find_similar_songs(catalogue.data, track_id, count, scope, probes, index=catalogue.index,
+                                           executor=process_executor)
         if isinstance(similar_songs, dict) and 'error' in similar_songs:
             return jsonify({'success': False, 'error': similar_songs['error']}), 404
 
@@ -167,8 +347,10 @@ def similar_songst():
 
 
 @app.route('/api/genres', methods=['GET'])
+@cached_response(response_cache, 'genres')
 def get_genres():
     try:
+        music_data = catalogue_manager.current.data
         if isinstance(music_data, pd.DataFrame) and 'track_genre' in music_data.columns:
             genres = sorted(music_data['track_genre'].unique().tolist())
             return jsonify({
@@ -185,6 +367,70 @@ def get_genres():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@app.route('/api/cache-stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify({
+        'success': True,
+        'cache': response_cache.stats()
+    })
+
+
+@app.route('/api/catalogue-status', methods=['GET'])
+def get_catalogue_status():
+    return jsonify({
+        'success': True,
+        'catalogue': catalogue_manager.status()
+    })
+
+
+# tracks can be added or updated without a reload by POSTing a delta CSV (same columns as the dataset)
+# to /api/catalogue-upsert, as the request body or a 'delta' file. it changes the catalogue, so it is
+# off unless MELODEX_INGEST_TOKEN is set, and requests have to send it as 'Authorization: Bearer <token>'
+INGEST_TOKEN = os.environ.get('MELODEX_INGEST_TOKEN', '')
+
+
+@app.route('/api/catalogue-upsert', methods=['POST'])
+def upsert_catalogue():
+    if not INGEST_TOKEN:
+        return jsonify({'success': False, 'error': 'Catalogue ingestion is off, set MELODEX_INGEST_TOKEN'}), 404
+    # compared as bytes, compare_digest raises TypeError on non ascii strings
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                               f'Bearer {INGEST_TOKEN}'.encode('utf-8')):
+        return jsonify({'success': False, 'error': 'Invalid ingestion token'}), 401
+
+    content = request.files['delta'].read() if 'delta' in request.files else request.get_data()
+    if not content:
+        return jsonify({'success': False, 'error': 'Expected a delta CSV'}), 400
+
+    try:
+        result = catalogue_manager.ingest(content)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    return jsonify({
+        'success': True,
+        **result
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(request_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/slow-requests', methods=['GET'])
+def get_slow_requests():
+    if slow_request_profiler is None:
+        return jsonify({'success': False, 'error': 'Slow request profiling is off, set MELODEX_PROFILE_SLOW_MS'}), 404
+    return jsonify({
+        'success': True,
+        'threshold_ms': slow_request_profiler.threshold_ms,
+        'requests': slow_request_profiler.recent()
+    })
+
+
 @app.route('/api/activities', methods=['GET'])
 def get_activities():
     activities = [
@@ -213,19 +459,36 @@ def activity_recommendation():
  
     activity = request.args.get('activity', ' ')
     item_type = request.args.get('item_type', 'song')
-    count = int(request.args.get('count', 5))
+    count = min(int(request.args.get('count', 5)), MAX_COUNT)
+    stream = request.args.get('stream') == '1'
+    # playlist options: fill each playlist up to a total duration, limit the songs per artist
+    target_duration_ms = request.args.get('target_duration_ms', None, type=int)
+    max_per_artist = request.args.get('max_per_artist', None, type=int)
+    # ranking=score ranks songs by how close they are to the feature ranges instead of filtering on them
+    ranking = request.args.get('ranking', 'filter')
+    temperature = request.args.get('temperature', SCORE_TEMPERATURE, type=float)
 
 
     if not activity:
         return jsonify({'success': False, 'error': 'Activity is required'}), 400
+    if not valid_temperature(temperature):
+        return jsonify({'success': False, 'error': INVALID_TEMPERATURE}), 400
+    if not valid_playlist_options(target_duration_ms, max_per_artist):
+        return jsonify({'success': False, 'error': INVALID_PLAYLIST_OPTIONS}), 400
 
     try:
-        results = recommend_by_activity(music_data, activity, item_type, count)
+        catalogue = catalogue_manager.current
+        results = recommend_by_activity(catalogue.data, activity, item_type, count, target_duration_ms,
+                                        max_per_artist, ranking, temperature, stream, index=catalogue.index,
+                                        executor=process_executor)
 
 
         if isinstance(results, dict) and 'error' in results:
             return jsonify({'success': False, 'error': results['error']}), 400
 
+        if stream:
+            return ndjson_response(results)
+
         return jsonify({
             'success': True,
             'items': results
@@ -240,17 +503,30 @@ def mood_recommendation():
     
     input_method = request.form.get('input_method', 'text')
     item_type = request.form.get('item_type', 'song')
-    count = int(request.form.get('count', 5))
+    count = min(int(request.form.get('count', 5)), MAX_COUNT)
+    stream = request.values.get('stream') == '1'
     genre = request.form.get('genre', None)  
+    # playlist options: fill each playlist up to a total duration, limit the songs per artist
+    target_duration_ms = request.form.get('target_duration_ms', None, type=int)
+    max_per_artist = request.form.get('max_per_artist', None, type=int)
+    # ranking=score ranks songs by how close they are to the feature ranges instead of filtering on them
+    ranking = request.form.get('ranking', 'filter')
+    temperature = request.form.get('temperature', SCORE_TEMPERATURE, type=float)
+    if not valid_temperature(temperature):
+        return jsonify({'success': False, 'error': INVALID_TEMPERATURE}), 400
+    if not valid_playlist_options(target_duration_ms, max_per_artist):
+        return jsonify({'success': False, 'error': INVALID_PLAYLIST_OPTIONS}), 400
 
     # mood determination variables 
     detected_mood = None
     detection_confidence = None
 
+
     # If a photo is uploaded
     if input_method == 'photo' and 'mood_photo' in request.files:
         # ensure the model is loaded first before proceeding
-        if emotion_model is None:
+        predictor = get_emotion_predictor()
+        if predictor is None:
             return jsonify({
                 'success': False,
                 'error': 'Emotion detection model failed to load'
@@ -260,52 +536,25 @@ def mood_recommendation():
             # get the photo
             mood_photo = request.files['mood_photo']
 
-            # Use OpenCV for face detection and preprocessing
-
-            # read the image 
-            img_array = np.frombuffer(mood_photo.read(), np.uint8)
-            img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-
-            # convert to grayscale for face detection (model was trained on grayscale images)
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-            # load the haarcascade face detector from cv2
-            face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
-
-            # detect face(s)
-            faces = face_cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+            # decode the photo, find the face and get it ready for the model (see face_detection)
+            face_roi = extract_face(mood_photo.read(), request_stages())
 
             # if no faces detected then send an error
-            if len(faces) == 0:
+            if face_roi is None:
                 return jsonify({
                     'success': False,
                     'error': 'No face detected in the image'
                 }), 400
 
-            # take the first detected face, if multiple rest are ignored
-            (x, y, w, h) = faces[0]
-
-            # get face ROI
-            face_roi = gray[y:y + h, x:x + w]
-
-            # resize it for the model (the images it was trained on are 48x48)
-            face_roi = cv2.resize(face_roi, (48, 48))
-
-            # normalisation
-            face_roi = face_roi / 255.0
-
-            # reshape it for the model
-            face_roi = np.expand_dims(face_roi, axis=0)
-            face_roi = np.expand_dims(face_roi, axis=-1)
-
-            # get emotion prediction
-            emotion_prediction = emotion_model.predict(face_roi)
+            # get emotion prediction, batched together with any other photos being processed
+            with stage('infer'):
+                emotion_prediction = predictor.predict(face_roi)
             detected_mood_index = np.argmax(emotion_prediction)
 
             # assign the mood with highest confidence and the confidence value
             # to the previously intialised variables
             detected_mood = EMOTION_LABELS[detected_mood_index]
-            detection_confidence = float(emotion_prediction[0][detected_mood_index] * 100)
+            detection_confidence = float(emotion_prediction[detected_mood_index] * 100)
 
 
         except Exception as e:
@@ -332,12 +581,20 @@ def mood_recommendation():
 
     try:
         # generate recommendationss
+        catalogue = catalogue_manager.current
         results = recommend_by_mood(
-            music_data,
+            catalogue.data,
             detected_mood,
             item_type,
             count,
-            genre  
+            genre,
+            target_duration_ms,
+            max_per_artist,
+            ranking,
+            temperature,
+            stream,
+            index=catalogue.index,
+            executor=process_executor
         )
 
         # check if results contain an error
@@ -347,6 +604,13 @@ def mood_recommendation():
                 'error': results['error']
             }), 404
 
+        if stream:
+            # the detected mood goes in headers as every line of the stream is an item
+            headers = {'X-Mood': detected_mood}
+            if detection_confidence is not None:
+                headers['X-Mood-Confidence'] = str(detection_confidence)
+            return ndjson_response(results, headers)
+
         return jsonify({
             'success': True,
             'mood': detected_mood,
@@ -363,5 +627,182 @@ def mood_recommendation():
         }), 500
 
 
+# the batch endpoints take a JSON array of queries, each with the same parameters as the single
+# endpoint, and return one result per query in the same order. a query that fails gets an
+# {'error': ...} dict in its place instead of failing the whole batch
+BATCH_LIMIT = int(os.environ.get('MELODEX_BATCH_LIMIT', 100))
+
+
+def batch_queries():
+    # the queries from the request body, or an error response
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list):
+        return None, (jsonify({'success': False, 'error': 'Expected a JSON array of queries'}), 400)
+    if len(queries) > BATCH_LIMIT:
+        return None, (jsonify({'success': False, 'error': f'At most {BATCH_LIMIT} queries per batch'}), 400)
+    return queries, None
+
+
+def run_batch(queries, run_query):
+    results = []
+    for query in queries:
+        try:
+            if not isinstance(query, dict):
+                raise ValueError('Each query must be a JSON object')
+            results.append(run_query(query))
+        except Exception as e:
+            results.append({'error': str(e)})
+    return results
+
+
+def optional_int(query, name):
+    return int(query[name]) if query.get(name) is not None else None
+
+
+@app.route('/api/similar/batch', methods=['POST'])
+def similar_songs_batch():
+    queries, error = batch_queries()
+    if error:
+        return error
+
+    try:
+        catalogue = catalogue_manager.current
+
+        # check every query first, then score all the valid ones together.
+        # scope 'global' queries go through the approximate index one by one, like the single endpoint
+        results = [None] * len(queries)
+        valid = []
+        for i, query in enumerate(queries):
+            if not isinstance(query, dict) or not query.get('track_id'):
+                results[i] = {'error': 'Track ID is required'}
+                continue
+            scope = query.get('scope', 'genre')
+            if scope not in SIMILAR_SCOPES:
+                results[i] = {'error': f'Invalid scope. Must be one of: {", ".join(SIMILAR_SCOPES)}'}
+                continue
+            try:
+                count = int(query.get('count', 5))
+                if scope == 'global':
+                    results[i] = find_similar_songs(catalogue.data, query['track_id'], count, scope,
+                                                    int(query.get('probes', ANN_PROBES)), index=catalogue.index)
+                else:
+                    valid.append((i, query['track_id'], count))
+            except (TypeError, ValueError) as e:
+                results[i] = {'error': str(e)}
+
+        if valid:
+            positions, track_ids, counts = zip(*valid)
+            found = find_similar_songs_batch(catalogue.data, list(zip(track_ids, counts)), index=catalogue.index)
+            for i, similar_songs in zip(positions, found):
+                results[i] = similar_songs
+
+        return jsonify({
+            'success': True,
+            'results': results
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+
+@app.route('/api/analyse/batch', methods=['POST'])
+def analyse_songs_batch():
+    queries, error = batch_queries()
+    if error:
+        return error
+
+    catalogue = catalogue_manager.current
+
+    def analyse(query):
+        if not query.get('track_id'):
+            return {'error': 'Track ID is required'}
+        return get_song_analysis(catalogue.data, query['track_id'], index=catalogue.index)
+
+    return jsonify({
+        'success': True,
+        'results': run_batch(queries, analyse)
+    })
+
+
+@app.route('/api/mood-recommend/batch', methods=['POST'])
+def mood_recommendation_batch():
+    # text moods only, photos still go through /api/mood-recommend one at a time
+    queries, error = batch_queries()
+    if error:
+        return error
+
+    catalogue = catalogue_manager.current
+    valid_moods = ['Angry', 'Frightened', 'Happy', 'Sad', 'Chill']
+
+    def recommend(query):
+        mood = str(query.get('mood', '')).capitalize()
+        if mood == 'Fear':
+            mood = 'Frightened'
+        if mood not in valid_moods:
+            return {'error': f'Unsupported mood. Supported moods are: {", ".join(valid_moods)}'}
+        temperature = float(query.get('temperature', SCORE_TEMPERATURE))
+        if not valid_temperature(temperature):
+            return {'error': INVALID_TEMPERATURE}
+        target_duration_ms = optional_int(query, 'target_duration_ms')
+        max_per_artist = optional_int(query, 'max_per_artist')
+        if not valid_playlist_options(target_duration_ms, max_per_artist):
+            return {'error': INVALID_PLAYLIST_OPTIONS}
+
+        return recommend_by_mood(
+            catalogue.data,
+            mood,
+            query.get('item_type', 'song'),
+            min(int(query.get('count', 5)), MAX_COUNT),
+            query.get('genre'),
+            target_duration_ms,
+            max_per_artist,
+            query.get('ranking', 'filter'),
+            temperature,
+            index=catalogue.index
+        )
+
+    return jsonify({
+        'success': True,
+        'results': run_batch(queries, recommend)
+    })
+
+
+@app.route('/api/activity-recommend/batch', methods=['POST'])
+def activity_recommendation_batch():
+    queries, error = batch_queries()
+    if error:
+        return error
+
+    catalogue = catalogue_manager.current
+
+    def recommend(query):
+        if not query.get('activity'):
+            return {'error': 'Activity is required'}
+        temperature = float(query.get('temperature', SCORE_TEMPERATURE))
+        if not valid_temperature(temperature):
+            return {'error': INVALID_TEMPERATURE}
+        target_duration_ms = optional_int(query, 'target_duration_ms')
+        max_per_artist = optional_int(query, 'max_per_artist')
+        if not valid_playlist_options(target_duration_ms, max_per_artist):
+            return {'error': INVALID_PLAYLIST_OPTIONS}
+
+        return recommend_by_activity(
+            catalogue.data,
+            query['activity'],
+            query.get('item_type', 'song'),
+            min(int(query.get('count', 5)), MAX_COUNT),
+            target_duration_ms,
+            max_per_artist,
+            query.get('ranking', 'filter'),
+            temperature,
+            index=catalogue.index
+        )
+
+    return jsonify({
+        'success': True,
+        'results': run_batch(queries, recommend)
+    })
+
+
+# development server. to serve for real use gunicorn (gunicorn.conf.py) or the async mode (asgi_app.py)
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
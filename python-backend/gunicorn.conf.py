@@ -0,0 +1,35 @@
+# Shared catalogue serving: gunicorn -c gunicorn.conf.py flask_app:app
+#
+# flask_app is imported once in the master (preload_app), which writes the catalogue snapshot
+# if needed, memory-maps it and builds the indexes. The workers are forked from there, so the
+# numeric columns are shared through the page cache and everything else through copy-on-write.
+import gc
+import os
+
+os.environ.setdefault('MELODEX_SHARED_CATALOGUE', '1')
+
+bind = os.environ.get('MELODEX_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('MELODEX_WORKERS', 4))
+preload_app = True
+
+
+def pre_fork(server, worker):
+    # keep the garbage collector from touching the objects loaded in the master, otherwise
+    # its bookkeeping writes would give every worker a private copy of those pages
+    gc.freeze()
+
+
+def when_ready(server):
+    # with MELODEX_PROCESS_WORKERS each worker forks its own recommender processes (post_fork),
+    # the ones the master started while loading the catalogue aren't used
+    import flask_app
+    if flask_app.process_executor is not None:
+        flask_app.process_executor.stop()
+
+
+def post_fork(server, worker):
+    # the catalogue watcher thread started in the master doesn't survive the fork
+    import flask_app
+    flask_app.catalogue_manager.start_watching()
+    if flask_app.process_executor is not None:
+        flask_app.process_executor.start(flask_app.catalogue_manager.current)
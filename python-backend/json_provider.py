@@ -0,0 +1,70 @@
+import dataclasses
+
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+
+from request_metrics import stage
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def encode_default(obj):
+    # types neither serializer handles on its own. orjson already encodes numpy scalars and
+    # (contiguous, numeric) arrays natively, this is what's left over plus everything the stdlib needs
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, np.floating):
+        return float(obj)
+    if isinstance(obj, np.bool_):
+        return bool(obj)
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    return DefaultJSONProvider.default(obj)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson (when it is installed) with numpy support built in, so
+    results can contain numpy scalars and arrays (e.g. a column of values) without converting them
+    first. Falls back to the standard json module with the same numpy handling without orjson.
+
+    Unlike json.dumps, NaN and infinity are written as null (valid JSON) with orjson.
+    """
+
+    default = staticmethod(encode_default)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=encode_default, option=self._options()).decode()
+
+    def dumpb(self, obj, indent=False):
+        # bytes straight from the serializer, for responses and streamed lines
+        if orjson is None:
+            return super().dumps(obj, indent=2 if indent else None,
+                                 separators=None if indent else (',', ':')).encode()
+        option = self._options() | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, default=encode_default, option=option)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        with stage('serialize'):
+            body = self.dumpb(obj, indent) + b'\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+    def _options(self):
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
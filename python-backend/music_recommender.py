@@ -1,20 +1,138 @@
+import contextvars
+from contextlib import contextmanager
+
 import numpy as np
 import pandas as pd
-import json
 import random
+from ann_index import ANN_PROBES
+from catalogue_index import (
+    ACTIVITY_FILTERS, MOOD_FEATURES, SCORE_TEMPERATURE, FeatureMasks, RangeScorer, SimilarityIndex, summarise_albums,
+    summarise_artists
+)
+from catalogue_store import load_snapshot, snapshot_is_fresh, snapshot_path_for
+from playlist_engine import PLAYLIST_SIZE, PlaylistEngine
+from request_metrics import stage
+
+
+# Output fields for each kind of result, as (output key, column, cast, default).
+# the default is used when the column is missing from the dataset, None means the column is required
+SONG_FIELDS = [
+    ('track_name', 'track_name', None, None),
+    ('artist', 'artists', None, None),
+    ('album', 'album_name', None, None),
+    ('genre', 'track_genre', None, None),
+    ('popularity', 'popularity', int, None),
+    ('duration_ms', 'duration_ms', int, 180000)
+]
+TRACK_FIELDS = [('track_id', 'track_id', None, None)] + SONG_FIELDS
+RANDOM_SONG_FIELDS = TRACK_FIELDS[:-1] + [('duration_ms', 'duration_ms', int, 0)]
+SIMILAR_SONG_FIELDS = TRACK_FIELDS[:-1] + [
+    ('duration_ms', 'duration_ms', int, None),
+    ('similarity_score', 'similarity_score', float, None)
+]
+
+# what find_similar_songs compares a song against, its genre or the whole catalogue
+SIMILAR_SCOPES = ('genre', 'global')
+PLAYLIST_SONG_FIELDS = [
+    ('track_name', 'track_name', None, None),
+    ('artist', 'artists', None, None),
+    ('duration_ms', 'duration_ms', int, 180000)
+]
+SEARCH_FIELDS = [
+    ('track_id', 'track_id', None, None),
+    ('track_name', 'track_name', None, None),
+    ('artist', 'artists', None, None)
+]
+
+
+# songs converted at a time when results are streamed (stream=True), instead of all at once
+STREAM_CHUNK_SIZE = 100
+
+# set inside rows_only(), see RowResult
+_rows_only = contextvars.ContextVar('rows_only', default=False)
+
+
+class RowResult:
+    """
+    Songs, similar songs or playlists picked by a recommender, as row positions instead of records.
+    Recommenders called inside rows_only() return one of these wherever they would return records,
+    which is small enough to send between processes (see process_executor). records(data) gives what
+    the recommender would have returned.
+    """
+
+    def __init__(self, kind, rows, stream=False, fields=None, lengths=None, scores=None, playlist_name=None):
+        self.kind = kind
+        self.rows = np.asarray(rows, dtype=np.int32)
+        self.stream = stream
+        self.fields = fields
+        self.lengths = lengths
+        self.scores = scores
+        self.playlist_name = playlist_name
+
+    def records(self, data):
+        if self.kind == 'songs':
+            return _songs(data, self.rows, self.fields, self.stream)
+        if self.kind == 'similar':
+            return _similar_songs(data, self.rows, self.scores)
+        playlist_rows = np.split(self.rows, np.cumsum(self.lengths)[:-1]) if len(self.lengths) else []
+        return _playlists(data, playlist_rows, self.playlist_name, self.stream)
+
+
+@contextmanager
+def rows_only():
+    # recommenders called in this block return a RowResult instead of records
+    token = _rows_only.set(True)
+    try:
+        yield
+    finally:
+        _rows_only.reset(token)
+
+
+def to_records(df, fields, rows=None, extra_columns=None):
+    """
+    Turn the rows of df into a list of plain python dicts with the given fields.
+    Each column is selected and cast once for the whole frame instead of row by row.
+
+    With rows only the rows at those positions are converted, taking just the columns needed
+    (much cheaper than df.iloc[rows] for a few rows of a wide frame). extra_columns maps a column
+    name to values for those rows, for columns that aren't in df (e.g. similarity scores).
+    """
+    length = len(df) if rows is None else len(rows)
+    extra_columns = extra_columns or {}
+    keys = []
+    columns = []
+    for key, column, cast, default in fields:
+        keys.append(key)
+        if column not in df.columns and column not in extra_columns and default is not None:
+            columns.append([default] * length)
+            continue
+
+        if column in extra_columns:
+            values = np.asarray(extra_columns[column])
+        elif rows is None:
+            values = df[column].to_numpy()
+        else:
+            values = df[column].array.take(rows).to_numpy()
+        if cast is not None:
+            # same failure as int(nan) would give, rather than numpy's silent garbage value
+            if cast is int and values.dtype.kind == 'f' and np.isnan(values).any():
+                raise ValueError(f'cannot convert float NaN to integer in column {column}')
+            values = values.astype(cast)
+        columns.append(values.tolist())
 
-class NumpyEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        if isinstance(obj, np.floating):
-            return float(obj)
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        return super(NumpyEncoder, self).default(obj)
+    return [dict(zip(keys, values)) for values in zip(*columns)]
 
 
 def load_data(dataset_path):
+    # prefer the binary snapshot written by catalogue_store.build_snapshot when it is up to date,
+    # it is memory-mapped instead of parsed and is already deduplicated
+    snapshot_path = snapshot_path_for(dataset_path)
+    if snapshot_is_fresh(dataset_path, snapshot_path):
+        try:
+            return load_snapshot(snapshot_path)
+        except Exception as e:
+            print(f"Error loading dataset snapshot, falling back to CSV: {e}")
+
     try:
         df = pd.read_csv(dataset_path)
         return df
@@ -23,132 +141,103 @@ def load_data(dataset_path):
         return pd.DataFrame(columns=['track_id', 'track_name', 'album_name', 'artists', 'track_genre', 'popularity'])
 
 
-def recommend_by_mood(data, mood, item_type='song', count=5, genre=None):
-    # mood-specific feature mappings are done 
-    mood_features = {
-        'angry': {
-            'valence': (0.0, 0.3),       
-            'energy': (0.7, 1.0),       
-            'loudness': (-10, 0),       
-            'tempo': (120, 200),        
-            'speechiness': (0.3, 1.0),  
-            'acousticness': (0.0, 0.4)  
-        },
-        'frightened': {
-            'valence': (0.2, 0.5),      
-            'energy': (0.4, 0.6),       
-            'instrumentalness': (0.3, 0.7),
-            'acousticness': (0.5, 0.8), 
-            'tempo': (70, 110),              
-        },
-        'happy': {
-            'valence': (0.7, 1.0),      
-            'energy': (0.6, 0.9),       
-            'danceability': (0.7, 1.0), 
-            'tempo': (110, 160),        
-            'loudness': (-8, 0),        
-            'mode': (1, 1),             
-            'speechiness': (0.0, 0.3)   
-        },
-        'sad': {
-            'valence': (0.3, 0.5),      
-            'energy': (0.3, 0.5),       
-            'acousticness': (0.5, 0.9), 
-            'tempo': (60, 100),                   
-            'instrumentalness': (0.2, 0.5)
-        },
-        'chill': {
-            'valence': (0.4, 0.7),      
-            'energy': (0.2, 0.5),       
-            'acousticness': (0.6, 1.0), 
-            'tempo': (60, 100),         
-            'instrumentalness': (0.3, 0.8),
-            'danceability': (0.3, 0.6), 
-            'loudness': (-20, -7)       
-        },
-    }
+def recommend_by_mood(data, mood, item_type='song', count=5, genre=None, target_duration_ms=None,
+                      max_per_artist=None, ranking='filter', temperature=SCORE_TEMPERATURE, stream=False, index=None,
+                      executor=None):
+    # playlists are built in a worker process when an executor is given (see process_executor)
+    if executor is not None and item_type == 'playlist':
+        return executor.run(recommend_by_mood, data, mood, item_type, count, genre, target_duration_ms,
+                            max_per_artist, ranking, temperature, stream, index=index)
 
-    # Select features for the specific mood and get songs with popularity over 30 only 
-    features = mood_features.get(mood.lower(), mood_features['happy'])
-    mood_data = data[data['popularity'] > 30].copy()
+    # the masks are normally built once at load time, build them for this call if not passed in
+    masks = index.masks if index is not None else FeatureMasks(data)
+    playlist_name = f"{mood.capitalize()} {genre if genre else ''} Mood Playlist"
 
-    # Apply genre filter if specified
-    if genre:
-        mood_data = mood_data[mood_data['track_genre'] == genre]
-        if len(mood_data) == 0:
-            return {'error': f'No {item_type}s found with genre: {genre}'}
-
-    # Apply the mood feature filters
-    for feature, (low, high) in features.items():
-        if feature in mood_data.columns:
-            mood_data = mood_data[mood_data[feature].between(low, high)]
-
-    # If no songs match, then fall back to broader a selection 
-    if len(mood_data) < count:
-        mood_data = data[data['popularity'] > 40]
-        if genre:
-            mood_data = mood_data[mood_data['track_genre'] == genre]
+    if ranking not in ('filter', 'score'):
+        return {'error': 'Invalid ranking. Choose "filter" or "score".'}
 
-            # If still no songs match with the genre, return error
-            if len(mood_data) == 0:
+    # ranking='score' ranks the tracks by their distance to the mood's feature ranges instead
+    # of filtering on them, see _scored_recommendations
+    if ranking == 'score':
+        rows = None
+        if genre:
+            with stage('filter'):
+                rows = masks.genre_rows(genre)
+            if len(rows) == 0:
                 return {'error': f'No {item_type}s found with genre: {genre}'}
+        ranges = MOOD_FEATURES.get(mood.lower(), MOOD_FEATURES['happy'])
+        return _scored_recommendations(data, ranges, item_type, count, rows, temperature, target_duration_ms,
+                                       max_per_artist, playlist_name, stream, index, popular=True)
 
-    # Shuffle the entire mood_data dataframe to ensure randomization
-    mood_data = mood_data.sample(frac=1, random_state=None).reset_index(drop=True)
+    with stage('filter'):
+        mood_rows = _mood_rows(masks, mood, genre, count)
+    if mood_rows is None:
+        return {'error': f'No {item_type}s found with genre: {genre}'}
 
     # If there are still not enough items even after the above conditions, then reduce the count to match available items
-    if len(mood_data) < count:
-        count = len(mood_data)
+    if len(mood_rows) < count:
+        count = len(mood_rows)
 
     if item_type == 'song':
-        # Take the first 'count' songs from the already shuffled dataframe
-        songs_sample = mood_data.head(count)
-        return [{
-            'track_name': row['track_name'],
-            'artist': row['artists'],
-            'album': row['album_name'],
-            'genre': row['track_genre'],
-            'popularity': int(row['popularity']),
-            'duration_ms': int(row.get('duration_ms', 180000))
-        } for _, row in songs_sample.iterrows()]
+        # Take 'count' random songs
+        with stage('sample'):
+            rows = _sample_rows(mood_rows, count)
+        return _songs(data, rows, SONG_FIELDS, stream)
 
     elif item_type == 'playlist':
-        playlists = []
-        for i in range(count):
-            playlist_size = min(10, len(mood_data))
-            if playlist_size == 0:
-                break
-
-            # For each playlist, take a different slice of the shuffled dataframe
-            # This ensures different songs per playlist
-            start_idx = (i * playlist_size) % len(mood_data)
-            if start_idx + playlist_size > len(mood_data):
-                playlist_songs = pd.concat([
-                    mood_data.iloc[start_idx:],
-                    mood_data.iloc[:playlist_size - (len(mood_data) - start_idx)]
-                ])
-            else:
-                playlist_songs = mood_data.iloc[start_idx:start_idx + playlist_size]
-            
-            playlist = {
-                'playlist_name': f"{mood.capitalize()} {genre if genre else ''} Mood Playlist",
-                'total_duration_ms': int(playlist_songs['duration_ms'].sum()),
-                'songs': [{
-                    'track_name': row['track_name'],
-                    'artist': row['artists'],
-                    'duration_ms': int(row.get('duration_ms', 180000))
-                } for _, row in playlist_songs.iterrows()]
-            }
-            playlists.append(playlist)
-        return playlists
+        # draw every playlist from one shuffle of the matching rows, so each playlist gets
+        # different songs (see PlaylistEngine)
+        engine = index.playlists if index is not None else PlaylistEngine(data)
+        with stage('sample'):
+            playlist_rows = engine.generate(mood_rows, count, target_duration_ms=target_duration_ms,
+                                            max_per_artist=max_per_artist)
+        return _playlists(data, playlist_rows, playlist_name, stream)
 
     else:
         return {'error': 'Invalid item type. Choose "song" or "playlist".'}
-    
-def recommend_by_activity(data, activity, item_type='song', count=5):
+
+
+def _mood_rows(masks, mood, genre, count):
+    # rows matching the mood, or None if the genre has no songs
+    # Select the mask for the specific mood (mood feature ranges are in MOOD_FEATURES)
+    # and get songs with popularity over 30 only
+    mood_mask = masks.moods.get(mood.lower(), masks.moods['happy'])
+
+    # Apply genre filter if specified
+    if genre:
+        candidates = masks.genre_rows(genre)
+        candidates = candidates[masks.popular[30][candidates]]
+        if len(candidates) == 0:
+            return None
+        mood_rows = candidates[mood_mask[candidates]]
+    else:
+        mood_rows = np.flatnonzero(masks.popular[30] & mood_mask)
+
+    # If no songs match, then fall back to broader a selection
+    if len(mood_rows) < count:
+        if genre:
+            candidates = masks.genre_rows(genre)
+            mood_rows = candidates[masks.popular[40][candidates]]
+
+            # If still no songs match with the genre, return error
+            if len(mood_rows) == 0:
+                return None
+        else:
+            mood_rows = np.flatnonzero(masks.popular[40])
+
+    return mood_rows
+
+
+def recommend_by_activity(data, activity, item_type='song', count=5, target_duration_ms=None, max_per_artist=None,
+                          ranking='filter', temperature=SCORE_TEMPERATURE, stream=False, index=None, executor=None):
     """
     Recommend songs or playlists based on a specific activity.
+    Playlists are built in a worker process when an executor is given (see process_executor).
     """
+    if executor is not None and item_type == 'playlist':
+        return executor.run(recommend_by_activity, data, activity, item_type, count, target_duration_ms,
+                            max_per_artist, ranking, temperature, stream, index=index)
+
     supported_activities = [
         'workout', 'studying', 'relaxing', 'party',
         'focus', 'commuting', 'meditation', 'cooking'
@@ -157,126 +246,58 @@ def recommend_by_activity(data, activity, item_type='song', count=5):
     if activity not in supported_activities:
         return {'error': f'Unsupported activity. Choose from: {", ".join(supported_activities)}'}
 
-    activity_filters = {
-        'workout': {
-            'energy': (0.7, 1.0), 
-            'tempo': (120, 200), 
-            'danceability': (0.6, 1.0) 
-        },
-        'studying': {
-            'instrumentalness': (0.5, 1.0), 
-            'energy': (0.0, 0.5), 
-            'acousticness': (0.4, 1.0) 
-        },
-        'relaxing': {
-            'energy': (0.0, 0.4), 
-            'valence': (0.3, 0.7), 
-            'acousticness': (0.5, 1.0), 
-            'instrumentalness': (0.3, 1.0) 
-        },
-        'party': {
-            'danceability': (0.7, 1.0), 
-            'energy': (0.7, 1.0), 
-            'valence': (0.6, 1.0) 
-        },
-        'commuting': {
-            'energy': (0.4, 0.8), 
-            'danceability': (0.4, 0.7), 
-            'instrumentalness': (0.2, 0.6) 
-        },
-        'meditation': {
-            'energy': (0.0, 0.3), 
-            'instrumentalness': (0.6, 1.0), 
-            'acousticness': (0.6, 1.0), 
-            'valence': (0.3, 0.7) 
-        },
-        'cooking': {
-            'danceability': (0.5, 0.9), 
-            'energy': (0.4, 0.7), 
-            'valence': (0.5, 0.9) 
-        }
-    }
-
     # check for the required columns
-    required_columns = list(set([col for filter_dict in activity_filters.values() for col in filter_dict.keys()]))
+    required_columns = list(set([col for filter_dict in ACTIVITY_FILTERS.values() for col in filter_dict.keys()]))
     missing_columns = [col for col in required_columns if col not in data.columns]
 
     if missing_columns:
         return {'error': f'Missing columns in dataset: {", ".join(missing_columns)}'}
 
-    if item_type == 'song':
-        # apply the activity-specific filters made previously 
-        filters = activity_filters[activity]
-
-        # make the filter conditions
-        song_conditions = [
-            data[col].between(min_val, max_val) if isinstance(min_val, (int, float)) else True
-            for col, (min_val, max_val) in filters.items()
-        ]
-
-        # combine all the conditions
-        songs = data[
-            (song_conditions[0]) &
-            (song_conditions[1] if len(song_conditions) > 1 else True) &
-            (song_conditions[2] if len(song_conditions) > 2 else True)
-            ]
-
-        # if there are no songs after filtering, fall back to general sampling
-        if len(songs) == 0:
-            songs = data
+    if ranking not in ('filter', 'score'):
+        return {'error': 'Invalid ranking. Choose "filter" or "score".'}
 
-        # sample the songs
-        songs_sample = songs.sample(min(count, len(songs)))
+    # ranking='score' ranks the tracks by their distance to all of the activity's feature ranges
+    # instead of filtering on the first three, see _scored_recommendations
+    if ranking == 'score':
+        return _scored_recommendations(data, ACTIVITY_FILTERS[activity], item_type, count, None, temperature,
+                                       target_duration_ms, max_per_artist, f"{activity.capitalize()} Vibes Playlist",
+                                       stream, index)
+
+    # the masks are normally built once at load time, build them for this call if not passed in
+    masks = index.masks if index is not None else FeatureMasks(data)
 
-        return [{
-            'track_name': row['track_name'],
-            'artist': row['artists'],
-            'album': row['album_name'],
-            'genre': row['track_genre'],
-            'popularity': int(row['popularity']),
-            'duration_ms': int(row.get('duration_ms', 180000))
-        } for _, row in songs_sample.iterrows()]
+    # the songs matching the activity-specific filters (ranges are in ACTIVITY_FILTERS)
+    with stage('filter'):
+        songs = np.flatnonzero(masks.activities[activity])
+
+    # if there are no songs after filtering, fall back to general sampling
+    if len(songs) == 0:
+        songs = np.arange(len(data))
+
+    if item_type == 'song':
+        # sample the songs
+        with stage('sample'):
+            rows = _sample_rows(songs, min(count, len(songs)))
+        return _songs(data, rows, SONG_FIELDS, stream)
 
     elif item_type == 'playlist':
-        playlists = []
-        for _ in range(count):
-    
-            filters = activity_filters[activity]
-            song_conditions = [
-                data[col].between(min_val, max_val) if isinstance(min_val, (int, float)) else True
-                for col, (min_val, max_val) in filters.items()
-            ]
-
-            songs = data[
-                (song_conditions[0]) &
-                (song_conditions[1] if len(song_conditions) > 1 else True) &
-                (song_conditions[2] if len(song_conditions) > 2 else True)
-                ]
-
-            if len(songs) == 0:
-                songs = data
-
-            playlist_songs = songs.sample(min(10, len(songs)))
-
-            playlist = {
-                'playlist_name': f"{activity.capitalize()} Vibes Playlist",
-                'total_duration_ms': int(playlist_songs['duration_ms'].sum()),
-                'songs': [{
-                    'track_name': row['track_name'],
-                    'artist': row['artists'],
-                    'duration_ms': int(row.get('duration_ms', 180000))
-                } for _, row in playlist_songs.iterrows()]
-            }
-            playlists.append(playlist)
-
-        return playlists
+        # all the playlists come from one shuffle of the songs, so songs don't repeat across them
+        engine = index.playlists if index is not None else PlaylistEngine(data)
+        with stage('sample'):
+            playlist_rows = engine.generate(songs, count, target_duration_ms=target_duration_ms,
+                                            max_per_artist=max_per_artist)
+        return _playlists(data, playlist_rows, f"{activity.capitalize()} Vibes Playlist", stream)
 
     else:
         return {'error': 'Invalid item type. Choose "song" or "playlist".'}
 
-def random_recommendations(data, item_type, genre=None, count=1):
+def random_recommendations(data, item_type, genre=None, count=1, stream=False, index=None):
     if genre:
-        filtered_data = data[data['track_genre'] == genre]
+        with stage('filter'):
+            if index is not None:
+                filtered_data = data.iloc[index.masks.genre_rows(genre)]
+            else:
+                filtered_data = data[data['track_genre'] == genre]
         if filtered_data.empty:
             return {'error': f'No items found with genre: {genre}'}
     else:
@@ -289,90 +310,188 @@ def random_recommendations(data, item_type, genre=None, count=1):
         count = len(filtered_data)
 
     if item_type == 'song':
-        sampled = filtered_data.sample(count)
-        return [{
-            'track_id': row['track_id'],
-            'track_name': row['track_name'],
-            'artist': row['artists'],
-            'album': row['album_name'],
-            'genre': row['track_genre'],
-            'popularity': int(row['popularity']),
-            'duration_ms': int(row.get('duration_ms', 0))
-        } for _, row in sampled.iterrows()]
-
-    elif item_type == 'album':
-        albums = filtered_data['album_name'].unique()
-        if len(albums) > count:
-            albums = np.random.choice(albums, count, replace=False)
-        else:
-            albums = albums[:count]
-
-        return [{
-            'album_name': album,
-            'artist': filtered_data[filtered_data['album_name'] == album]['artists'].iloc[0],
-            'tracks': int(len(filtered_data[filtered_data['album_name'] == album])),
-            'genres': filtered_data[filtered_data['album_name'] == album]['track_genre'].unique().tolist()
-        } for album in albums]
-
-    elif item_type == 'artist':
-        artists = filtered_data['artists'].unique()
-        if len(artists) > count:
-            artists = np.random.choice(artists, count, replace=False)
+        # the same draw filtered_data.sample(count) makes
+        with stage('sample'):
+            rows = _sample_rows(np.arange(len(filtered_data)), count)
+        return _songs(filtered_data, rows, RANDOM_SONG_FIELDS, stream)
+
+    elif item_type in ('album', 'artist'):
+        # the album and artist summaries are normally built once at load time (for the whole catalogue
+        # and per genre), summarise the filtered data for this call if not passed in
+        if index is not None:
+            summaries = index.groups.albums if item_type == 'album' else index.groups.artists
+            names, records = summaries[genre or None]
+        elif item_type == 'album':
+            names, records = summarise_albums(filtered_data)
         else:
-            artists = artists[:count]
+            names, records = summarise_artists(filtered_data)
 
-        return [{
-            'artist': artist,
-            'tracks': int(len(filtered_data[filtered_data['artists'] == artist])),
-            'albums': filtered_data[filtered_data['artists'] == artist]['album_name'].unique().tolist(),
-            'genres': filtered_data[filtered_data['artists'] == artist]['track_genre'].unique().tolist()
-        } for artist in artists]
+        with stage('sample'):
+            if len(names) > count:
+                chosen = np.random.choice(len(names), count, replace=False)
+            else:
+                chosen = range(min(count, len(names)))
+
+        albums_or_artists = (dict(records[i]) for i in chosen)
+        return albums_or_artists if stream else list(albums_or_artists)
 
     elif item_type == 'playlist':
-        playlists = []
-        for i in range(count):
-            playlist_size = np.random.randint(5, 15) 
-            playlist_songs = filtered_data.sample(min(playlist_size, len(filtered_data)))
-            playlist = {
-                'playlist_name': f"Random Playlist {i + 1}",
-                'total_duration_ms': int(playlist_songs[
-                                             'duration_ms'].sum() if 'duration_ms' in playlist_songs.columns else 0),
-                'songs': [{
-                    'track_name': row['track_name'],
-                    'artist': row['artists'],
-                    'duration_ms': int(row.get('duration_ms', 180000))
-                } for _, row in playlist_songs.iterrows()]
-            }
-            playlists.append(playlist)
-        return playlists
+        # streamed playlists are drawn one at a time as they are sent
+        playlists = _random_playlists(filtered_data, count)
+        return playlists if stream else list(playlists)
 
     else:
         return {'error': f'Invalid item type: {item_type}'}
 
 
-def search_songs(data, query):
-    results = data[
-        data['track_name'].str.contains(query, case=False, na=False) |
-        data['artists'].str.contains(query, case=False, na=False)
-        ]
+def search_songs(data, query, index=None, limit=10):
+    # the query is always matched as plain text, never as a regex.
+    # results are ranked exact match > prefix match > substring match, then by popularity
+    with stage('filter'):
+        if index is not None:
+            positions = index.search.search(query, limit)
+        else:
+            positions = _scan_search(data, query, limit)
+
+    with stage('serialize'):
+        return to_records(data, SEARCH_FIELDS, positions)
+
+
+def _scan_search(data, query, limit=10):
+    # same ranking as the prebuilt search index, but by scanning both name columns
+    query = query.lower()
+    names = data['track_name'].str.lower()
+    artists = data['artists'].str.lower()
+
+    matches = (names.str.contains(query, regex=False, na=False) |
+               artists.str.contains(query, regex=False, na=False)).to_numpy()
+    exact = (names.eq(query) | artists.eq(query)).to_numpy()
+    prefix = (names.str.startswith(query, na=False) | artists.str.startswith(query, na=False)).to_numpy()
 
-    # limit the results to the top 10
-    results = results.head(10)
+    tier = np.where(exact, 0, np.where(prefix, 1, 2))
+    popularity = data['popularity'].fillna(0).to_numpy() if 'popularity' in data.columns else np.zeros(len(data))
+
+    positions = np.flatnonzero(matches)
+    ranked = np.lexsort((positions, -popularity[positions], tier[positions]))
+    return positions[ranked][:limit]
+
+
+def _sample_rows(rows, size):
+    # random selection of `size` row positions without replacement, drawn the same way DataFrame.sample does
+    return rows[np.random.choice(len(rows), size=size, replace=False)]
+
+
+def _scored_recommendations(data, ranges, item_type, count, rows, temperature, target_duration_ms, max_per_artist,
+                            playlist_name, stream=False, index=None, popular=False):
+    """
+    Songs or playlists from a single ranked pass over the tracks (or just rows), by weighted distance
+    to the feature ranges and sampled with the temperature. Tracks just outside a range rank close
+    behind the ones inside it, so there is no cut-off to fall back from. popular pushes unpopular
+    tracks down (the moods), see RangeScorer.distances.
+    """
+    scorer = index.scorer if index is not None else RangeScorer(data)
+
+    if item_type == 'song':
+        with stage('score'):
+            ranked = scorer.rank(ranges, count, rows, temperature, popular)
+        return _songs(data, ranked, SONG_FIELDS, stream)
+
+    elif item_type == 'playlist':
+        # playlists are drawn from the best tracks, twice as many as they can take
+        engine = index.playlists if index is not None else PlaylistEngine(data)
+        with stage('score'):
+            pool = scorer.rank(ranges, 2 * count * engine.playlist_length(target_duration_ms), rows, temperature,
+                               popular)
+        with stage('sample'):
+            playlist_rows = engine.generate(pool, count, target_duration_ms=target_duration_ms,
+                                            max_per_artist=max_per_artist)
+        return _playlists(data, playlist_rows, playlist_name, stream)
+
+    else:
+        return {'error': 'Invalid item type. Choose "song" or "playlist".'}
+
+
+def _random_playlists(data, count):
+    for i in range(count):
+        playlist_size = np.random.randint(5, 15) 
+        playlist_songs = data.sample(min(playlist_size, len(data)))
+        yield {
+            'playlist_name': f"Random Playlist {i + 1}",
+            'total_duration_ms': int(playlist_songs[
+                                         'duration_ms'].sum() if 'duration_ms' in playlist_songs.columns else 0),
+            'songs': to_records(playlist_songs, PLAYLIST_SONG_FIELDS)
+        }
+
+
+def _songs(data, rows, fields, stream=False):
+    # records of the songs at rows, with stream a generator converting STREAM_CHUNK_SIZE songs at a time
+    if _rows_only.get():
+        return RowResult('songs', rows, stream, fields=fields)
+    if stream:
+        return _in_chunks(rows, STREAM_CHUNK_SIZE, lambda chunk: to_records(data, fields, chunk))
+    with stage('serialize'):
+        return to_records(data, fields, rows)
+
+
+def _in_chunks(items, chunk_size, convert):
+    for start in range(0, len(items), chunk_size):
+        yield from convert(items[start:start + chunk_size])
+
+
+def _playlists(data, playlist_rows, playlist_name, stream=False):
+    # the songs of every playlist are looked up and converted together, then split back up.
+    # with stream a generator doing that for STREAM_CHUNK_SIZE songs worth of playlists at a time
+    if _rows_only.get():
+        rows = np.concatenate(playlist_rows) if playlist_rows else []
+        return RowResult('playlists', rows, stream, lengths=[len(playlist) for playlist in playlist_rows],
+                         playlist_name=playlist_name)
+    if stream:
+        per_chunk = max(1, STREAM_CHUNK_SIZE // PLAYLIST_SIZE)
+        return _in_chunks(playlist_rows, per_chunk, lambda chunk: _playlists(data, chunk, playlist_name))
+    if not playlist_rows:
+        return []
+    with stage('serialize'):
+        return _playlist_records(data, playlist_rows, playlist_name)
+
+
+def _playlist_records(data, playlist_rows, playlist_name):
+    rows = np.concatenate(playlist_rows)
+    songs = to_records(data, PLAYLIST_SONG_FIELDS, rows)
+    starts = np.cumsum([0] + [len(playlist) for playlist in playlist_rows])
+    durations = np.add.reduceat(np.nan_to_num(data['duration_ms'].to_numpy(dtype=np.float64)[rows]), starts[:-1])
 
     return [{
-        'track_id': row['track_id'],
-        'track_name': row['track_name'],
-        'artist': row['artists']
-    } for _, row in results.iterrows()]
+        'playlist_name': playlist_name,
+        'total_duration_ms': int(duration),
+        'songs': songs[start:stop]
+    } for start, stop, duration in zip(starts[:-1], starts[1:], durations)]
+
 
+def _track_position(data, track_id, index=None):
+    # row position of the first song with this track_id, or None if there isn't one.
+    # goes through the prebuilt hash index when available, otherwise scans the track_id column
+    if index is not None:
+        return index.tracks.position(track_id)
 
-def get_song_analysis(data, track_id):
-    song = data[data['track_id'] == track_id]
+    matches = np.flatnonzero((data['track_id'] == track_id).to_numpy())
+    return matches[0] if len(matches) else None
 
-    if song.empty:
+
+def _as_float(value):
+    # float32 columns from a snapshot go through their shortest repr, so 0.7 comes out as 0.7
+    # rather than 0.699999988079071
+    if isinstance(value, np.float32):
+        return float(str(value))
+    return float(value)
+
+
+def get_song_analysis(data, track_id, index=None):
+    position = _track_position(data, track_id, index)
+
+    if position is None:
         return {'error': f'Song with track_id {track_id} not found'}
 
-    song = song.iloc[0]
+    song = index.tracks.record(position) if index is not None else data.iloc[position]
 
     return {
         'track_id': song['track_id'],
@@ -383,17 +502,17 @@ def get_song_analysis(data, track_id):
         'popularity': int(song['popularity']),
         'duration_ms': int(song.get('duration_ms', 180000)),
         'explicit': bool(song.get('explicit', False)),
-        'danceability': float(song.get('danceability', 0.0)),
-        'energy': float(song.get('energy', 0.0)),
+        'danceability': _as_float(song.get('danceability', 0.0)),
+        'energy': _as_float(song.get('energy', 0.0)),
         'key': int(song.get('key', 0)),
-        'loudness': float(song.get('loudness', 0.0)),
+        'loudness': _as_float(song.get('loudness', 0.0)),
         'mode': int(song.get('mode', 0)),
-        'speechiness': float(song.get('speechiness', 0.0)),
-        'acousticness': float(song.get('acousticness', 0.0)),
-        'instrumentalness': float(song.get('instrumentalness', 0.0)),
-        'liveness': float(song.get('liveness', 0.0)),
-        'valence': float(song.get('valence', 0.0)),
-        'tempo': float(song.get('tempo', 0.0)),
+        'speechiness': _as_float(song.get('speechiness', 0.0)),
+        'acousticness': _as_float(song.get('acousticness', 0.0)),
+        'instrumentalness': _as_float(song.get('instrumentalness', 0.0)),
+        'liveness': _as_float(song.get('liveness', 0.0)),
+        'valence': _as_float(song.get('valence', 0.0)),
+        'tempo': _as_float(song.get('tempo', 0.0)),
         'track_genre': song['track_genre']
     }
 
@@ -411,113 +530,137 @@ def find_obscure_songs(data, genre=None, popularity_threshold=30, count=5):
     # Sample random songs matching criteria
     sampled = filtered_data.sample(min(count, len(filtered_data)))
 
-    return [{
-        'track_id': row['track_id'],
-        'track_name': row['track_name'],
-        'artist': row['artists'],
-        'album': row['album_name'],
-        'genre': row['track_genre'],
-        'popularity': int(row['popularity']),
-        'duration_ms': int(row.get('duration_ms', 180000))
-    } for _, row in sampled.iterrows()]
-
-
-def find_similar_songs(data, track_id, count=5):
-    reference_song = data[data['track_id'] == track_id]
-    if reference_song.empty:
+    return to_records(sampled, TRACK_FIELDS)
+
+
+def find_similar_songs(data, track_id, count=5, scope='genre', probes=ANN_PROBES, index=None, executor=None):
+    """
+    The `count` songs most similar to track_id. scope 'genre' compares against the songs of its genre,
+    'global' against the whole catalogue through the approximate index (index.ann), searching
+    `probes` of its lists (more is slower but misses fewer of the closest songs).
+    """
+    # scored in a worker process when an executor is given (see process_executor), unless the
+    # precomputed table has them and there's nothing to score
+    if executor is not None and not _in_similar_table(data, track_id, count, scope, index):
+        return executor.run(find_similar_songs, data, track_id, count, scope, probes, index=index)
+
+    if scope not in SIMILAR_SCOPES:
+        return {'error': f'Invalid scope: {scope}. Choose from {", ".join(SIMILAR_SCOPES)}'}
+
+    reference_position = _track_position(data, track_id, index)
+    if reference_position is None:
         return {"error": "Reference song not found"}
-    
-    # get the songs genre and filter the data to include songs from that genre 
+
+    # the feature matrix is normally built once at load time, build one for this call if not passed in
+    similarity_index = index.similarity if index is not None else SimilarityIndex(data)
+    if similarity_index.missing_columns:
+        return {'error': f'Missing columns in dataset: {", ".join(similarity_index.missing_columns)}'}
+
+    if scope == 'global':
+        # songs without a genre aren't in the feature matrix
+        if similarity_index.columns[reference_position] < 0:
+            return {"error": "Reference song has no genre to compare by"}
+        with stage('score'):
+            if index is not None and index.ann is not None:
+                positions, scores = index.ann.nearest(reference_position, count, probes, exclude_track_id=track_id)
+            else:
+                # no approximate index built for this data, scan everything
+                positions, scores = similarity_index.nearest_global(reference_position, count,
+                                                                    exclude_track_id=track_id)
+        return _similar_songs(data, positions, scores)
+
+    # get the songs genre and only compare against songs from that genre
     # (this allows for more accurate recommendations)
-    reference_genre = reference_song['track_genre'].iloc[0]
-    genre_data = data[data['track_genre'] == reference_genre]
+    reference_genre = data['track_genre'].iloc[reference_position]
 
     # if not enough songs in that genre, then return error
-    if len(genre_data) <= 1:  
+    if similarity_index.genre_size(reference_genre) <= 1:
         return {"error": f"Not enough songs in the {reference_genre} genre for comparison"}
 
-    
-    reference_features = reference_song[['danceability', 'energy', 'key', 'loudness',
-                                         'speechiness', 'acousticness', 'instrumentalness',
-                                         'liveness', 'valence', 'tempo']].iloc[0]
-
-    # calculate euclidean distance for all the songs in the same genre for recommendation
-    # a copy is made to avoid modifying the original df
-    working_data = genre_data.copy()
-
-    # Weights are defined for finding similar songs,
-    # a value is assigned between 0 and 1, 
-    # the higher the value the more the importance of that attribute and vice versa
-    weights = {
-        'danceability': 1.0,
-        'energy': 1.0,
-        'key': 0.5,  # Less weight for key since it has less impact than other features 
-        'loudness': 0.8,
-        'speechiness': 0.8,
-        'acousticness': 1.0,
-        'instrumentalness': 0.9,
-        'liveness': 0.6, # same as key, less impact
-        'valence': 1.0,  
-        'tempo': 0.7
-    }
+    # weighted distance to every song in the genre, excluding the reference song itself,
+    # and take the top 'count' number of results (count is the amount of songs requested by the user).
+    # the precomputed table has the same songs when it covers this one
+    with stage('score'):
+        positions = _similar_from_table(index, reference_position, reference_genre, count)
+        if positions is not None:
+            scores = similarity_index.scores_of(reference_position, positions)
+        else:
+            positions, scores = similarity_index.nearest_in_genre(reference_position, count,
+                                                                  exclude_track_id=track_id)
+
+    return _similar_songs(data, positions, scores)
+
+
+def _in_similar_table(data, track_id, count, scope, index):
+    # whether find_similar_songs can take the songs from index.similar_table
+    if scope != 'genre' or index is None or index.similar_table is None:
+        return False
+    position = index.tracks.position(track_id)
+    return (position is not None and
+            _similar_from_table(index, position, data['track_genre'].iloc[position], count) is not None)
+
 
-    # normalise the features for better comparison
-    features = ['danceability', 'energy', 'speechiness', 'acousticness',
-                'instrumentalness', 'liveness', 'valence']
-    
-    
-    # normalise key (0-11)
-    working_data['key_norm'] = (working_data['key'] - reference_features['key']).abs() / 11
-
-    # normalise the loudness (its usually between -60 and 0)
-    max_loudness_diff = 60  # Maximum possible difference
-    working_data['loudness_norm'] = (working_data['loudness'] - reference_features[
-        'loudness']).abs() / max_loudness_diff
-
-    # normalise tempo 
-    max_tempo_diff = 150  # A reasonable maximum
-    working_data['tempo_norm'] = (working_data['tempo'] - reference_features['tempo']).abs() / max_tempo_diff
-
-    # calculate the normalised differences for standard features (0-1 scale)
-    for feature in features:
-        working_data[f'{feature}_diff'] = (working_data[feature] - reference_features[feature]).abs()
-
-    # calculate weighted similarity score
-    similarity_score = (
-            weights['danceability'] * working_data['danceability_diff'] +
-            weights['energy'] * working_data['energy_diff'] +
-            weights['key'] * working_data['key_norm'] +
-            weights['loudness'] * working_data['loudness_norm'] +
-            weights['speechiness'] * working_data['speechiness_diff'] +
-            weights['acousticness'] * working_data['acousticness_diff'] +
-            weights['instrumentalness'] * working_data['instrumentalness_diff'] +
-            weights['liveness'] * working_data['liveness_diff'] +
-            weights['valence'] * working_data['valence_diff'] +
-            weights['tempo'] * working_data['tempo_norm']
-    )
-
-    # convert to similarity (lower distance = higher similarity)
-    working_data['similarity_score'] = 1 / (1 + similarity_score)
-
-    # exclude the reference song itself
-    similar_songs = working_data[working_data['track_id'] != track_id]
-
-    # Sort by similarity score, highest sim first 
-    similar_songs = similar_songs.sort_values('similarity_score', ascending=False)
-
-    # Take the top 'count' number of results (count is the amount of songs requested by the user)
-    top_similar = similar_songs.head(count)
-    results = []
-    for _, song in top_similar.iterrows():
-        results.append({
-            'track_id': song['track_id'],
-            'track_name': song['track_name'],
-            'artist': song['artists'],
-            'album': song['album_name'],
-            'genre': song['track_genre'],
-            'popularity': int(song['popularity']),
-            'duration_ms': int(song['duration_ms']),
-            'similarity_score': float(song['similarity_score'])
-        })
-
-    return results
\ No newline at end of file
+def _similar_from_table(index, position, genre, count):
+    # the similar songs from index.similar_table (see similar_table), None if there isn't one covering them
+    if index is None or index.similar_table is None:
+        return None
+    return index.similar_table.nearest(position, genre, count)
+
+
+def _similar_songs(data, positions, scores):
+    if _rows_only.get():
+        return RowResult('similar', positions, scores=scores)
+    with stage('serialize'):
+        return to_records(data, SIMILAR_SONG_FIELDS, positions, {'similarity_score': scores})
+
+
+def find_similar_songs_batch(data, queries, index=None):
+    """
+    find_similar_songs for a list of (track_id, count) queries, returning one result per query
+    (the songs, or an {'error': ...} dict). Queries from the same genre are scored together.
+    """
+    similarity_index = index.similarity if index is not None else SimilarityIndex(data)
+    if similarity_index.missing_columns:
+        error = {'error': f'Missing columns in dataset: {", ".join(similarity_index.missing_columns)}'}
+        return [error] * len(queries)
+
+    results = [None] * len(queries)
+    pending = []
+    for i, (track_id, count) in enumerate(queries):
+        position = _track_position(data, track_id, index)
+        if position is None:
+            results[i] = {"error": "Reference song not found"}
+            continue
+        reference_genre = data['track_genre'].iloc[position]
+        if similarity_index.genre_size(reference_genre) <= 1:
+            results[i] = {"error": f"Not enough songs in the {reference_genre} genre for comparison"}
+            continue
+        pending.append((i, position, track_id, count))
+
+    if pending:
+        indices, positions, track_ids, counts = zip(*pending)
+        with stage('score'):
+            # queries the precomputed table covers are taken from it, the rest are scored together
+            nearest = [None] * len(pending)
+            for j, (position, count) in enumerate(zip(positions, counts)):
+                found = _similar_from_table(index, position, data['track_genre'].iloc[position], count)
+                if found is not None:
+                    nearest[j] = found, similarity_index.scores_of(position, found)
+            missing = [j for j, found in enumerate(nearest) if found is None]
+            if missing:
+                computed = similarity_index.nearest_in_genre_batch(
+                    [positions[j] for j in missing], [counts[j] for j in missing],
+                    exclude_track_ids=[track_ids[j] for j in missing])
+                for j, found in zip(missing, computed):
+                    nearest[j] = found
+
+        # the songs of every query are looked up and converted together, then split back up
+        similar_positions, scores = zip(*nearest)
+        with stage('serialize'):
+            songs = to_records(data, SIMILAR_SONG_FIELDS, np.concatenate(similar_positions),
+                               {'similarity_score': np.concatenate(scores)})
+        starts = np.cumsum([0] + [len(found) for found in similar_positions])
+        for i, start, stop in zip(indices, starts[:-1], starts[1:]):
+            results[i] = songs[start:stop]
+
+    return results
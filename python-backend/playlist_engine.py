@@ -0,0 +1,141 @@
+import copy
+
+import numpy as np
+import pandas as pd
+
+# songs in a playlist when no target duration is asked for
+PLAYLIST_SIZE = 10
+
+# most songs a target duration playlist can have
+MAX_PLAYLIST_SIZE = 200
+
+# used for songs without a duration, the same default the playlist output uses
+DEFAULT_DURATION_MS = 180000
+
+
+class PlaylistEngine:
+    """
+    Builds playlists out of candidate row positions. All the playlists asked for are drawn
+    together from a single shuffle of the candidates, so a song is only used again in another
+    playlist once every candidate has been used.
+    """
+
+    def __init__(self, data):
+        if 'duration_ms' in data.columns:
+            durations = data['duration_ms'].to_numpy(dtype=np.float64)
+            self.durations = np.nan_to_num(durations, nan=DEFAULT_DURATION_MS)
+        else:
+            self.durations = np.full(len(data), DEFAULT_DURATION_MS, dtype=np.float64)
+        self.typical_duration = np.median(self.durations) if len(data) else DEFAULT_DURATION_MS
+
+        # songs by the same artists string get the same code
+        if 'artists' in data.columns:
+            self.artist_codes, self.artists = pd.factorize(data['artists'], use_na_sentinel=False)
+        else:
+            self.artist_codes, self.artists = np.arange(len(data)), None
+
+    def upsert(self, data, rows):
+        # the engine for data, where the songs at rows were updated or added since this one was built
+        updated = copy.copy(self)
+        part = data.iloc[rows]
+        updated.durations = np.empty(len(data), dtype=np.float64)
+        updated.durations[:len(self.durations)] = self.durations
+        updated.durations[rows] = PlaylistEngine(part).durations
+        updated.typical_duration = np.median(updated.durations) if len(data) else DEFAULT_DURATION_MS
+
+        updated.artist_codes = np.empty(len(data), dtype=np.int64)
+        updated.artist_codes[:len(self.artist_codes)] = self.artist_codes
+        if self.artists is None:
+            updated.artist_codes[rows] = rows
+        else:
+            # artists seen for the first time get the next codes
+            names = pd.Index(part['artists'].to_numpy(dtype=object))
+            updated.artists = self.artists.append(names[self.artists.get_indexer(names) < 0].unique())
+            updated.artist_codes[rows] = updated.artists.get_indexer(names)
+        return updated
+
+    def generate(self, rows, count, size=PLAYLIST_SIZE, target_duration_ms=None, max_per_artist=None):
+        """
+        Draw `count` playlists from the row positions in rows, as a list of row position arrays.
+
+        With target_duration_ms a playlist gets songs until its total duration reaches the target
+        instead of `size` songs. With max_per_artist no playlist has more than that many songs by
+        one artist and songs are never reused, so playlists can come out shorter (or be left out)
+        when there aren't enough candidates.
+        """
+        rows = np.asarray(rows)
+        if count <= 0 or len(rows) == 0:
+            return []
+
+        # one shuffle of all the candidates, drawn the same way DataFrame.sample does
+        order = rows[np.random.choice(len(rows), size=len(rows), replace=False)]
+
+        if target_duration_ms:
+            # room for an even share of the candidates at most, trimmed to the target below
+            slots = min(self.playlist_length(target_duration_ms), max(1, len(order) // count))
+        else:
+            slots = min(size, len(order))
+
+        if max_per_artist:
+            grid = self._diverse_grid(order, count, slots, max_per_artist)
+        else:
+            # consecutive slices of the shuffled candidates, wrapping around at the end
+            grid = np.take(order, np.arange(count * slots), mode='wrap').reshape(count, slots)
+
+        filled = grid >= 0
+        if target_duration_ms:
+            durations = np.where(filled, self.durations[grid], 0)
+            # a song is kept if the playlist is still short of the target when it starts
+            starts = np.cumsum(durations, axis=1) - durations
+            filled &= starts < target_duration_ms
+
+        # the filled slots of each row always come first
+        lengths = filled.sum(axis=1)
+        return [grid[i, :length] for i, length in enumerate(lengths) if length]
+
+    def playlist_length(self, target_duration_ms=None, size=PLAYLIST_SIZE):
+        # songs a playlist can take, for a target duration about twice what a typical one needs
+        if not target_duration_ms:
+            return size
+        return min(MAX_PLAYLIST_SIZE, int(np.ceil(2 * target_duration_ms / max(self.typical_duration, 1))) + 1)
+
+    def _diverse_grid(self, order, count, slots, max_per_artist):
+        # (count, slots) grid of row positions, -1 where a playlist ran out of songs.
+        # only a prefix of the shuffled candidates is looked at unless that leaves playlists short
+        limit = min(len(order), 4 * count * slots)
+        grid = self._assign(order[:limit], count, slots, max_per_artist)
+        if limit < len(order) and (grid < 0).any():
+            grid = self._assign(order, count, slots, max_per_artist)
+        return grid
+
+    def _assign(self, order, count, slots, max_per_artist):
+        # each artist's songs go max_per_artist at a time to consecutive playlists, starting
+        # from a playlist picked by when the artist first shows up so artists are spread evenly
+        artists = self.artist_codes[order]
+        by_artist = np.argsort(artists, kind='stable')
+        new_artist = np.r_[True, artists[by_artist][1:] != artists[by_artist][:-1]]
+        artist_starts = np.flatnonzero(new_artist)
+
+        # for every song its artist (numbered by first appearance) and how many songs by
+        # that artist came before it
+        artist_rank = np.empty(len(artist_starts), dtype=np.int64)
+        artist_rank[np.argsort(by_artist[artist_starts])] = np.arange(len(artist_starts))
+        group = np.cumsum(new_artist) - 1
+        artist = np.empty(len(order), dtype=np.int64)
+        artist[by_artist] = artist_rank[group]
+        occurrence = np.empty(len(order), dtype=np.int64)
+        occurrence[by_artist] = np.arange(len(order)) - artist_starts[group]
+
+        # songs past max_per_artist in every playlist are left out
+        positions = np.flatnonzero(occurrence < max_per_artist * count)
+        playlist = (artist[positions] + occurrence[positions] // max_per_artist) % count
+
+        # songs of each playlist in shuffled order, the first `slots` of them are used
+        by_playlist = np.lexsort((positions, playlist))
+        positions, playlist = positions[by_playlist], playlist[by_playlist]
+        slot = np.arange(len(positions)) - np.searchsorted(playlist, playlist)
+        used = slot < slots
+
+        grid = np.full((count, slots), -1, dtype=np.int64)
+        grid[playlist[used], slot[used]] = order[positions[used]]
+        return grid
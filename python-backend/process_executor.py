@@ -0,0 +1,109 @@
+import multiprocessing
+import os
+import threading
+
+import numpy as np
+
+from music_recommender import RowResult, rows_only
+from request_metrics import stage
+
+# the catalogue the worker processes were forked with
+_worker_catalogue = None
+
+# seconds an old pool is kept after a new one is started, for calls that picked it just before
+RETIRE_AFTER = 30.0
+
+# seconds a call waits for a worker before giving up on it and running here instead
+CALL_TIMEOUT = float(os.environ.get('MELODEX_PROCESS_TIMEOUT', 10))
+
+
+def _start_worker():
+    # forked workers start with the parent's random state, so they'd all draw the same songs
+    np.random.seed()
+
+
+def _run(function, args, kwargs):
+    catalogue = _worker_catalogue
+    with rows_only():
+        return function(catalogue.data, *args, index=catalogue.index, **kwargs)
+
+
+class ProcessExecutor:
+    """
+    Runs recommender calls in a pool of worker processes forked from this one, so CPU bound calls
+    use more than one core. The workers already hold the catalogue and its indexes (shared with
+    this process copy-on-write, and through the page cache for a snapshot). Only the arguments and
+    the picked row positions are sent between processes (see music_recommender.RowResult); the
+    records are built here.
+
+    A new pool is forked for every fully loaded catalogue with start(), calls for catalogues with
+    deltas ingested since then run in this process. A call a worker doesn't answer within CALL_TIMEOUT
+    runs here too. This needs the fork start method, so on Windows calls always run in this process.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        # (pool, the catalogue it holds, pid of the process that forked it), replaced as a whole so
+        # a call never pairs one catalogue's data with a pool holding another
+        self.current = None
+        self.stopped_pid = None
+        self.lock = threading.Lock()
+
+    def start(self, catalogue):
+        """
+        Forks a new pool holding catalogue, the old one finishes the calls it already has. Only fully
+        loaded catalogues get a pool: forking for every ingested delta would start processes far too
+        often (and from threads that may hold locks), calls for those run here until the next reload.
+        """
+        global _worker_catalogue
+        if 'fork' not in multiprocessing.get_all_start_methods() or self.stopped_pid == os.getpid():
+            return
+        with self.lock:
+            old_pool = self._own_pool()
+            # the same data (e.g. with a similar songs table attached) is still served by the workers
+            if old_pool is not None and (catalogue.incremental or catalogue.data is self.current[1].data):
+                return
+            _worker_catalogue = catalogue
+            pool = multiprocessing.get_context('fork').Pool(self.processes, initializer=_start_worker)
+            self.current = (pool, catalogue, os.getpid())
+        if old_pool is not None:
+            # calls that picked the old pool have an answer or have given up on it by then, so a stuck
+            # worker can't keep it around
+            retire = threading.Timer(RETIRE_AFTER + CALL_TIMEOUT, old_pool.terminate)
+            retire.daemon = True
+            retire.start()
+
+    def stop(self):
+        # also keeps this process from starting pools for later reloads (processes forked from it still can)
+        with self.lock:
+            pool = self._own_pool()
+            self.current = None
+            self.stopped_pid = os.getpid()
+        if pool is not None:
+            # calls still waiting on it run here instead (see run)
+            pool.terminate()
+
+    def run(self, function, data, *args, index=None, **kwargs):
+        """
+        function(data, *args, index=index, **kwargs) in a worker process, when data is the catalogue
+        the pool holds. Otherwise, e.g. for a request still using the previous catalogue after a
+        reload or in a process the pool wasn't forked from, it runs here.
+        """
+        current = self.current
+        if current is None or current[2] != os.getpid() or data is not current[1].data:
+            return function(data, *args, index=index, **kwargs)
+
+        try:
+            with stage('worker'):
+                result = current[0].apply_async(_run, (function, args, kwargs)).get(CALL_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            # a stuck or overloaded worker doesn't hold up the request
+            print(f"Worker process didn't answer {function.__name__} within {CALL_TIMEOUT}s, running it here")
+            return function(data, *args, index=index, **kwargs)
+        return result.records(data) if isinstance(result, RowResult) else result
+
+    def _own_pool(self):
+        # a pool inherited through a fork (e.g. by a gunicorn worker) belongs to the parent
+        if self.current is None or self.current[2] != os.getpid():
+            return None
+        return self.current[0]
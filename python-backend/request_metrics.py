@@ -0,0 +1,222 @@
+import contextvars
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from flask import g, request
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# stage timings (in milliseconds) of the request being handled, None outside a request
+_stage_timings = contextvars.ContextVar('stage_timings', default=None)
+
+
+@contextmanager
+def timed(timings, stage_name):
+    # adds the time spent in the block to timings[stage_name], in milliseconds
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage_name] = timings.get(stage_name, 0.0) + (time.perf_counter() - start) * 1000
+
+
+@contextmanager
+def stage(stage_name):
+    # times the block as a stage of the current request, does nothing outside a request
+    timings = _stage_timings.get()
+    if timings is None:
+        yield
+        return
+    with timed(timings, stage_name):
+        yield
+
+
+def request_stages():
+    # the current request's stage timings, for code that adds its own (e.g. extract_face)
+    timings = _stage_timings.get()
+    return {} if timings is None else timings
+
+
+def server_timing(timings):
+    # Server-Timing header value, e.g. "decode;dur=1.84, detect;dur=12.03"
+    return ', '.join(f'{stage_name};dur={duration:.2f}' for stage_name, duration in timings.items())
+
+
+class Histogram:
+    """
+    Prometheus style histogram, one set of bucket counts per combination of label values.
+    """
+
+    def __init__(self, name, description, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        # labels is a tuple of values in the order of label_names
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self.series.items())
+
+        for labels, counts, total in series:
+            label_text = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_text}}} {total}')
+            lines.append(f'{self.name}_count{{{label_text}}} {cumulative}')
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RequestMetrics:
+    """
+    Latency histograms for every route and for the stages of handling a request (filter, sample,
+    score, serialize, and decode, detect, crop, infer for photos). Metrics are kept per process,
+    so with several workers each scrape of /metrics sees the worker that answered it.
+    """
+
+    def __init__(self):
+        self.requests = Histogram('melodex_request_duration_seconds', 'Time spent handling requests.',
+                                  ('route', 'method', 'status'))
+        self.stages = Histogram('melodex_stage_duration_seconds', 'Time spent in each stage of a request.',
+                                ('route', 'stage'))
+
+    def observe_stages(self, route, timings):
+        for stage_name, duration in timings.items():
+            self.stages.observe((route, stage_name), duration / 1000)
+
+    def render(self):
+        # Prometheus text exposition format
+        return '\n'.join(self.requests.render() + self.stages.render()) + '\n'
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler for slow requests. While requests are running a background thread records
+    the stack of every thread handling one each interval_ms. When a request took longer than
+    threshold_ms its samples are kept (the last `keep` of them) as counts of folded stacks,
+    innermost frame last, the format flame graph tools read.
+    """
+
+    def __init__(self, threshold_ms, interval_ms=5.0, keep=20, max_depth=40):
+        self.threshold_ms = threshold_ms
+        self.interval = interval_ms / 1000
+        self.max_depth = max_depth
+        self.profiles = deque(maxlen=keep)
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.sampler_pid = None
+
+    def start(self):
+        # threads don't survive a fork, so the sampler is started in the process that serves requests
+        with self.lock:
+            self.samples[threading.get_ident()] = []
+            if self.sampler_pid != os.getpid():
+                self.sampler_pid = os.getpid()
+                threading.Thread(target=self._sample, name='slow-request-profiler', daemon=True).start()
+
+    def stop(self, route, duration_ms):
+        with self.lock:
+            samples = self.samples.pop(threading.get_ident(), None)
+        if samples is None or duration_ms < self.threshold_ms:
+            return
+
+        stacks = Counter(samples)
+        self.profiles.append({
+            'route': route,
+            'duration_ms': duration_ms,
+            'finished_at': time.time(),
+            'samples': len(samples),
+            'stacks': [{'stack': stack, 'count': count} for stack, count in stacks.most_common()]
+        })
+        print(f"Slow request: {route} took {duration_ms:.0f} ms ({len(samples)} samples)")
+
+    def recent(self):
+        return list(self.profiles)
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                threads = list(self.samples)
+            if not threads:
+                continue
+
+            frames = sys._current_frames()
+            stacks = {thread: self._folded(frames[thread]) for thread in threads if thread in frames}
+            with self.lock:
+                for thread, stack in stacks.items():
+                    # the request may have finished in the meantime
+                    if thread in self.samples:
+                        self.samples[thread].append(stack)
+
+    def _folded(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}')
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+
+def instrument(app, metrics, profiler=None):
+    """
+    Time every request of the app into metrics (and profile it with profiler if given), and
+    send the stage timings of each response in its Server-Timing header.
+    """
+
+    @app.before_request
+    def start_request_timing():
+        g.request_start = time.perf_counter()
+        timings = {}
+        # time spent waiting for a worker thread, when served through asgi_app
+        if 'melodex.queue_ms' in request.environ:
+            timings['queue'] = request.environ['melodex.queue_ms']
+        g.stage_timings_token = _stage_timings.set(timings)
+        if profiler is not None:
+            profiler.start()
+
+    @app.after_request
+    def add_server_timing(response):
+        g.response_status = response.status_code
+        timings = _stage_timings.get()
+        if timings:
+            response.headers['Server-Timing'] = server_timing(timings)
+        return response
+
+    @app.teardown_request
+    def finish_request_timing(exception=None):
+        if 'request_start' not in g:
+            return
+        duration = time.perf_counter() - g.request_start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        status = g.get('response_status', 500)
+
+        metrics.requests.observe((route, request.method, str(status)), duration)
+        metrics.observe_stages(route, _stage_timings.get() or {})
+        _stage_timings.reset(g.stage_timings_token)
+        if profiler is not None:
+            profiler.stop(route, duration * 1000)
@@ -0,0 +1,196 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import Response, make_response, request
+
+
+class LocalSharedBackend:
+    """
+    In-process stand-in for a cache shared between workers (same get/set/clear interface
+    as RedisBackend), useful for development and for running with a single worker.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.values.get(key, (None, None))
+        if expires is not None and expires < time.monotonic():
+            return None
+        return value
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.values[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class RedisBackend:
+    """
+    Cache shared by every worker through redis (needs the redis package).
+    Keys already contain the catalogue version, so clear() doesn't have to touch redis.
+    """
+
+    def __init__(self, url, prefix='melodex:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, ex=int(ttl) if ttl else None)
+
+    def clear(self):
+        pass
+
+
+class ResponseCache:
+    """
+    Bounded LRU cache of serialised JSON responses, keyed by endpoint, normalised query
+    arguments and catalogue version. Entries can expire after ttl seconds. An optional shared
+    backend is checked on local misses, so a response computed by one worker is reused by others.
+    """
+
+    def __init__(self, max_entries=2048, ttl=None, backend=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.catalogue_version = '0'
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        # shared backend calls that failed (e.g. redis down), they count as misses and skipped stores
+        self.shared_errors = 0
+
+    def key(self, endpoint, args):
+        # url encoded, so a value containing & or = can't pass for other arguments
+        arguments = urlencode([(name, str(value)) for name, value in sorted(args.items()) if value is not None])
+        return f'{self.catalogue_version}:{endpoint}?{arguments}'
+
+    def get(self, key):
+        # returns (status, body) or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                status, body, expires = entry
+                if expires is None or expires >= time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return status, body
+                del self.entries[key]
+
+        if self.backend is not None:
+            value = self._shared('get', key)
+            if value is not None:
+                status, body = value.split(b' ', 1)
+                self._store(key, int(status), body)
+                with self.lock:
+                    self.shared_hits += 1
+                return int(status), body
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, status, body):
+        self._store(key, status, body)
+        if self.backend is not None:
+            self._shared('set', key, str(status).encode() + b' ' + body, self.ttl)
+
+    def invalidate(self, catalogue_version=None):
+        # called when the catalogue is reloaded, the new version keeps stale shared entries from being used
+        with self.lock:
+            self.entries.clear()
+            if catalogue_version is not None:
+                self.catalogue_version = str(catalogue_version)
+        if self.backend is not None:
+            self._shared('clear')
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'shared_errors': self.shared_errors,
+                'hit_rate': (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+                'catalogue_version': self.catalogue_version
+            }
+
+    def _shared(self, method, *args):
+        # the shared backend is optional, when it fails the response is computed (or kept) locally
+        try:
+            return getattr(self.backend, method)(*args)
+        except Exception as e:
+            print(f"Error using the shared response cache ({method}): {e}")
+            with self.lock:
+                self.shared_errors += 1
+            return None
+
+    def _store(self, key, status, body):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries[key] = (status, body, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+def int_argument(default):
+    # normalises a query argument the way request.args.get(name, default, type=int) reads it
+    def parse(value):
+        try:
+            return int(value)
+        except ValueError:
+            return default
+    return parse
+
+
+def cached_response(cache, endpoint, params=None):
+    """
+    Decorator for routes whose JSON response only depends on the given query parameters.
+    params maps each parameter name to a function that normalises its value (or None to use it as is),
+    it should read it the same way the view does (e.g. int_argument) so the key holds what the view sees.
+    Responses with a server error status are never cached.
+    """
+    params = params or {}
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            values = {}
+            for name, normalise in params.items():
+                value = request.args.get(name)
+                values[name] = normalise(value) if normalise is not None and value is not None else value
+            key = cache.key(endpoint, values)
+
+            hit = cache.get(key)
+            if hit is not None:
+                status, body = hit
+                return Response(body, status=status, mimetype='application/json', headers={'X-Cache': 'HIT'})
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code < 500:
+                cache.set(key, response.status_code, response.get_data())
+            response.headers['X-Cache'] = 'MISS'
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,172 @@
+import copy
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from catalogue_index import SIMILARITY_FEATURES, SIMILARITY_SCALES, SIMILARITY_WEIGHTS
+
+SIMILAR_TABLE_VERSION = 1
+
+# neighbours kept per track, /api/similar calls asking for more are computed live
+SIMILAR_TABLE_SIZE = 50
+
+# tracks per task handed to a worker process while building
+BUILD_CHUNK_TRACKS = 2048
+
+# what the table was built from, handed to the worker processes through fork
+_build_similarity = None
+
+
+def similar_table_path_for(dataset_path):
+    # songs_dataset.csv -> songs_dataset.similar (a directory)
+    return os.path.splitext(dataset_path)[0] + '.similar'
+
+
+class SimilarTable:
+    """
+    The SIMILAR_TABLE_SIZE nearest tracks in the same genre of every track (find_similar_songs with
+    scope 'genre'), precomputed by build_similar_table. positions[row] are the row positions of the
+    neighbours of the track at row, closest first and -1 past the end of a small genre. It is
+    memory-mapped, so every worker shares one copy. The scores aren't stored, the few that are
+    served are computed again from the feature matrix, exactly as a live call would.
+
+    Genres updated since the table was built (see CatalogueIndex.upsert) are left to live computation,
+    as are tracks added since.
+    """
+
+    def __init__(self, path, version, positions, stale_genres=frozenset()):
+        self.path = path
+        self.version = version
+        self.positions = positions
+        self.stale_genres = stale_genres
+
+    def upsert(self, genres):
+        # this table for the catalogue after tracks in `genres` were updated or added
+        updated = copy.copy(self)
+        updated.stale_genres = self.stale_genres | frozenset(genres)
+        return updated
+
+    def nearest(self, position, genre, count):
+        # row positions of the `count` tracks most similar to the track at position, None if the table can't tell
+        if not 0 < count <= self.positions.shape[1] or position >= len(self.positions) or genre in self.stale_genres:
+            return None
+        found = self.positions[position, :count]
+        return found[found >= 0].astype(np.int64)
+
+
+def build_similar_table(catalogue, table_path, processes=None):
+    """
+    Write the SimilarTable of a loaded Catalogue to table_path (a directory), computed in chunks of
+    BUILD_CHUNK_TRACKS tracks by `processes` worker processes (one per core by default) with the same
+    code find_similar_songs uses, so the table gives exactly the songs a live call would.
+    """
+    global _build_similarity
+    similarity = catalogue.index.similarity
+    if similarity.missing_columns:
+        raise ValueError(f'Missing columns in dataset: {", ".join(similarity.missing_columns)}')
+
+    # like build_snapshot, written to a temporary directory first so a half written table is never loaded
+    building_path = f'{table_path}.building-{os.getpid()}'
+    shutil.rmtree(building_path, ignore_errors=True)
+    os.makedirs(building_path)
+
+    shape = (len(catalogue.data), SIMILAR_TABLE_SIZE)
+    positions = np.lib.format.open_memmap(os.path.join(building_path, 'positions.npy'), 'w+', np.int32, shape)
+    positions[:] = -1
+    del positions
+
+    # the matrix columns are grouped by genre, so most chunks are scored against a single genre
+    chunks = [(building_path, similarity.positions[start:start + BUILD_CHUNK_TRACKS])
+              for start in range(0, len(similarity.positions), BUILD_CHUNK_TRACKS)]
+    processes = processes or os.cpu_count() or 1
+    _build_similarity = similarity
+    try:
+        if processes > 1 and len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                for _ in pool.imap_unordered(_build_chunk, chunks):
+                    pass
+        else:
+            for chunk in chunks:
+                _build_chunk(chunk)
+    finally:
+        _build_similarity = None
+
+    meta = {
+        'version': SIMILAR_TABLE_VERSION,
+        'catalogue_version': catalogue.version,
+        'rows': len(catalogue.data),
+        'weights': _weights()
+    }
+    with open(os.path.join(building_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    shutil.rmtree(table_path, ignore_errors=True)
+    try:
+        os.rename(building_path, table_path)
+    except OSError:
+        # another process put its (identical) table in place first
+        shutil.rmtree(building_path, ignore_errors=True)
+    return table_path
+
+
+def load_similar_table(table_path, catalogue):
+    """
+    The SimilarTable at table_path if it was built for this version of the catalogue with the current
+    similarity weights, otherwise None.
+    """
+    meta = _read_meta(table_path)
+    if (meta is None or meta.get('version') != SIMILAR_TABLE_VERSION or meta.get('weights') != _weights()
+            or meta.get('catalogue_version') != catalogue.version or meta.get('rows') != len(catalogue.data)):
+        return None
+    try:
+        positions = np.load(os.path.join(table_path, 'positions.npy'), mmap_mode='r')
+    except (OSError, ValueError) as e:
+        print(f"Error loading similar songs table: {e}")
+        return None
+    return SimilarTable(table_path, catalogue.version, positions)
+
+
+def _build_chunk(task):
+    # nearest tracks of one chunk, written straight into the table's file
+    building_path, chunk = task
+    similarity = _build_similarity
+    track_ids = similarity.track_ids[similarity.columns[chunk]]
+    nearest = similarity.nearest_in_genre_batch(chunk, [SIMILAR_TABLE_SIZE] * len(chunk), list(track_ids))
+
+    positions = np.load(os.path.join(building_path, 'positions.npy'), mmap_mode='r+')
+    for position, (found, _) in zip(chunk, nearest):
+        positions[position, :len(found)] = found
+    positions.flush()
+
+
+def _weights():
+    # the similarity formula the table was computed with, a table built with other weights is stale
+    return {feature: [SIMILARITY_WEIGHTS[feature], SIMILARITY_SCALES.get(feature, 1)]
+            for feature in SIMILARITY_FEATURES}
+
+
+def _read_meta(table_path):
+    try:
+        with open(os.path.join(table_path, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+if __name__ == '__main__':
+    # python similar_table.py path/to/songs_dataset.csv [processes]
+    # builds the table for the catalogue the server would load, saved deltas included
+    from catalogue_manager import CatalogueManager
+    from catalogue_store import drop_duplicate_tracks
+    from music_recommender import load_data
+
+    dataset_path = sys.argv[1]
+    manager = CatalogueManager(dataset_path, lambda path: drop_duplicate_tracks(load_data(path)), poll_interval=0)
+    if not manager.reload():
+        sys.exit(f'Could not load {dataset_path}')
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    print(f'Wrote {build_similar_table(manager.current, similar_table_path_for(dataset_path), processes)}')
@@ -0,0 +1,72 @@
+"""
+The prebuilt CatalogueIndex gives the same results as scanning the DataFrame (index=None), which is
+what the recommenders did before it. Run from python-backend/: python -m pytest tests
+"""
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import make_catalogue
+from catalogue_index import CatalogueIndex
+from music_recommender import (find_similar_songs, get_song_analysis, recommend_by_activity, recommend_by_mood,
+                               search_songs)
+
+ROWS = 3000
+
+
+@pytest.fixture(scope='module')
+def catalogue():
+    data = make_catalogue(ROWS).reset_index(drop=True)
+    # a genre with two songs, one with a single song and a song missing a feature
+    data.loc[:1, 'track_genre'] = 'tiny'
+    data.loc[2, 'track_genre'] = 'alone'
+    data.loc[5, 'energy'] = np.nan
+    return data, CatalogueIndex(data)
+
+
+def same_songs(a, b):
+    # equal results, a NaN similarity_score equal to another NaN
+    if isinstance(a, dict) or isinstance(b, dict):
+        return a == b
+    return len(a) == len(b) and all(
+        x.keys() == y.keys() and all(x[k] == y[k] or (x[k] != x[k] and y[k] != y[k]) for k in x)
+        for x, y in zip(a, b))
+
+
+@pytest.mark.parametrize('count', [1, 5, 20])
+def test_similar_songs_match_scan(catalogue, count):
+    data, index = catalogue
+    for track_id in list(data['track_id'].iloc[:6]) + list(data['track_id'].sample(40, random_state=1)):
+        assert same_songs(find_similar_songs(data, track_id, count, index=index),
+                          find_similar_songs(data, track_id, count)), track_id
+    assert find_similar_songs(data, 'missing', count, index=index) == find_similar_songs(data, 'missing', count)
+
+
+def test_search_matches_scan(catalogue):
+    data, index = catalogue
+    names = data['track_name'].str.lower().sample(20, random_state=2)
+    queries = ['love', 'night fire', 'artist 1', 'zzz', 'a', 'e l'] + [name[:k] for name in names for k in (2, 5, 9)]
+    for query in queries:
+        for limit in (1, 10, 50):
+            assert search_songs(data, query, index=index, limit=limit) == search_songs(data, query, limit=limit), query
+
+
+def test_song_analysis_matches_scan(catalogue):
+    data, index = catalogue
+    for track_id in list(data['track_id'].iloc[:6]) + ['missing']:
+        assert same_songs([get_song_analysis(data, track_id, index=index)], [get_song_analysis(data, track_id)])
+
+
+@pytest.mark.parametrize('ranking', ['filter', 'score'])
+def test_mood_and_activity_songs_match_scan(catalogue, ranking):
+    data, index = catalogue
+    # the same random draws on both paths, and no sampling at all for ranking='score'
+    for mood, genre in [('happy', None), ('sad', 'jazz'), ('calm', 'tiny'), ('energetic', 'unknown')]:
+        np.random.seed(3)
+        indexed = recommend_by_mood(data, mood, count=8, genre=genre, ranking=ranking, temperature=0, index=index)
+        np.random.seed(3)
+        assert indexed == recommend_by_mood(data, mood, count=8, genre=genre, ranking=ranking, temperature=0)
+    for activity in ['workout', 'studying', 'meditation']:
+        np.random.seed(4)
+        indexed = recommend_by_activity(data, activity, count=8, ranking=ranking, temperature=0, index=index)
+        np.random.seed(4)
+        assert indexed == recommend_by_activity(data, activity, count=8, ranking=ranking, temperature=0)
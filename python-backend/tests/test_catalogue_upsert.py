@@ -0,0 +1,117 @@
+"""
+A CatalogueIndex updated by upsert gives the same results as one built from scratch on the updated
+catalogue. Run from python-backend/: python -m pytest tests
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import make_catalogue
+from catalogue_index import CatalogueIndex
+from catalogue_store import upsert_tracks
+from music_recommender import (find_similar_songs, get_song_analysis, random_recommendations, recommend_by_mood,
+                               search_songs)
+
+ROWS = 3000
+
+
+def make_delta(data, seed):
+    # replaced tracks, some moving genre (one to a new genre, one losing it), and new tracks
+    rng = np.random.default_rng(seed)
+    changed = data.iloc[rng.choice(len(data), 60, replace=False)].copy()
+    changed['popularity'] = rng.integers(0, 100, len(changed))
+    changed['energy'] = rng.random(len(changed))
+    changed.iloc[:5, changed.columns.get_loc('track_genre')] = 'jazz'
+    changed.iloc[5, changed.columns.get_loc('track_genre')] = 'brand-new-genre'
+    changed.iloc[6, changed.columns.get_loc('track_id')] = f'renamed-{seed}'
+    changed.iloc[7, changed.columns.get_loc('track_genre')] = np.nan
+    added = make_catalogue(40, seed=seed)
+    added['track_id'] = [f'new-{seed}-{i}' for i in range(len(added))]
+    added['track_name'] = [f'New Song {seed} {i} love' for i in range(len(added))]
+    added.iloc[:3, added.columns.get_loc('track_genre')] = 'another-new'
+    return pd.concat([changed, added], ignore_index=True)
+
+
+@pytest.fixture(scope='module')
+def catalogues():
+    # the index after two upserts in a row, and the index built from the same data
+    data = make_catalogue(ROWS).reset_index(drop=True)
+    data.attrs['deduplicated'] = True
+    index = CatalogueIndex(data)
+    keys = None
+    for seed in (1, 2):
+        data, changed, added, keys = upsert_tracks(data, make_delta(data, seed), keys)
+        index = index.upsert(data, changed, added, keys)
+    return data, index, CatalogueIndex(data)
+
+
+def same_songs(a, b):
+    # equal results, a NaN similarity_score equal to another NaN
+    if isinstance(a, dict) or isinstance(b, dict):
+        return a == b
+    return len(a) == len(b) and all(
+        x.keys() == y.keys() and all(x[k] == y[k] or (x[k] != x[k] and y[k] != y[k]) for k in x)
+        for x, y in zip(a, b))
+
+
+def sample_track_ids(data):
+    # updated tracks (replaced ones are spread over the catalogue, added ones are at the end) and others
+    return list(data['track_id'].iloc[-45:]) + list(data['track_id'].sample(60, random_state=3)) + ['renamed-1']
+
+
+def test_tracks_match_fresh_build(catalogues):
+    data, upserted, built = catalogues
+    assert upserted.tracks.positions == built.tracks.positions
+    for track_id in sample_track_ids(data):
+        assert same_songs([get_song_analysis(data, track_id, index=upserted)],
+                          [get_song_analysis(data, track_id, index=built)]), track_id
+
+
+@pytest.mark.parametrize('count', [1, 10])
+def test_similar_songs_match_fresh_build(catalogues, count):
+    data, upserted, built = catalogues
+    for track_id in sample_track_ids(data):
+        assert same_songs(find_similar_songs(data, track_id, count, index=upserted),
+                          find_similar_songs(data, track_id, count, index=built)), track_id
+
+
+def test_search_matches_fresh_build(catalogues):
+    data, upserted, built = catalogues
+    names = data['track_name'].str.lower()
+    queries = ['love', 'new song', 'new song 2', 'artist 1', 'zzz', 'e l'] + \
+        [name[:k] for name in names.iloc[-45:] for k in (3, 8)] + list(names.sample(20, random_state=4))
+    for query in queries:
+        for limit in (1, 10, 30):
+            assert search_songs(data, query, index=upserted, limit=limit) == \
+                search_songs(data, query, index=built, limit=limit), query
+
+
+def test_masks_and_groups_match_fresh_build(catalogues):
+    data, upserted, built = catalogues
+    assert set(upserted.masks.genres) == set(built.masks.genres)
+    for genre, rows in built.masks.genres.items():
+        assert np.array_equal(upserted.masks.genre_rows(genre), rows), genre
+    for moods in ('popular', 'moods', 'activities'):
+        for name, mask in getattr(built.masks, moods).items():
+            assert np.array_equal(getattr(upserted.masks, moods)[name], mask), name
+    for groups in ('albums', 'artists'):
+        upserted_groups, built_groups = getattr(upserted.groups, groups), getattr(built.groups, groups)
+        assert set(upserted_groups) == set(built_groups), groups
+        for genre, (names, records) in built_groups.items():
+            assert list(upserted_groups[genre][0]) == list(names) and upserted_groups[genre][1] == records, genre
+
+
+@pytest.mark.parametrize('genre', [None, 'jazz', 'brand-new-genre', 'another-new'])
+def test_recommendations_match_fresh_build(catalogues, genre):
+    data, upserted, built = catalogues
+    # ties are broken at random, the same way on both
+    np.random.seed(5)
+    result = recommend_by_mood(data, 'happy', count=10, genre=genre, ranking='score', temperature=0, index=upserted)
+    np.random.seed(5)
+    assert result == recommend_by_mood(data, 'happy', count=10, genre=genre, ranking='score', temperature=0,
+                                       index=built)
+    for item_type in ('album', 'artist'):
+        np.random.seed(5)
+        result = random_recommendations(data, item_type, genre, count=5, index=upserted)
+        np.random.seed(5)
+        assert result == random_recommendations(data, item_type, genre, count=5, index=built), item_type
@@ -0,0 +1,58 @@
+"""
+The converted emotion model backends (see emotion_backends) give the same predictions as the Keras
+model they were converted from. Run from python-backend/: python -m pytest tests
+
+The trained model is checked when MELODEX_EMOTION_MODEL_PATH points at it, against whichever of
+its .tflite / .onnx artefacts exist. A small model with the same shapes is converted and checked in
+any case, tests whose runtime isn't installed are skipped.
+"""
+import os
+
+import pytest
+
+from emotion_backends import artefact_path, check_parity, convert
+
+MODEL_PATH = os.environ.get('MELODEX_EMOTION_MODEL_PATH', '')
+
+# largest difference allowed between the predicted probabilities
+ATOL = 1e-4
+
+# python modules each backend needs to convert to it and run it
+RUNTIMES = {
+    'tflite': ['tensorflow'],
+    'onnx': ['tensorflow', 'tf2onnx', 'onnxruntime']
+}
+
+
+@pytest.mark.parametrize('backend', ['tflite', 'onnx'])
+def test_trained_model_artefacts_match_keras(backend):
+    if not os.path.exists(MODEL_PATH):
+        pytest.skip('MELODEX_EMOTION_MODEL_PATH is not set to the trained model')
+    if not os.path.exists(artefact_path(MODEL_PATH, backend)):
+        pytest.skip(f'no {backend} artefact next to {MODEL_PATH}')
+    for module in RUNTIMES[backend]:
+        pytest.importorskip(module)
+
+    assert check_parity(MODEL_PATH, backend, atol=ATOL) <= ATOL
+
+
+@pytest.mark.parametrize('backend', ['tflite', 'onnx'])
+def test_converted_model_matches_keras(backend, tmp_path):
+    for module in RUNTIMES[backend]:
+        pytest.importorskip(module)
+    from tensorflow import keras
+
+    # 48x48 grayscale crops in, probabilities of the 4 emotions out, like the trained model
+    keras.utils.set_random_seed(0)
+    model = keras.Sequential([
+        keras.Input((48, 48, 1)),
+        keras.layers.Conv2D(8, 3, activation='relu'),
+        keras.layers.MaxPooling2D(),
+        keras.layers.Flatten(),
+        keras.layers.Dense(4, activation='softmax')
+    ])
+    keras_path = str(tmp_path / 'model.keras')
+    model.save(keras_path)
+
+    convert(keras_path, backend)
+    assert check_parity(keras_path, backend, atol=ATOL) <= ATOL
@@ -0,0 +1,66 @@
+"""
+The precomputed similar songs table (see similar_table) gives the same songs and scores as
+find_similar_songs computing them live. Run from python-backend/: python -m pytest tests
+"""
+import numpy as np
+import pytest
+
+from benchmarks.synthetic import make_catalogue
+from catalogue_manager import Catalogue
+from music_recommender import find_similar_songs, find_similar_songs_batch
+from similar_table import SIMILAR_TABLE_SIZE, build_similar_table, load_similar_table
+
+ROWS = 3000
+
+
+@pytest.fixture(scope='module')
+def catalogues(tmp_path_factory):
+    # the catalogue computing similar songs live, and a copy taking them from its table
+    data = make_catalogue(ROWS).reset_index(drop=True)
+    # a genre smaller than the table and a song missing a feature
+    data.loc[:2, 'track_genre'] = 'tiny'
+    data.loc[5, 'energy'] = np.nan
+    live = Catalogue(data, 'test')
+    table_path = str(tmp_path_factory.mktemp('similar') / 'songs_dataset.similar')
+    build_similar_table(live, table_path, processes=2)
+    table = load_similar_table(table_path, live)
+    assert table is not None and table.nearest(10, data['track_genre'][10], 5) is not None
+    return live, live.with_similar_table(table)
+
+
+def same_songs(a, b):
+    # equal results, a NaN similarity_score equal to another NaN
+    if isinstance(a, dict) or isinstance(b, dict):
+        return a == b
+    return len(a) == len(b) and all(
+        x.keys() == y.keys() and all(x[k] == y[k] or (x[k] != x[k] and y[k] != y[k]) for k in x)
+        for x, y in zip(a, b))
+
+
+def sample_track_ids(data):
+    return list(data['track_id'].iloc[:8]) + list(data['track_id'].sample(60, random_state=1))
+
+
+@pytest.mark.parametrize('count', [1, 5, SIMILAR_TABLE_SIZE, SIMILAR_TABLE_SIZE + 1])
+def test_table_matches_live(catalogues, count):
+    live, tabled = catalogues
+    for track_id in sample_track_ids(live.data):
+        assert same_songs(find_similar_songs(tabled.data, track_id, count, index=tabled.index),
+                          find_similar_songs(live.data, track_id, count, index=live.index)), track_id
+
+
+def test_batch_table_matches_live(catalogues):
+    live, tabled = catalogues
+    queries = [(track_id, count) for track_id in sample_track_ids(live.data) for count in (3, SIMILAR_TABLE_SIZE + 10)]
+    queries.append(('missing', 5))
+    for a, b in zip(find_similar_songs_batch(tabled.data, queries, index=tabled.index),
+                    find_similar_songs_batch(live.data, queries, index=live.index)):
+        assert same_songs(a, b)
+
+
+def test_stale_genres_are_computed_live(catalogues):
+    live, tabled = catalogues
+    table = tabled.index.similar_table.upsert(['jazz'])
+    position = live.index.tracks.position(live.data['track_id'][live.data['track_genre'] == 'jazz'].iloc[0])
+    assert table.nearest(position, 'jazz', 5) is None
+    assert tabled.index.similar_table.nearest(position, 'jazz', 5) is not None